@@ -0,0 +1,355 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""An event-driven HTTP front end for update checks.
+
+Connections are multiplexed by a single asyncore loop rather than served by a
+thread each, so that many idle keep-alive clients cost little more than their
+sockets. Update checks, which may have to generate or hash payloads, run on a
+small pool of worker threads; the cheap host info and status endpoints are
+answered directly from the loop. Payloads themselves are still served by
+CherryPy, which update responses point clients to.
+"""
+
+import asynchat
+import asyncore
+import httplib
+import os
+import Queue
+import socket
+import threading
+import time
+import traceback
+import urlparse
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('ASYNC_FRONTEND', message, *args)
+
+
+# Default number of threads running update checks.
+WORKER_THREADS = 10
+
+# Seconds after which idle connections are closed.
+IDLE_TIMEOUT = 300
+
+# Maximum sizes, in bytes, of request headers and bodies.
+_MAX_HEADER_SIZE = 64 * 1024
+_MAX_BODY_SIZE = 1024 * 1024
+
+
+class _HttpError(Exception):
+  """An error to be returned to the client as an HTTP status."""
+
+  def __init__(self, status):
+    Exception.__init__(self, status)
+    self.status = status
+
+
+def _ParseRequestHead(head):
+  """Parses the request line and headers of an HTTP request.
+
+  Returns:
+    A tuple of the method, path, query dictionary, HTTP version and a
+    dictionary of headers, with lowercase names.
+  Raises:
+    _HttpError(400) if the request is malformed.
+  """
+  lines = head.lstrip('\r\n').split('\r\n')
+  try:
+    method, target, version = lines[0].split()
+    headers = {}
+    for line in lines[1:]:
+      name, value = line.split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+  except ValueError:
+    raise _HttpError(400)
+  url = urlparse.urlsplit(target)
+  query = dict((name, values[-1]) for name, values in
+               urlparse.parse_qs(url.query).iteritems())
+  return method, url.path, query, version, headers
+
+
+class _Wakeup(asyncore.file_dispatcher):
+  """A pipe through which worker threads wake up the asyncore loop."""
+
+  def __init__(self, callback, asyncore_map):
+    read_fd, self._write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, read_fd, map=asyncore_map)
+    os.close(read_fd)
+    self._callback = callback
+
+  def Wake(self):
+    os.write(self._write_fd, 'x')
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    self.recv(4096)
+    self._callback()
+
+
+class _HttpChannel(asynchat.async_chat):
+  """A client connection, carrying any number of requests in sequence.
+
+  While a request is being handled, no further input is read, and input
+  already received is kept aside until the response is sent, so pipelined
+  requests are answered in order.
+
+  Members:
+    busy: whether a request is being handled.
+    last_activity: time of the last input or output on the connection.
+  """
+
+  def __init__(self, front_end, sock, addr):
+    asynchat.async_chat.__init__(self, sock, map=front_end.asyncore_map)
+    self._front_end = front_end
+    self._client_ip = addr[0]
+    self._incoming = []
+    self._incoming_size = 0
+    # Input received after the request being handled.
+    self._pending = ''
+    self._request = None
+    self._keep_alive = False
+    self.busy = False
+    self.last_activity = time.time()
+    self.set_terminator('\r\n\r\n')
+
+  def readable(self):
+    return not self.busy and asynchat.async_chat.readable(self)
+
+  def recv(self, buffer_size):
+    # Input kept aside while busy is parsed before reading any more.
+    if self._pending:
+      data, self._pending = self._pending, ''
+      return data
+    return asynchat.async_chat.recv(self, buffer_size)
+
+  def collect_incoming_data(self, data):
+    self.last_activity = time.time()
+    if self.busy:
+      self._pending += data
+      return
+    self._incoming.append(data)
+    self._incoming_size += len(data)
+    if self._request is None and self._incoming_size > _MAX_HEADER_SIZE:
+      self.close()
+
+  def found_terminator(self):
+    data = ''.join(self._incoming)
+    self._incoming = []
+    self._incoming_size = 0
+
+    if self._request is None:
+      try:
+        request = _ParseRequestHead(data)
+        length = int(request[4].get('content-length', 0))
+      except (_HttpError, ValueError):
+        self._keep_alive = False
+        self.SendResponse(400, '')
+        return
+      if length > _MAX_BODY_SIZE:
+        self._keep_alive = False
+        self.SendResponse(413, '')
+        return
+      if length > 0:
+        self._request = request
+        self.set_terminator(length)
+        return
+      body = ''
+    else:
+      request, body = self._request, data
+      self._request = None
+      self.set_terminator('\r\n\r\n')
+
+    method, path, query, version, headers = request
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+      self._keep_alive = connection == 'keep-alive'
+    else:
+      self._keep_alive = connection != 'close'
+
+    # Without a terminator, the rest of the input goes to _pending.
+    self.busy = True
+    self.set_terminator(None)
+    try:
+      func, args, offload = self._front_end.GetHandler(
+          method, path, query, headers, body, self._client_ip)
+    except _HttpError as e:
+      self.SendResponse(e.status, '')
+      return
+    if offload:
+      self._front_end.Submit(self, func, args)
+    else:
+      self.SendResponse(*self._front_end.RunHandler(func, args))
+
+  def SendResponse(self, status, body):
+    """Sends a response and gets ready for the next request.
+
+    Must be called from the asyncore loop.
+    """
+    body = body or ''
+    head = ['HTTP/1.1 %d %s' % (status, httplib.responses.get(status, '')),
+            'Content-Type: text/html;charset=utf-8',
+            'Content-Length: %d' % len(body)]
+    if not self._keep_alive:
+      head.append('Connection: close')
+    self.push('\r\n'.join(head) + '\r\n\r\n' + body)
+    self.busy = False
+    self.set_terminator('\r\n\r\n')
+    self.last_activity = time.time()
+    if not self._keep_alive:
+      self.close_when_done()
+    elif self._pending:
+      self.handle_read()
+
+
+class AsyncFrontEnd(asyncore.dispatcher):
+  """Serves update checks and host info requests from an asyncore loop.
+
+  Members:
+    asyncore_map: the socket map of the front end's asyncore loop.
+  """
+
+  def __init__(self, updater, host, port, static_port,
+               num_workers=WORKER_THREADS, idle_timeout=IDLE_TIMEOUT):
+    """Binds the front end's listening socket.
+
+    Args:
+      updater: the Autoupdate object handling requests.
+      host: address to listen on.
+      port: port to listen on.
+      static_port: port of the CherryPy server that serves payloads.
+      num_workers: number of threads running update checks.
+      idle_timeout: seconds after which idle connections are closed.
+    """
+    self.asyncore_map = {}
+    asyncore.dispatcher.__init__(self, map=self.asyncore_map)
+    self._updater = updater
+    self._static_port = static_port
+    self._idle_timeout = idle_timeout
+
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    self.create_socket(family, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    if family == socket.AF_INET6:
+      self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    self.bind((host, port))
+    self.listen(socket.SOMAXCONN)
+
+    self._tasks = Queue.Queue()
+    self._completed = Queue.Queue()
+    self._wakeup = _Wakeup(self._DeliverResponses, self.asyncore_map)
+    for _ in range(num_workers):
+      worker = threading.Thread(target=self._RunTasks)
+      worker.daemon = True
+      worker.start()
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair:
+      _HttpChannel(self, *pair)
+
+  def _GetHostname(self, headers):
+    """Returns the base URL payloads should be downloaded from."""
+    x_forwarded_host = headers.get('x-forwarded-host')
+    if x_forwarded_host:
+      return 'http://' + x_forwarded_host
+    host = headers.get('host', socket.getfqdn())
+    if not host.endswith(']'):
+      host = host.rsplit(':', 1)[0]
+    return 'http://%s:%d' % (host, self._static_port)
+
+  def GetHandler(self, method, path, query, headers, body, client_ip):
+    """Maps a request to the function computing its response body.
+
+    Returns:
+      A tuple of the function, its arguments and whether it must be run off
+      the asyncore loop.
+    Raises:
+      _HttpError if the request can't be handled.
+    """
+    parts = path.strip('/').split('/')
+    updater = self._updater
+    if parts[0] == 'update':
+      if method != 'POST':
+        raise _HttpError(405)
+      label = '/'.join(parts[1:])
+      return (updater.HandleUpdatePing,
+              (body, label, client_ip, self._GetHostname(headers)), True)
+    if parts[0] != 'api' or len(parts) < 2:
+      raise _HttpError(404)
+    if parts[1:] == ['hostinfo'] and query.get('ip'):
+      return updater.HandleHostInfoPing, (query['ip'],), False
+    if parts[1:] == ['cachestats']:
+      return updater.HandleCacheStatsPing, (), False
+    if parts[1:] == ['payloadjobs']:
+      return updater.HandlePayloadJobsPing, (), False
+    if parts[1] == 'setnextupdate' and len(parts) == 3 and method == 'POST':
+      label = body.strip()
+      if not label:
+        raise _HttpError(400)
+      return updater.HandleSetUpdatePing, (parts[2], label), False
+    raise _HttpError(404)
+
+  @staticmethod
+  def RunHandler(func, args):
+    """Runs a request handler.
+
+    Returns:
+      A tuple of the HTTP status and the response body.
+    """
+    try:
+      return 200, func(*args)
+    except Exception:
+      _Log('Request failed: %s', traceback.format_exc())
+      return 500, ''
+
+  def Submit(self, channel, func, args):
+    """Runs a request handler on a worker thread, answering on channel."""
+    self._tasks.put((channel, func, args))
+
+  def _RunTasks(self):
+    """Worker thread loop; runs request handlers forever."""
+    while True:
+      channel, func, args = self._tasks.get()
+      self._completed.put((channel, self.RunHandler(func, args)))
+      self._wakeup.Wake()
+
+  def _DeliverResponses(self):
+    """Sends the responses of completed handlers to their clients."""
+    while True:
+      try:
+        channel, response = self._completed.get_nowait()
+      except Queue.Empty:
+        return
+      if channel.connected:
+        channel.SendResponse(*response)
+
+  def _CloseIdleChannels(self):
+    expiry = time.time() - self._idle_timeout
+    for channel in self.asyncore_map.values():
+      if (isinstance(channel, _HttpChannel) and not channel.busy and
+          channel.last_activity < expiry):
+        channel.close()
+
+  def Serve(self):
+    """Runs the asyncore loop forever."""
+    _Log('Serving on port %d', self.socket.getsockname()[1])
+    next_idle_check = 0
+    while True:
+      asyncore.loop(timeout=1, use_poll=True, map=self.asyncore_map, count=1)
+      if time.time() >= next_idle_check:
+        self._CloseIdleChannels()
+        next_idle_check = time.time() + 1
+
+  def Start(self):
+    """Runs the asyncore loop in a background thread."""
+    thread = threading.Thread(target=self.Serve)
+    thread.daemon = True
+    thread.start()
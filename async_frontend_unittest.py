@@ -0,0 +1,98 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for async_frontend module."""
+
+import httplib
+import socket
+import unittest
+
+import mox
+
+import async_frontend
+import autoupdate
+
+
+class AsyncFrontEndTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.updater = self.mox.CreateMock(autoupdate.Autoupdate)
+    self.front_end = async_frontend.AsyncFrontEnd(self.updater, '127.0.0.1', 0,
+                                                  8080, num_workers=2)
+    self.front_end.Start()
+    self.conn = httplib.HTTPConnection(
+        '127.0.0.1', self.front_end.socket.getsockname()[1])
+
+  def tearDown(self):
+    self.conn.close()
+    mox.MoxTestBase.tearDown(self)
+
+  def _Request(self, method, url, body=None, headers=None):
+    self.conn.request(method, url, body, headers or {})
+    response = self.conn.getresponse()
+    return response.status, response.read()
+
+  def testKeepAlive(self):
+    """Tests that several requests are served on one connection."""
+    self.updater.HandleUpdatePing('<request/>', 'some/label', '127.0.0.1',
+                                  'http://myhost:8080').AndReturn('update')
+    self.updater.HandleHostInfoPing('1.2.3.4').AndReturn('{}')
+    self.updater.HandleSetUpdatePing('1.2.3.4', 'label').AndReturn(None)
+    self.mox.ReplayAll()
+
+    self.assertEqual(self._Request('POST', '/update/some/label', '<request/>',
+                                   {'Host': 'myhost:9090'}),
+                     (200, 'update'))
+    self.assertEqual(self._Request('GET', '/api/hostinfo?ip=1.2.3.4'),
+                     (200, '{}'))
+    self.assertEqual(self._Request('POST', '/api/setnextupdate/1.2.3.4',
+                                   'label\n'),
+                     (200, ''))
+    self.mox.VerifyAll()
+
+  def testPipelining(self):
+    """Tests that pipelined requests are answered in order."""
+    self.updater.HandleUpdatePing('<request/>', '', '127.0.0.1',
+                                  'http://myhost:8080').AndReturn('update')
+    self.updater.HandleHostInfoPing('1.2.3.4').AndReturn('{}')
+    self.mox.ReplayAll()
+
+    sock = socket.create_connection(('127.0.0.1', self.conn.port))
+    sock.sendall('POST /update HTTP/1.1\r\nHost: myhost\r\n'
+                 'Content-Length: 10\r\n\r\n<request/>'
+                 'GET /api/hostinfo?ip=1.2.3.4 HTTP/1.1\r\n'
+                 'Connection: close\r\n\r\n')
+    data = ''
+    while True:
+      chunk = sock.recv(4096)
+      if not chunk:
+        break
+      data += chunk
+    sock.close()
+    responses = data.split('HTTP/1.1 ')[1:]
+    self.assertEqual(len(responses), 2)
+    self.assertTrue(responses[0].endswith('\r\n\r\nupdate'))
+    self.assertTrue(responses[1].endswith('\r\n\r\n{}'))
+    self.mox.VerifyAll()
+
+  def testErrors(self):
+    self.updater.HandleUpdatePing(
+        '<request/>', '', '127.0.0.1', 'http://proxy').AndRaise(
+            autoupdate.AutoupdateError('failed'))
+    self.mox.ReplayAll()
+
+    self.assertEqual(self._Request('POST', '/update', '<request/>',
+                                   {'X-Forwarded-Host': 'proxy'})[0], 500)
+    self.assertEqual(self._Request('GET', '/update')[0], 405)
+    self.assertEqual(self._Request('GET', '/static/update.gz')[0], 404)
+    self.assertEqual(self._Request('POST', '/api/setnextupdate/1.2.3.4')[0],
+                     400)
+    self.mox.VerifyAll()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,25 +2,37 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import base64
+import binascii
+import collections
 import json
 import os
 import errno
+import heapq
+import itertools
 import re
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
 import time
-import urllib2
 import urlparse
 
 import cherrypy
 
 import autoupdate_lib
 import common_util
+import image_catalog
 import log_util
+import metrics
+import payload_cache
+import remote_fileinfo
 
 
 # Module-local log function.
-def _Log(message, *args):
-  return log_util.LogWithTag('UPDATE', message, *args)
+def _Log(message, *args, **kwargs):
+  return log_util.LogWithTag('UPDATE', message, *args, **kwargs)
 
 
 UPDATE_FILE = 'update.gz'
@@ -29,6 +41,41 @@ METADATA_FILE = 'update.meta'
 KERNEL_METADATA_FILE = 'kernel_update.meta'
 CACHE_DIR = 'cache'
 
+# Maximum number of payloads whose metadata is kept in memory.
+METADATA_CACHE_ENTRIES = 64
+
+# Maximum number of files whose MD5 is kept in memory.
+FILE_MD5_ENTRIES = 64
+
+# Default maximum number of hosts to keep information on, and of log entries to
+# keep per host.
+MAX_HOSTS = 10000
+HOST_LOG_ENTRIES = 100
+
+# Number of independently locked shards the host info table is split into.
+HOST_TABLE_SHARDS = 16
+
+# Number of hosts whose logs are fetched from the host info table at a time.
+HOST_LOG_BATCH = 100
+
+# Maximum number of base URLs whose static URL base is remembered.
+MAX_STATIC_URLS = 100
+
+# Maximum number of distinct host-reported strings to share among log entries.
+MAX_INTERNED_STRINGS = 10000
+
+# Omaha event result reported by clients whose update failed.
+EVENT_RESULT_ERROR = 0
+
+_interned_strings = {}
+
+# Source of host log entry sequence numbers.
+_host_log_sequence = itertools.count(1)
+
+_UPDATE_STAGE_SECONDS = metrics.Histogram(
+    'devserver_update_stage_seconds',
+    'Time spent in each stage of handling update pings.', label='stage')
+
 
 class AutoupdateError(Exception):
   """Exception classes used by this module."""
@@ -45,65 +92,423 @@ def _ChangeUrlPort(url, new_port):
   else:
     host_port[1] = new_port
 
-  print host_port
   netloc = "%s:%s" % tuple(host_port)
 
   return urlparse.urlunsplit((scheme, netloc, path, query, fragment))
 
+def _RestartHostLogSequence(last_seq):
+  """Makes new host log entries get sequence numbers following last_seq."""
+  # pylint: disable=W0603
+  global _host_log_sequence
+  _host_log_sequence = itertools.count(last_seq + 1)
+
+
+def _GetHostId(client_ip):
+  """Returns the host info table key of a client address."""
+  # Strip any IPv6 data from the address for simplicity.
+  return client_ip.split(':')[-1]
+
+
+def _GetFileMd5Key(file_path, file_stat):
+  """Returns the key of a file in Autoupdate._file_md5s."""
+  return (os.path.realpath(file_path), file_stat.st_ino, file_stat.st_size,
+          file_stat.st_mtime)
+
+
 def _NonePathJoin(*args):
   """os.path.join that filters None's from the argument list."""
   return os.path.join(*filter(None, args))
 
 
+def _InternString(value):
+  """Returns a shared copy of a string reported by hosts.
+
+  Versions, boards and tracks are few and repeated across most hosts and log
+  entries, so only one copy of each is kept, up to a limit.
+  """
+  if (isinstance(value, basestring) and
+      len(_interned_strings) < MAX_INTERNED_STRINGS):
+    return _interned_strings.setdefault(value, value)
+  return value
+
+
+class HostLogEntry(object):
+  """A recorded host event.
+
+  Members:
+    seq:       sequence number of the event, increasing across all hosts.
+    timestamp: time the event was recorded, in seconds since the epoch.
+    Other members correspond to the attributes of the event and are None if
+    not reported.
+  """
+
+  _ATTRS = ('version', 'track', 'board', 'event_result', 'event_type',
+            'previous_version')
+  __slots__ = ('seq', 'timestamp') + _ATTRS
+
+  def __init__(self, seq, timestamp, **attrs):
+    self.seq = seq
+    self.timestamp = timestamp
+    for name in self._ATTRS:
+      setattr(self, name, _InternString(attrs.pop(name, None)))
+    assert not attrs, 'Unknown host log attributes %s' % attrs.keys()
+
+  def __repr__(self):
+    return '%s' % self.ToDict()
+
+  def GetAttrs(self):
+    """Returns a dictionary of all reported attributes."""
+    return dict((name, getattr(self, name)) for name in self._ATTRS
+                if getattr(self, name) is not None)
+
+  def ToDict(self):
+    """Returns a dictionary of the sequence number, timestamp and all reported
+    attributes."""
+    entry = self.GetAttrs()
+    entry['seq'] = self.seq
+    entry['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(self.timestamp))
+    return entry
+
+
 class HostInfo(object):
   """Records information about an individual host.
 
   Members:
-    attrs: Static attributes (legacy)
-    log: Complete log of recorded client entries
+    attrs: Static attributes (legacy); replaced rather than modified on update
+    log: Log of the most recent client entries
   """
 
-  def __init__(self):
+  __slots__ = ('attrs', 'log')
+
+  def __init__(self, max_log_entries=HOST_LOG_ENTRIES):
     # A dictionary of current attributes pertaining to the host.
     self.attrs = {}
 
-    # A list of pairs consisting of a timestamp and a dictionary of recorded
-    # attributes.
-    self.log = []
+    # The most recent HostLogEntry objects, oldest first.
+    self.log = collections.deque(maxlen=max_log_entries)
 
   def __repr__(self):
-    return 'attrs=%s, log=%s' % (self.attrs, self.log)
+    return 'attrs=%s, log=%s' % (self.attrs, list(self.log))
 
-  def AddLogEntry(self, entry):
-    """Append a new log entry."""
-    # Append a timestamp.
+  def AddLogEntry(self, entry, timestamp=None, seq=None):
+    """Append a new log entry, dropping the oldest one if the log is full.
+
+    Args:
+      entry: dictionary of event attributes.
+      timestamp: time of the event in seconds since the epoch; defaults to now.
+      seq: sequence number of the event; defaults to the next one.
+    Returns:
+      The new HostLogEntry.
+    """
     assert not 'timestamp' in entry, 'Oops, timestamp field already in use'
-    entry['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
-    # Add entry to hosts' message log.
-    self.log.append(entry)
+    if timestamp is None:
+      timestamp = int(time.time())
+    if seq is None:
+      seq = next(_host_log_sequence)
+    log_entry = HostLogEntry(seq, timestamp, **entry)
+    self.log.append(log_entry)
+    return log_entry
+
+  def GetLog(self):
+    """Returns the log as a list of dictionaries, oldest first."""
+    return [entry.ToDict() for entry in list(self.log)]
+
+
+class _HostInfoShard(object):
+  """A least recently active first table of hosts, with its lock.
+
+  Members:
+    hosts: dictionary of HostInfo objects, least recently active first.
+    evicted: number of hosts evicted from the shard so far.
+    lock: lock to hold while modifying the shard or its hosts.
+  """
+
+  __slots__ = ('hosts', 'evicted', 'lock')
+
+  def __init__(self):
+    self.hosts = collections.OrderedDict()
+    self.evicted = 0
+    self.lock = threading.Lock()
 
 
 class HostInfoTable(object):
   """Records information about a set of hosts who engage in update activity.
 
+  Hosts are spread over a number of shards, each with its own lock, so that
+  pings from different hosts rarely contend. The table is bounded in total:
+  once it is full, each new host makes the host that has been idle the longest
+  in the fullest shard be evicted.
+
+  Host attributes are copied on write: a host's attrs dictionary is never
+  modified once published, only replaced, so readers may use it without
+  locking. Updates must go through UpdateHostAttrs().
+
+  If a log store is given, the table is populated from it on creation, and log
+  entries added through AddLogEntry() are persisted to it.
+
+  Log entries are numbered, appended and persisted under one lock, so that
+  every entry up to GetLastLogSeq() is in its host's log.
+
   Members:
-    table: Table of information on hosts.
+    max_hosts: maximum number of hosts to keep information on.
+    max_log_entries: maximum number of log entries kept per host.
   """
 
-  def __init__(self):
-    # A dictionary of host information. Keys are normally IP addresses.
-    self.table = {}
+  def __init__(self, max_hosts=MAX_HOSTS, max_log_entries=HOST_LOG_ENTRIES,
+               log_store=None, num_shards=HOST_TABLE_SHARDS):
+    self.max_hosts = max_hosts
+    self.max_log_entries = max_log_entries
+    self._shards = [_HostInfoShard()
+                    for _ in range(max(1, min(num_shards, max_hosts)))]
+    # Number of hosts across all shards, guarded by its own lock, which may be
+    # taken while holding a shard's lock but not the other way around.
+    self._num_hosts = 0
+    self._num_hosts_lock = threading.Lock()
+
+    self._log_lock = threading.Lock()
+    self._last_log_seq = 0
+    self._log_store = log_store
+    if log_store:
+      # Replayed entries keep their sequence numbers, so that cursors handed
+      # out before a restart stay valid, and new entries follow them.
+      last_seq = 0
+      for host_id, seq, timestamp, attrs in log_store.Replay():
+        if seq is None:
+          seq = last_seq + 1
+        last_seq = max(last_seq, seq)
+        self.GetInitHostInfo(host_id).AddLogEntry(attrs, timestamp, seq)
+      _RestartHostLogSequence(last_seq)
+      self._last_log_seq = last_seq
+      _Log('Replayed host logs of %d hosts', len(self.GetHostInfos()))
 
   def __repr__(self):
-    return '%s' % self.table
+    return '%s' % dict(self.GetHostInfos())
+
+  def _GetShard(self, host_id):
+    return self._shards[hash(host_id) % len(self._shards)]
+
+  def _GetInitHostInfo(self, shard, host_id):
+    """Returns a host's info object in shard, creating it if needed.
+
+    The host is marked as the most recently active one. Must be called with
+    the shard's lock held, and followed by _EvictHosts() once it is released.
+    """
+    host_info = shard.hosts.pop(host_id, None)
+    if host_info is None:
+      host_info = HostInfo(self.max_log_entries)
+      with self._num_hosts_lock:
+        self._num_hosts += 1
+    shard.hosts[host_id] = host_info
+    return host_info
+
+  def _EvictHosts(self):
+    """Evicts hosts until the table is within its bound.
+
+    Hosts are evicted from the fullest shard, which is taken to hold the host
+    idle the longest, since hosts are spread evenly. Must be called without
+    holding any shard's lock.
+    """
+    while True:
+      with self._num_hosts_lock:
+        if self._num_hosts <= self.max_hosts:
+          return
+        self._num_hosts -= 1
+      # A host is left to evict, though others may be racing for it.
+      while True:
+        shard = max(self._shards, key=lambda other: len(other.hosts))
+        with shard.lock:
+          if shard.hosts:
+            shard.hosts.popitem(last=False)
+            shard.evicted += 1
+            break
 
   def GetInitHostInfo(self, host_id):
-    """Return a host's info object, or create a new one if none exists."""
-    return self.table.setdefault(host_id, HostInfo())
+    """Return a host's info object, or create a new one if none exists.
+
+    The host is marked as the most recently active one.
+    """
+    shard = self._GetShard(host_id)
+    with shard.lock:
+      host_info = self._GetInitHostInfo(shard, host_id)
+    self._EvictHosts()
+    return host_info
 
   def GetHostInfo(self, host_id):
     """Return an info object for given host, if such exists."""
-    return self.table.get(host_id)
+    # Hosts are briefly removed from their shard while being marked active.
+    shard = self._GetShard(host_id)
+    with shard.lock:
+      return shard.hosts.get(host_id)
+
+  def UpdateHostAttrs(self, host_id, attrs, pop_attr=None):
+    """Atomically updates a host's attributes, creating the host if needed.
+
+    Args:
+      host_id: the host to update.
+      attrs: dictionary of attributes to set.
+      pop_attr: name of an attribute to remove, if any.
+    Returns:
+      The previous value of pop_attr, or None.
+    """
+    shard = self._GetShard(host_id)
+    with shard.lock:
+      host_info = self._GetInitHostInfo(shard, host_id)
+      new_attrs = dict(host_info.attrs)
+      new_attrs.update(attrs)
+      popped = new_attrs.pop(pop_attr, None) if pop_attr else None
+      host_info.attrs = new_attrs
+    self._EvictHosts()
+    return popped
+
+  def AddLogEntry(self, host_id, entry):
+    """Appends a log entry to a host's log, persisting it if so configured.
+
+    Args:
+      host_id: the host the event is from.
+      entry: dictionary of event attributes.
+    """
+    shard = self._GetShard(host_id)
+    with self._log_lock:
+      with shard.lock:
+        host_info = self._GetInitHostInfo(shard, host_id)
+        log_entry = host_info.AddLogEntry(entry)
+      self._last_log_seq = log_entry.seq
+      if self._log_store:
+        self._log_store.Append(host_id, log_entry.seq, log_entry.timestamp,
+                               log_entry.GetAttrs())
+    self._EvictHosts()
+
+  def GetLastLogSeq(self):
+    """Returns the sequence number of the last log entry added, or 0."""
+    with self._log_lock:
+      return self._last_log_seq
+
+  def Close(self):
+    """Writes out pending log entries and closes the log store, if any."""
+    if self._log_store:
+      self._log_store.Close()
+
+  def GetHostInfos(self):
+    """Returns a list of (host_id, info object) pairs for all hosts.
+
+    Within each shard, hosts are listed least recently active first.
+    """
+    host_infos = []
+    for shard in self._shards:
+      with shard.lock:
+        host_infos.extend(shard.hosts.iteritems())
+    return host_infos
+
+  def GetHostIds(self):
+    """Returns the ids of all hosts, in the order of GetHostInfos()."""
+    return [host_id for host_id, _ in self.GetHostInfos()]
+
+  def _GetHostInfos(self, host_ids):
+    """Returns (host_id, info object) pairs for the known hosts of host_ids.
+
+    All hosts are returned if host_ids is None.
+    """
+    if host_ids is None:
+      return self.GetHostInfos()
+    host_infos = []
+    for host_id in host_ids:
+      host_info = self.GetHostInfo(host_id)
+      if host_info:
+        host_infos.append((host_id, host_info))
+    return host_infos
+
+  @staticmethod
+  def _SelectLogEntries(host_info, since, cursor, last=None):
+    """Yields the entries of a host's log matching the given filters.
+
+    Args:
+      host_info: HostInfo whose log to select entries from.
+      since: if set, only select entries recorded at or after this time.
+      cursor: if set, only select entries with a greater sequence number.
+      last: if set, only select entries with at most this sequence number.
+    """
+    for entry in list(host_info.log):
+      if ((since is None or entry.timestamp >= since) and
+          (cursor is None or entry.seq > cursor) and
+          (last is None or entry.seq <= last)):
+        yield entry
+
+  def GetLastSelectedLogSeq(self, host_ids, since, limit, cursor, last):
+    """Returns the sequence number of the last of the oldest matching entries.
+
+    The logs of the hosts are merged lazily in sequence order, up to limit
+    entries, so that they are never collected at once.
+
+    Args:
+      host_ids: hosts to select entries from, or None for all hosts.
+      since: if set, only select entries recorded at or after this time.
+      limit: if set, select at most this many entries.
+      cursor: if set, only select entries with a greater sequence number.
+      last: only select entries with at most this sequence number.
+    Returns:
+      The sequence number, or None if no entry matches.
+    """
+    merged = heapq.merge(*[
+        (entry.seq for entry in self._SelectLogEntries(host_info, since,
+                                                       cursor, last))
+        for _, host_info in self._GetHostInfos(host_ids)])
+    last = None
+    for last in itertools.islice(merged, limit):
+      pass
+    return last
+
+  def GetHostLogs(self, host_ids, since, cursor, last):
+    """Returns the matching log entries of hosts, as dictionaries.
+
+    Args:
+      host_ids: hosts whose logs to select entries from.
+      since: if set, only select entries recorded at or after this time.
+      cursor: if set, only select entries with a greater sequence number.
+      last: if set, only select entries with at most this sequence number.
+    Returns:
+      A list of (host_id, list of entry dictionaries) pairs, for the hosts
+      with matching entries, in the order of host_ids.
+    """
+    host_logs = []
+    for host_id, host_info in self._GetHostInfos(host_ids):
+      entries = [entry.ToDict() for entry in
+                 self._SelectLogEntries(host_info, since, cursor, last)]
+      if entries:
+        host_logs.append((host_id, entries))
+    return host_logs
+
+  def GetAttrCounts(self, name):
+    """Returns a dictionary counting hosts by their value of attribute name.
+
+    Hosts without the attribute aren't counted.
+    """
+    counts = collections.Counter(host_info.attrs.get(name)
+                                 for _, host_info in self.GetHostInfos())
+    counts.pop(None, None)
+    return dict(counts)
+
+  def GetStats(self):
+    """Returns a dictionary describing the size of the table.
+
+    Memory usage is an estimate of the bytes taken by the table, host info
+    objects, their attributes and logs; strings shared among hosts are not
+    counted.
+    """
+    host_infos = self.GetHostInfos()
+    log_entries = sum(len(host_info.log) for _, host_info in host_infos)
+    memory_bytes = sum(sys.getsizeof(shard.hosts) for shard in self._shards)
+    memory_bytes += sum(
+        sys.getsizeof(host_info) + sys.getsizeof(host_info.attrs) +
+        sys.getsizeof(host_info.log) +
+        sum(sys.getsizeof(entry) for entry in list(host_info.log))
+        for _, host_info in host_infos)
+    return {'hosts': len(host_infos),
+            'max_hosts': self.max_hosts,
+            'evicted_hosts': sum(shard.evicted for shard in self._shards),
+            'log_entries': log_entries,
+            'max_log_entries_per_host': self.max_log_entries,
+            'memory_bytes': memory_bytes}
 
 
 class UpdateMetadata(object):
@@ -116,6 +521,72 @@ class UpdateMetadata(object):
     self.is_delta_format = is_delta_format
 
 
+class PayloadMetadataCache(object):
+  """A thread-safe LRU cache of update payload metadata.
+
+  Entries are indexed by payload path and validated against the inode, mtime
+  and size of the payload, so a payload that is regenerated or replaced is
+  never answered from a stale entry.
+
+  Members:
+    max_entries: maximum number of payloads to keep metadata for.
+    hits:        number of lookups answered from the cache.
+    misses:      number of lookups that were not.
+  """
+
+  def __init__(self, max_entries=METADATA_CACHE_ENTRIES):
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    # Maps a payload path to a pair of its stat key and metadata object, least
+    # recently used first.
+    self._entries = collections.OrderedDict()
+
+  @staticmethod
+  def _GetStatKey(file_stat):
+    """Returns the part of a stat result that identifies a file's content."""
+    return (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+
+  def Get(self, filename, file_stat):
+    """Returns cached metadata for filename if still valid, None otherwise."""
+    stat_key = self._GetStatKey(file_stat)
+    with self._lock:
+      entry = self._entries.pop(filename, None)
+      if entry and entry[0] == stat_key:
+        self._entries[filename] = entry
+        self.hits += 1
+        return entry[1]
+
+      self.misses += 1
+      return None
+
+  def Peek(self, filename, file_stat):
+    """Like Get(), but neither counted as a hit or miss nor marked as used."""
+    stat_key = self._GetStatKey(file_stat)
+    with self._lock:
+      entry = self._entries.get(filename)
+    if entry and entry[0] == stat_key:
+      return entry[1]
+    return None
+
+  def Put(self, filename, file_stat, metadata_obj):
+    """Stores metadata for filename, evicting the least recently used."""
+    with self._lock:
+      self._entries.pop(filename, None)
+      self._entries[filename] = (self._GetStatKey(file_stat), metadata_obj)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def GetStats(self):
+    """Returns a dictionary of cache size and hit/miss counters."""
+    with self._lock:
+      return {'entries': len(self._entries),
+              'max_entries': self.max_entries,
+              'hits': self.hits,
+              'misses': self.misses}
+
+
 class Autoupdate(object):
   """Class that contains functionality that handles Chrome OS update pings.
 
@@ -136,7 +607,22 @@ class Autoupdate(object):
     critical_update:  whether provisioned payload is critical.
     remote_payload:   whether provisioned payload is remotely staged.
     max_updates:      maximum number of updates we'll try to provision.
-    host_log:         record full history of host update events.
+    host_log:         record history of host update events.
+    max_hosts:        maximum number of hosts to keep information on.
+    host_log_entries: maximum number of events to record per host.
+    hash_index:       optional hash_index.HashIndex used to avoid rehashing
+                      unchanged images and payloads.
+    payload_scheduler:  optional payload_jobs.PayloadJobScheduler; if given,
+                        payloads are generated in the background and update
+                        checks get no update until theirs is ready.
+    delta_sources:    number of client versions, most reported by hosts
+                      first, to pre-generate delta payloads from; see
+                      PreGenerateDeltas().
+    image_catalog:    optional image_catalog.ImageCatalog to find the latest
+                      image of a board with, rather than get_latest_image.sh.
+    payload_cache:    optional payload_cache.PayloadCache managing
+                      static_dir/cache; if given, its entries are protected
+                      from eviction while generated or copied.
   """
 
   _PAYLOAD_URL_PREFIX = '/static/'
@@ -153,7 +639,10 @@ class Autoupdate(object):
                copy_to_static_root=True, private_key=None,
                critical_update=False, remote_payload=False, max_updates= -1,
                host_log=False, devserver_dir=None, scripts_dir=None,
-               static_dir=None):
+               static_dir=None, hash_index=None, payload_scheduler=None,
+               max_hosts=MAX_HOSTS, host_log_entries=HOST_LOG_ENTRIES,
+               host_log_store=None, delta_sources=0, payload_cache=None,
+               image_catalog=None):
     self.devserver_dir = devserver_dir,
     self.scripts_dir = scripts_dir
     self.static_dir = static_dir
@@ -176,25 +665,71 @@ class Autoupdate(object):
     self.remote_payload = remote_payload
     self.max_updates = max_updates
     self.host_log = host_log
+    self.hash_index = hash_index
+    self.payload_scheduler = payload_scheduler
+    self.delta_sources = delta_sources
+    self.payload_cache = payload_cache
+    self.image_catalog = image_catalog
 
     # Path to pre-generated file.
     self.pregenerated_path = None
 
+    # Metadata of the --payload file, by the directory and legacy flag it was
+    # registered for; see RegisterPayload().
+    self._registered_payloads = {}
+
     # Initialize empty host info cache. Used to keep track of various bits of
     # information about a given host.  A host is identified by its IP address.
-    # The info stored for each host includes a complete log of events for this
+    # The info stored for each host includes a log of recent events for this
     # host, as well as a dictionary of current attributes derived from events.
-    self.host_infos = HostInfoTable()
+    # Logs are replayed from, and persisted to, host_log_store if given.
+    self.host_infos = HostInfoTable(max_hosts, host_log_entries,
+                                    host_log_store)
+
+    # In-memory cache of local payload metadata, so that update checks for an
+    # unchanged payload don't need to touch the disk beyond a stat.
+    self.payload_metadata_cache = PayloadMetadataCache()
+
+    # Locks serializing the generation of each cached payload.
+    self._cache_lock_dict = common_util.LockDict()
+
+    # MD5s of files hashed so far, by path and stat, so that the cache dirs
+    # of their payloads can be found without hashing them again.
+    self._file_md5s = {}
+
+    # Attributes of remote payloads, so that update checks don't each make
+    # the remote devserver look its payload up.
+    self.remote_payload_cache = remote_fileinfo.RemoteFileInfoCache(
+        self._ParseMetadata)
+
+    # Static URL bases by the base URL the devserver was reached at, which
+    # clients rarely vary.
+    self._static_urls = {}
+
+    # Pre-generated delta payloads by client version, as (target image, cache
+    # sub dir) pairs; replaced as a whole by PreGenerateDeltas().
+    self._delta_routes = {}
+
+    # Catalog of the images next to the latest image, when the latest image
+    # isn't found through self.image_catalog.
+    self._source_catalog = None
 
   @classmethod
   def _ReadMetadataFromStream(cls, stream):
     """Returns metadata obj from input json stream that implements .read()."""
-    file_attr_dict = {}
     try:
-      file_attr_dict = json.loads(stream.read())
+      return cls._ParseMetadata(stream.read())
     except IOError:
       return None
 
+  @classmethod
+  def _ParseMetadata(cls, data):
+    """Returns metadata obj from a json string.
+
+    Raises:
+      ValueError if data is not valid json.
+    """
+    file_attr_dict = json.loads(data)
     sha1 = file_attr_dict.get(cls.SHA1_ATTR)
     sha256 = file_attr_dict.get(cls.SHA256_ATTR)
     size = file_attr_dict.get(cls.SIZE_ATTR)
@@ -223,8 +758,103 @@ class Autoupdate(object):
       metadata_file = os.path.join(payload_dir, METADATA_FILE)
     else:
       metadata_file = os.path.join(payload_dir, KERNEL_METADATA_FILE)
-    with open(metadata_file, 'w') as file_handle:
+    # Write to a temporary file first so readers never see a partial file.
+    fd, temp_file = tempfile.mkstemp(
+        prefix='.' + os.path.basename(metadata_file), dir=payload_dir)
+    os.fchmod(fd, 0644)
+    with os.fdopen(fd, 'w') as file_handle:
       json.dump(file_dict, file_handle)
+    os.rename(temp_file, metadata_file)
+
+  def GetFileMd5(self, file_path):
+    """Returns the MD5 checksum of a file (hex encoded)."""
+    try:
+      file_stat = os.stat(file_path)
+    except OSError:
+      file_stat = None
+    if self.hash_index:
+      md5 = self.hash_index.GetFileMd5(file_path)
+    else:
+      md5 = common_util.GetFileMd5(file_path)
+    if file_stat:
+      if len(self._file_md5s) >= FILE_MD5_ENTRIES:
+        self._file_md5s.clear()
+      self._file_md5s[_GetFileMd5Key(file_path, file_stat)] = md5
+    return md5
+
+  def _GetKnownFileMd5(self, file_path):
+    """Returns the MD5 of a file if known without reading it, or None."""
+    try:
+      file_stat = os.stat(file_path)
+    except OSError:
+      return None
+    md5 = self._file_md5s.get(_GetFileMd5Key(file_path, file_stat))
+    if not md5 and self.hash_index:
+      hashes = self.hash_index.LookupFileHashes(file_path, file_stat)
+      if hashes:
+        md5 = binascii.hexlify(hashes['md5'])
+    return md5
+
+  def GetFileSha1AndSha256(self, file_path):
+    """Returns the SHA1 and SHA256 checksums of a file (base64 encoded)."""
+    if self.hash_index:
+      return self.hash_index.GetFileSha1AndSha256(file_path)
+    return common_util.GetFileSha1AndSha256(file_path)
+
+  def GetPayloadETag(self, file_path, file_stat):
+    """Returns the hex SHA256 of a file if already known, None otherwise.
+
+    The payload metadata cache, the hash index and, for payloads, a metadata
+    file no older than the payload are consulted, so that the tag survives
+    restarts; the file itself is never read. Lookups aren't counted in the
+    cache statistics.
+    """
+    # Payloads are cached by their path under the real static directory.
+    file_path = os.path.realpath(file_path)
+    metadata_obj = self.payload_metadata_cache.Peek(file_path, file_stat)
+    if not metadata_obj:
+      metadata_obj = self._ReadPayloadMetadataFile(file_path, file_stat)
+    if metadata_obj:
+      return binascii.hexlify(base64.b64decode(metadata_obj.sha256))
+    if self.hash_index:
+      hashes = self.hash_index.LookupFileHashes(file_path, file_stat)
+      if hashes:
+        return binascii.hexlify(hashes['sha256'])
+    return None
+
+  @staticmethod
+  def _ReadPayloadMetadataFile(file_path, file_stat):
+    """Returns the metadata stored next to a payload, if still current."""
+    metadata_files = {UPDATE_FILE: METADATA_FILE,
+                      KERNEL_UPDATE_FILE: KERNEL_METADATA_FILE}
+    payload_dir, name = os.path.split(file_path)
+    if name not in metadata_files:
+      return None
+    metadata_file = os.path.join(payload_dir, metadata_files[name])
+    try:
+      if os.stat(metadata_file).st_mtime < file_stat.st_mtime:
+        return None
+      metadata_obj = Autoupdate._ReadMetadataFromFile(payload_dir,
+                                                      name == UPDATE_FILE)
+    except (IOError, OSError, ValueError):
+      return None
+    if metadata_obj and metadata_obj.sha256:
+      return metadata_obj
+    return None
+
+  def _PublishFile(self, source, dest):
+    """Publishes a cached file to dest, unless dest already holds its contents.
+
+    Contents are only compared by hashes the hash index already has, so that
+    neither file is read.
+    """
+    if self.hash_index and os.path.exists(dest):
+      source_hashes = self.hash_index.LookupFileHashes(source, os.stat(source))
+      if (source_hashes and
+          source_hashes == self.hash_index.LookupFileHashes(dest,
+                                                            os.stat(dest))):
+        return
+    common_util.PublishFile(source, dest)
 
   def _GetLatestImageDir(self, board):
     """Returns the latest image dir based on shell script."""
@@ -234,12 +864,27 @@ class Autoupdate(object):
   @staticmethod
   def _GetVersionFromDir(image_dir):
     """Returns the version of the image based on version.txt."""
-    with open('%s/version.txt' % image_dir, 'r') as ver_file:
-      for line in ver_file:
-        key, _, value = line.partition('=')
-        if key == 'COREOS_VERSION':
-          return value.strip('"\'\t ')
-    raise AutoupdateError('Failed to parse version.txt in %s' % image_dir)
+    version = image_catalog.ReadVersion(image_dir)
+    if not version:
+      raise AutoupdateError('Failed to parse version.txt in %s' % image_dir)
+    return version
+
+  def _GetLatestImage(self, board):
+    """Returns the directory and version of the latest image for board.
+
+    Raises:
+      AutoupdateError if there is no such image.
+    """
+    if self.image_catalog:
+      latest_image = self.image_catalog.GetLatestImage(board)
+      if not latest_image:
+        raise AutoupdateError('No image found for board %s' % board)
+      return latest_image
+
+    latest_image_dir = self._GetLatestImageDir(board)
+    if not latest_image_dir:
+      raise AutoupdateError('No image found for board %s' % board)
+    return latest_image_dir, self._GetVersionFromDir(latest_image_dir)
 
   @staticmethod
   def _CanUpdate(client_version, latest_version):
@@ -289,10 +934,17 @@ class Autoupdate(object):
       update_path = os.path.join(output_dir, KERNEL_UPDATE_FILE)
     _Log('Generating update image %s', update_path)
 
+    # Generate the payload under a temporary name and rename it into place
+    # once complete, so that a partially written payload is never served.
+    fd, temp_path = tempfile.mkstemp(
+        prefix='.' + os.path.basename(update_path), dir=output_dir)
+    os.fchmod(fd, 0644)
+    os.close(fd)
+
     update_command = [
         'cros_generate_update_payload',
         '--image', image_path,
-        '--output', update_path,
+        '--output', temp_path,
     ]
 
     if not legacy_image:
@@ -305,14 +957,24 @@ class Autoupdate(object):
       update_command.extend(['--private_key', self.private_key])
 
     _Log('Running %s', ' '.join(update_command))
-    subprocess.check_call(update_command)
-
-  def FindCachedUpdateImageSubDir(self, src_image, dest_image):
+    try:
+      subprocess.check_call(update_command)
+      os.rename(temp_path, update_path)
+    finally:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  def FindCachedUpdateImageSubDir(self, src_image, dest_image,
+                                  hash_files=True):
     """Find directory to store a cached update.
 
     Given one, or two images for an update, this finds which cache directory
     should hold the update files, even if they don't exist yet.
 
+    Args:
+      src_image: source image of a delta update, or None.
+      dest_image: image to update to.
+      hash_files: whether to hash files whose MD5 isn't known yet.
     Returns:
       A directory path for storing a cached update, of the following form:
         Non-delta updates:
@@ -321,32 +983,44 @@ class Autoupdate(object):
           CACHE_DIR/<src_hash>_<dest_hash>
         Signed updates (self.private_key):
           CACHE_DIR/<src_hash>_<dest_hash>+<private_key_hash>
+      or None if hash_files is false and a file would have to be hashed.
     """
+    get_md5 = self.GetFileMd5 if hash_files else self._GetKnownFileMd5
+    md5s = [get_md5(path) if path else ''
+            for path in (src_image, dest_image, self.private_key)]
+    if None in md5s:
+      return None
+    src_md5, dest_md5, key_md5 = md5s
+
     update_dir = ''
-    if src_image:
-      update_dir += common_util.GetFileMd5(src_image) + '_'
+    if src_md5:
+      update_dir += src_md5 + '_'
 
-    update_dir += common_util.GetFileMd5(dest_image)
-    if self.private_key:
-      update_dir += '+' + common_util.GetFileMd5(self.private_key)
+    update_dir += dest_md5
+    if key_md5:
+      update_dir += '+' + key_md5
 
     if not self.vm:
       update_dir += '+patched_kernel'
 
     return os.path.join(CACHE_DIR, update_dir)
 
-  def GenerateUpdateImage(self, image_path, output_dir, legacy_image):
+  def GenerateUpdateImage(self, image_path, output_dir, legacy_image,
+                          src_image=None):
     """Force generates an update payload based on the given image_path.
 
     Args:
-      src_image: image we are updating from (Null/empty for non-delta)
       image_path: full path to the image.
       output_dir: the directory to write the update payloads to
+      src_image: image we are updating from (empty for non-delta); defaults
+                 to self.src_image.
     Raises:
       AutoupdateError if it failed to generate either update or stateful
         payload.
     """
     _Log('Generating update for image %s', image_path)
+    if src_image is None:
+      src_image = self.src_image
 
     try:
       os.makedirs(output_dir)
@@ -355,12 +1029,86 @@ class Autoupdate(object):
         pass
 
     try:
-      self.GenerateUpdateFile(self.src_image, image_path, output_dir,
+      self.GenerateUpdateFile(src_image, image_path, output_dir,
                               legacy_image)
     except subprocess.CalledProcessError:
-      os.system('rm -rf "%s"' % output_dir)
       raise AutoupdateError('Failed to generate update in %s' % output_dir)
 
+  def _GetCacheEntryName(self, cache_dir):
+    """Returns the name of cache_dir in self.payload_cache, if it's managed."""
+    if self.payload_cache and (
+        os.path.normpath(os.path.dirname(cache_dir)) ==
+        os.path.normpath(os.path.join(self.static_dir, CACHE_DIR))):
+      return os.path.basename(cache_dir)
+    return None
+
+  def _AcquireCacheEntry(self, cache_dir):
+    """Protects cache_dir from eviction; returns what to pass to release it."""
+    entry_name = self._GetCacheEntryName(cache_dir)
+    if entry_name:
+      self.payload_cache.Acquire(entry_name)
+    return entry_name
+
+  def _ReleaseCacheEntry(self, entry_name):
+    if entry_name:
+      self.payload_cache.Release(entry_name)
+
+  def _GenerateCachedUpdateImage(self, image_path, cache_dir, legacy_image,
+                                 src_image=None):
+    """Generates a payload and its metadata in cache_dir, unless present.
+
+    Only one thread of one process generates a given payload; any others
+    asking for it in the meantime wait for it to be published. The payload is
+    generated in a temporary directory and only then moved to cache_dir, so
+    that generation interrupted by a crash leaves nothing behind to be served.
+    """
+    if legacy_image:
+      cache_update_payload = os.path.join(cache_dir, UPDATE_FILE)
+    else:
+      cache_update_payload = os.path.join(cache_dir, KERNEL_UPDATE_FILE)
+
+    entry_name = self._AcquireCacheEntry(cache_dir)
+    try:
+      # Other worker processes may be generating the same payload.
+      with self._cache_lock_dict.lock(cache_update_payload), \
+          payload_cache.LockDir(cache_dir):
+        # Check to see if this cache directory is valid.
+        if not os.path.exists(cache_update_payload):
+          temp_dir = payload_cache.MakeTempDir(cache_dir)
+          try:
+            self.GenerateUpdateImage(image_path, temp_dir, legacy_image,
+                                     src_image)
+            if entry_name:
+              self.payload_cache.Publish(entry_name, temp_dir)
+            else:
+              payload_cache.PublishDir(temp_dir, cache_dir)
+          finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        # Generate the cache file.
+        self.GetLocalPayloadAttrs(cache_dir, legacy_image)
+    finally:
+      self._ReleaseCacheEntry(entry_name)
+
+  def _SubmitCachedUpdateImage(self, image_path, static_image_dir,
+                               legacy_image):
+    """Hashes the images of a payload, then schedules its generation.
+
+    Run by the payload scheduler, so that update checks never wait for the
+    images to be hashed.
+    """
+    full_cache_dir = os.path.join(
+        static_image_dir,
+        self.FindCachedUpdateImageSubDir(self.src_image, image_path))
+    if legacy_image:
+      cache_update_payload = os.path.join(full_cache_dir, UPDATE_FILE)
+    else:
+      cache_update_payload = os.path.join(full_cache_dir, KERNEL_UPDATE_FILE)
+    if not os.path.exists(cache_update_payload):
+      self.payload_scheduler.Submit(
+          cache_update_payload, self._GenerateCachedUpdateImage, image_path,
+          full_cache_dir, legacy_image)
+
   def GenerateUpdateImageWithCache(self, image_path, static_image_dir,
                                    legacy_image):
     """Force generates an update payload based on the given image_path.
@@ -377,7 +1125,20 @@ class Autoupdate(object):
     _Log('Generating update for src %s image %s', self.src_image, image_path)
 
     # Which sub_dir of static_image_dir should hold our cached update image
-    cache_sub_dir = self.FindCachedUpdateImageSubDir(self.src_image, image_path)
+    if self.payload_scheduler:
+      # Hashing the images could take minutes; until they are hashed, leave
+      # that to the background workers too.
+      cache_sub_dir = self.FindCachedUpdateImageSubDir(
+          self.src_image, image_path, hash_files=False)
+      if not cache_sub_dir:
+        self.payload_scheduler.Submit(
+            image_path + ':hash', self._SubmitCachedUpdateImage, image_path,
+            static_image_dir, legacy_image)
+        raise AutoupdateError('Update payload for %s is not ready yet' %
+                              image_path)
+    else:
+      cache_sub_dir = self.FindCachedUpdateImageSubDir(self.src_image,
+                                                       image_path)
     _Log('Caching in sub_dir "%s"', cache_sub_dir)
 
     # The cached payloads exist in a cache dir
@@ -389,37 +1150,50 @@ class Autoupdate(object):
                                           cache_sub_dir, KERNEL_UPDATE_FILE)
 
     full_cache_dir = os.path.join(static_image_dir, cache_sub_dir)
-    # Check to see if this cache directory is valid.
-    if not os.path.exists(cache_update_payload):
-      self.GenerateUpdateImage(image_path, full_cache_dir, legacy_image)
-
-    # Generate the cache file.
-    self.GetLocalPayloadAttrs(full_cache_dir, legacy_image)
-    if legacy_image:
-      cache_metadata_file = os.path.join(full_cache_dir, METADATA_FILE)
-    else:
-      cache_metadata_file = os.path.join(full_cache_dir, KERNEL_METADATA_FILE)
-
-    # Generation complete, copy if requested.
-    if self.copy_to_static_root:
-      # The final results exist directly in static
+    if self.payload_scheduler:
+      # Leave generation to the background workers, and have the client check
+      # back later rather than holding up this request.
+      job = self.payload_scheduler.GetJob(cache_update_payload)
+      if (job and job.IsActive()) or not os.path.exists(cache_update_payload):
+        self.payload_scheduler.Submit(
+            cache_update_payload, self._GenerateCachedUpdateImage,
+            image_path, full_cache_dir, legacy_image)
+        raise AutoupdateError('Update payload %s is not ready yet' %
+                              cache_update_payload)
+
+    # Keep the payload from being evicted until it's copied, if need be.
+    entry_name = self._AcquireCacheEntry(full_cache_dir)
+    try:
+      self._GenerateCachedUpdateImage(image_path, full_cache_dir,
+                                      legacy_image)
       if legacy_image:
-        update_payload = os.path.join(static_image_dir,
-                                      UPDATE_FILE)
-        metadata_file = os.path.join(static_image_dir, METADATA_FILE)
+        cache_metadata_file = os.path.join(full_cache_dir, METADATA_FILE)
       else:
-        update_payload = os.path.join(static_image_dir,
-                                      KERNEL_UPDATE_FILE)
-        metadata_file = os.path.join(static_image_dir, KERNEL_METADATA_FILE)
+        cache_metadata_file = os.path.join(full_cache_dir,
+                                           KERNEL_METADATA_FILE)
 
-      common_util.CopyFile(cache_update_payload, update_payload)
-      common_util.CopyFile(cache_metadata_file, metadata_file)
-      return None
-    else:
-      return cache_sub_dir
+      # Generation complete, copy if requested.
+      if self.copy_to_static_root:
+        # The final results exist directly in static
+        if legacy_image:
+          update_payload = os.path.join(static_image_dir,
+                                        UPDATE_FILE)
+          metadata_file = os.path.join(static_image_dir, METADATA_FILE)
+        else:
+          update_payload = os.path.join(static_image_dir,
+                                        KERNEL_UPDATE_FILE)
+          metadata_file = os.path.join(static_image_dir, KERNEL_METADATA_FILE)
+
+        self._PublishFile(cache_update_payload, update_payload)
+        self._PublishFile(cache_metadata_file, metadata_file)
+        return None
+      else:
+        return cache_sub_dir
+    finally:
+      self._ReleaseCacheEntry(entry_name)
 
   def GenerateLatestUpdateImage(self, board, client_version,
-                                static_image_dir, legacy_image):
+                                static_image_dir, legacy_image, host_id=None):
     """Generates an update using the latest image that has been built.
 
     This will only generate an update if the newest update is newer than that
@@ -429,6 +1203,7 @@ class Autoupdate(object):
       board: Name of the board.
       client_version: Current version of the client or 'ForcedUpdate'
       static_image_dir: the directory to move images to after generating.
+      host_id: the requesting host, if known.
     Returns:
       Name of the update directory relative to the static dir. None if it should
         serve from the static_image_dir.
@@ -436,8 +1211,7 @@ class Autoupdate(object):
       AutoupdateError if it failed to generate the payload or can't update
         the given client_version.
     """
-    latest_image_dir = self._GetLatestImageDir(board)
-    latest_version = self._GetVersionFromDir(latest_image_dir)
+    latest_image_dir, latest_version = self._GetLatestImage(board)
     latest_image_path = os.path.join(latest_image_dir, self._GetImageName())
 
      # Check to see whether or not we should update.
@@ -446,14 +1220,23 @@ class Autoupdate(object):
       raise AutoupdateError('Update check received but no update available '
                             'for client')
 
+    delta_sub_dir = self._GetPreGeneratedDelta(
+        client_version, latest_image_path, static_image_dir, legacy_image,
+        host_id)
+    if delta_sub_dir:
+      _Log('Serving pre-generated delta payload from %s', delta_sub_dir)
+      return delta_sub_dir
+
     return self.GenerateUpdateImageWithCache(latest_image_path,
                                              static_image_dir=static_image_dir,
                                              legacy_image=legacy_image)
 
   def GenerateUpdatePayload(self, board, client_version, static_image_dir,
-                            legacy_image):
+                            legacy_image, host_id=None):
     """Generates an update for an image and returns the relative payload dir.
 
+    Args:
+      host_id: the requesting host, if known.
     Returns:
       payload dir relative to static_image_dir. None if it should
       serve from the static_image_dir.
@@ -466,13 +1249,7 @@ class Autoupdate(object):
       dest_path = os.path.join(static_image_dir, KERNEL_UPDATE_FILE)
 
     if self.payload_path:
-      # If the forced payload is not already in our static_image_dir,
-      # copy it there.
-      src_path = os.path.abspath(self.payload_path)
-      # Only copy the files if the source directory is different from dest.
-      if os.path.dirname(src_path) != os.path.abspath(static_image_dir):
-        common_util.CopyFile(src_path, dest_path)
-
+      self.RegisterPayload(static_image_dir, legacy_image)
       # Serve from the main directory so rel_path is None.
       return None
     elif self.forced_image:
@@ -487,7 +1264,44 @@ class Autoupdate(object):
           'You must set --board when pre-generating latest update.')
 
       return self.GenerateLatestUpdateImage(board, client_version,
-                                            static_image_dir, legacy_image)
+                                            static_image_dir, legacy_image,
+                                            host_id=host_id)
+
+  def RegisterPayload(self, static_image_dir, legacy_image):
+    """Places the forced payload in static_image_dir, once, if not there yet.
+
+    The payload is linked (or copied) and its metadata computed on the first
+    call for a given directory; later calls return the recorded metadata
+    without touching the disk. A payload replaced on disk after that is only
+    noticed once the devserver restarts.
+
+    Returns:
+      The UpdateMetadata of the payload.
+    Raises:
+      AutoupdateError if the payload can't be placed.
+    """
+    key = (os.path.abspath(static_image_dir), legacy_image)
+    metadata_obj = self._registered_payloads.get(key)
+    if metadata_obj:
+      return metadata_obj
+
+    with self._cache_lock_dict.lock(key):
+      metadata_obj = self._registered_payloads.get(key)
+      if not metadata_obj:
+        if legacy_image:
+          dest_path = os.path.join(static_image_dir, UPDATE_FILE)
+        else:
+          dest_path = os.path.join(static_image_dir, KERNEL_UPDATE_FILE)
+        try:
+          common_util.PublishFile(os.path.abspath(self.payload_path),
+                                  dest_path)
+        except (IOError, OSError) as e:
+          raise AutoupdateError('Failed to place payload %s in %s: %s' %
+                                (self.payload_path, static_image_dir, e))
+        metadata_obj = self.GetLocalPayloadAttrs(static_image_dir,
+                                                 legacy_image)
+        self._registered_payloads[key] = metadata_obj
+    return metadata_obj
 
   def PreGenerateUpdate(self):
     """Pre-generates an update and prints out the relative path it.
@@ -505,6 +1319,125 @@ class Autoupdate(object):
                                                    UPDATE_FILE)
     return pregenerated_update
 
+  def _GetSourceImages(self, latest_image_dir):
+    """Returns the images of the board next to its latest image.
+
+    Images are looked up in self.image_catalog, or, if the latest image was
+    found by get_latest_image.sh, in a catalog of the directory holding it.
+
+    Returns:
+      A dictionary mapping image versions to image paths.
+    """
+    if self.image_catalog:
+      image_dirs = self.image_catalog.GetImages(self.board)
+    else:
+      images_root, board = os.path.split(os.path.dirname(latest_image_dir))
+      if (not self._source_catalog or
+          self._source_catalog.images_root != images_root):
+        self._source_catalog = image_catalog.ImageCatalog(images_root)
+      image_dirs = self._source_catalog.GetImages(board)
+
+    images = {}
+    for image_dir, version in sorted(image_dirs.iteritems()):
+      image_path = os.path.join(image_dir, self._GetImageName())
+      if os.path.exists(image_path):
+        images[version] = image_path
+    return images
+
+  def GetDemandedVersions(self):
+    """Returns versions last reported by known hosts, most common first.
+
+    Returns:
+      A list of (version, number of hosts) pairs.
+    """
+    # Counted by the table, which may be in the state process.
+    counts = collections.Counter(
+        self.host_infos.GetAttrCounts('last_known_version'))
+    counts.pop('ForcedUpdate', None)
+    return counts.most_common()
+
+  def PreGenerateDeltas(self):
+    """Schedules delta payloads to the latest image for demanded versions.
+
+    Of the versions hosts last reported running, the self.delta_sources most
+    common ones with an image next to the latest image get a delta payload
+    from that image to the latest, generated by self.payload_scheduler. Once
+    generated, clients reporting a version are routed to its delta. Only
+    non-legacy payloads, with the kernel included, are pre-generated.
+
+    Returns:
+      The list of versions deltas are, or are being, generated from.
+    Raises:
+      AutoupdateError if the latest image can't be found.
+    """
+    latest_image_dir, latest_version = self._GetLatestImage(self.board)
+    latest_image_path = os.path.join(latest_image_dir, self._GetImageName())
+    source_images = self._GetSourceImages(latest_image_dir)
+
+    routes = {}
+    for version, _ in self.GetDemandedVersions():
+      if len(routes) >= self.delta_sources:
+        break
+      src_image = source_images.get(version)
+      if not src_image or not self._CanUpdate(version, latest_version):
+        continue
+
+      cache_sub_dir = self.FindCachedUpdateImageSubDir(src_image,
+                                                       latest_image_path)
+      cache_dir = os.path.join(self.static_dir, cache_sub_dir)
+      cache_update_payload = os.path.join(cache_dir, KERNEL_UPDATE_FILE)
+      if not os.path.exists(cache_update_payload):
+        self.payload_scheduler.Submit(
+            cache_update_payload, self._GenerateCachedUpdateImage,
+            latest_image_path, cache_dir, False, src_image)
+      routes[version] = (latest_image_path, cache_sub_dir)
+
+    self._delta_routes = routes
+    return sorted(routes)
+
+  def _HasFailedUpdate(self, host_id, client_version):
+    """Returns whether a host reported a failed update from client_version.
+
+    The host's event log is searched if host events are logged; otherwise
+    only the last event the host reported is known.
+    """
+    host_info = self.host_infos.GetHostInfo(host_id)
+    if not host_info:
+      return False
+    if self.host_log:
+      return any(entry.event_result == EVENT_RESULT_ERROR and
+                 entry.version == client_version
+                 for entry in list(host_info.log))
+    return (host_info.attrs.get('last_event_status') == EVENT_RESULT_ERROR and
+            host_info.attrs.get('last_known_version') == client_version)
+
+  def _GetPreGeneratedDelta(self, client_version, image_path,
+                            static_image_dir, legacy_image, host_id=None):
+    """Returns the cache sub dir of a ready delta for a client, if any.
+
+    Hosts that failed to update from their version get the full payload
+    instead, in case the delta is what they failed to apply.
+
+    Args:
+      client_version: version the client is running.
+      image_path: image the client is to be updated to.
+      static_image_dir: directory the payload would be served from.
+      legacy_image: whether the client needs a legacy payload.
+      host_id: the requesting host, if known.
+    """
+    route = self._delta_routes.get(client_version)
+    if (not route or route[0] != image_path or legacy_image or
+        static_image_dir != self.static_dir):
+      return None
+    if not os.path.exists(os.path.join(static_image_dir, route[1],
+                                       KERNEL_UPDATE_FILE)):
+      return None
+    if host_id and self._HasFailedUpdate(host_id, client_version):
+      _Log('Host %s failed to update from %s, not serving it a delta',
+           host_id, client_version)
+      return None
+    return route[1]
+
   def _GetRemotePayloadAttrs(self, url):
     """Returns hashes, size and delta flag of a remote update payload.
 
@@ -526,20 +1459,16 @@ class Autoupdate(object):
 
     fileinfo_url = url.replace(self._PAYLOAD_URL_PREFIX,
                                self._FILEINFO_URL_PREFIX)
-    _Log('Retrieving file info for remote payload via %s', fileinfo_url)
     try:
-      conn = urllib2.urlopen(fileinfo_url)
-      metadata_obj = Autoupdate._ReadMetadataFromStream(conn)
-      # These fields are required for remote calls.
-      if not metadata_obj:
-        raise AutoupdateError('Failed to obtain remote payload info')
-
-      if not metadata_obj.is_delta_format:
-        metadata_obj.is_delta_format = ('_mton' in url) or ('_nton' in url)
-
-      return metadata_obj
+      metadata_obj = self.remote_payload_cache.Get(fileinfo_url)
     except IOError as e:
-      raise AutoupdateError('Failed to obtain remote payload info: %s', e)
+      raise AutoupdateError('Failed to obtain remote payload info: %s' % e)
+
+    if not metadata_obj.is_delta_format:
+      metadata_obj = UpdateMetadata(
+          metadata_obj.sha1, metadata_obj.sha256, metadata_obj.size,
+          ('_mton' in url) or ('_nton' in url))
+    return metadata_obj
 
   def GetLocalPayloadAttrs(self, payload_dir, legacy_image):
     """Returns hashes, size and delta flag of a local update payload.
@@ -554,81 +1483,94 @@ class Autoupdate(object):
       filename = os.path.join(payload_dir, UPDATE_FILE)
     else:
       filename = os.path.join(payload_dir, KERNEL_UPDATE_FILE)
-    if not os.path.exists(filename):
+    try:
+      file_stat = os.stat(filename)
+    except OSError:
       raise AutoupdateError('%s not present in payload dir %s' %
                             (filename, payload_dir))
 
+    metadata_obj = self.payload_metadata_cache.Get(filename, file_stat)
+    if metadata_obj:
+      return metadata_obj
+
     metadata_obj = Autoupdate._ReadMetadataFromFile(payload_dir, legacy_image)
     if not metadata_obj or not (metadata_obj.sha1 and
                                 metadata_obj.sha256 and
                                 metadata_obj.size):
-      sha1 = common_util.GetFileSha1(filename)
-      sha256 = common_util.GetFileSha256(filename)
+      sha1, sha256 = self.GetFileSha1AndSha256(filename)
       size = common_util.GetFileSize(filename)
       is_delta_format = self._IsDeltaFormatFile(filename)
       metadata_obj = UpdateMetadata(sha1, sha256, size, is_delta_format)
       Autoupdate._StoreMetadataToFile(payload_dir, metadata_obj, legacy_image)
 
+    self.payload_metadata_cache.Put(filename, file_stat, metadata_obj)
     return metadata_obj
 
-  def _ProcessUpdateComponents(self, app, event):
+  def _ProcessUpdateComponents(self, app, event, client_ip):
     """Processes the app and event components of an update request.
 
+    Args:
+      app: dictionary of app attributes of the request, or None.
+      event: dictionary of event attributes of the request, or None.
+      client_ip: address of the client that sent the request.
+
     Returns tuple containing forced_update_label, client_version, board and
     app_id
     """
-    # Initialize an empty dictionary for event attributes to log.
+    # Initialize empty dictionaries for event attributes to log, and for host
+    # attributes to update.
     log_message = {}
+    host_attrs = {}
 
-    # Determine request IP, strip any IPv6 data for simplicity.
-    client_ip = cherrypy.request.remote.ip.split(':')[-1]
-    # Obtain (or init) info object for this client.
-    curr_host_info = self.host_infos.GetInitHostInfo(client_ip)
+    client_ip = _GetHostId(client_ip)
 
     client_version = 'ForcedUpdate'
     board = None
     app_id = None
-    if app:
-      client_version = app.getAttribute('version')
-      channel = app.getAttribute('track')
-      board = (app.hasAttribute('board') and app.getAttribute('board')
-                  or self.board)
-      app_id = app.getAttribute('appid')
+    if app is not None:
+      client_version = app.get('version', '')
+      channel = app.get('track', '')
+      board = app.get('board') or self.board
+      app_id = app.get('appid', '')
       # Add attributes to log message
       log_message['version'] = client_version
       log_message['track'] = channel
       log_message['board'] = board
-      curr_host_info.attrs['last_known_version'] = client_version
-
-    if event:
-      event_result = int(event[0].getAttribute('eventresult'))
-      event_type = int(event[0].getAttribute('eventtype'))
-      client_previous_version = (event[0].getAttribute('previousversion')
-                                 if event[0].hasAttribute('previousversion')
-                                 else None)
+      host_attrs['last_known_version'] = client_version
+
+    if event is not None:
+      event_result = int(event.get('eventresult', ''))
+      event_type = int(event.get('eventtype', ''))
+      client_previous_version = event.get('previousversion')
       # Store attributes to legacy host info structure
-      curr_host_info.attrs['last_event_status'] = event_result
-      curr_host_info.attrs['last_event_type'] = event_type
+      host_attrs['last_event_status'] = event_result
+      host_attrs['last_event_type'] = event_type
       # Add attributes to log message
       log_message['event_result'] = event_result
       log_message['event_type'] = event_type
       if client_previous_version is not None:
         log_message['previous_version'] = client_previous_version
 
+    # Update the host's attributes, consuming any forced update in the same
+    # step so that it is handed out exactly once.
+    forced_update_label = self.host_infos.UpdateHostAttrs(
+        client_ip, host_attrs, pop_attr='forced_update_label')
+
     # Log host event, if so instructed.
     if self.host_log:
-      curr_host_info.AddLogEntry(log_message)
+      self.host_infos.AddLogEntry(client_ip, log_message)
 
-    return (curr_host_info.attrs.pop('forced_update_label', None),
-            client_version, board, app_id)
+    return forced_update_label, client_version, board, app_id
 
-  def _GetStaticUrl(self):
-    """Returns the static url base that should prefix all payload responses."""
-    x_forwarded_host = cherrypy.request.headers.get('X-Forwarded-Host')
-    if x_forwarded_host:
-      hostname = 'http://' + x_forwarded_host
-    else:
-      hostname = cherrypy.request.base
+  def _GetStaticUrl(self, hostname):
+    """Returns the static url base that should prefix all payload responses.
+
+    Args:
+      hostname: base URL the devserver is reached at, e.g. http://host:8080.
+    """
+    static_urlbase = self._static_urls.get(hostname)
+    if static_urlbase:
+      return static_urlbase
 
     if self.urlbase:
       static_urlbase = self.urlbase
@@ -642,31 +1584,52 @@ class Autoupdate(object):
     if self.proxy_port:
       static_urlbase = _ChangeUrlPort(static_urlbase, self.proxy_port)
 
-    _Log('Using static url base %s', static_urlbase)
-    _Log('Handling update ping as %s', hostname)
+    _Log('Using static url base %s when reached at %s', static_urlbase,
+         hostname)
+    # Host headers come from clients; don't let bogus ones grow this forever.
+    if len(self._static_urls) >= MAX_STATIC_URLS:
+      self._static_urls.clear()
+    self._static_urls[hostname] = static_urlbase
     return static_urlbase
 
-  def HandleUpdatePing(self, data, label=None):
+  def HandleUpdatePing(self, data, label=None, client_ip=None,
+                       hostname=None):
     """Handles an update ping from an update client.
 
     Args:
       data: XML blob from client.
       label: optional label for the update.
+      client_ip: address of the client; defaults to that of the current
+                 CherryPy request.
+      hostname: base URL the client reached the devserver at; defaults to
+                that of the current CherryPy request, or its X-Forwarded-Host.
     Returns:
       Update payload message for client.
     """
+    if client_ip is None:
+      client_ip = cherrypy.request.remote.ip
+    if hostname is None:
+      x_forwarded_host = cherrypy.request.headers.get('X-Forwarded-Host')
+      if x_forwarded_host:
+        hostname = 'http://' + x_forwarded_host
+      else:
+        hostname = cherrypy.request.base
+
     # Get the static url base that will form that base of our update url e.g.
     # http://hostname:8080/static/update.gz.
-    static_urlbase = self._GetStaticUrl()
+    static_urlbase = self._GetStaticUrl(hostname)
 
-    _Log(data)
+    _Log(data, level=log_util.DEBUG)
     # Parse the XML we got into the components we care about.
-    protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(data)
+    with _UPDATE_STAGE_SECONDS.Time('parse'):
+      request = autoupdate_lib.ParseUpdateRequest(data)
+    protocol = request.protocol
 
     # #########################################################################
     # Process attributes of the update check.
-    forced_update_label, client_version, board, app_id = self._ProcessUpdateComponents(
-        app, event)
+    with _UPDATE_STAGE_SECONDS.Time('host_info'):
+      forced_update_label, client_version, board, app_id = (
+          self._ProcessUpdateComponents(request.app, request.event, client_ip))
 
     if app_id == '{e96281a6-d1af-4bde-9a0a-97b76e56dc57}':
       legacy_image = True
@@ -674,11 +1637,12 @@ class Autoupdate(object):
       legacy_image = False
 
     # We only process update_checks in the update rpc.
-    if not update_check:
+    if not request.update_check:
       _Log('Non-update check received.  Returning blank payload')
       # TODO(sosa): Generate correct non-updatecheck payload to better test
       # update clients.
-      return autoupdate_lib.GetNoUpdateResponse(protocol)
+      with _UPDATE_STAGE_SECONDS.Time('render'):
+        return autoupdate_lib.GetNoUpdateResponse(protocol)
 
     # In case max_updates is used, return no response if max reached.
     if self.max_updates > 0:
@@ -714,16 +1678,22 @@ class Autoupdate(object):
         url = '/'.join(filter(None, [static_urlbase, label, UPDATE_FILE]))
 
         # Get remote payload attributes.
-        metadata_obj = self._GetRemotePayloadAttrs(url)
+        with _UPDATE_STAGE_SECONDS.Time('metadata'):
+          metadata_obj = self._GetRemotePayloadAttrs(url)
       else:
         static_image_dir = _NonePathJoin(self.static_dir, label)
         rel_path = None
 
+        # The forced payload is served as registered, without file operations.
+        if self.payload_path and not self.serve_only:
+          metadata_obj = self.RegisterPayload(static_image_dir, legacy_image)
         # Serving files only, don't generate an update.
-        if not self.serve_only:
+        elif not self.serve_only:
           # Generate payload if necessary.
-          rel_path = self.GenerateUpdatePayload(board, client_version,
-                                                static_image_dir, legacy_image)
+          with _UPDATE_STAGE_SECONDS.Time('generate'):
+            rel_path = self.GenerateUpdatePayload(
+                board, client_version, static_image_dir, legacy_image,
+                host_id=_GetHostId(client_ip))
 
         if legacy_image:
           filename = UPDATE_FILE
@@ -732,7 +1702,10 @@ class Autoupdate(object):
         url = '/'.join(filter(None, [static_urlbase, label, rel_path,
                                      filename]))
         local_payload_dir = _NonePathJoin(static_image_dir, rel_path)
-        metadata_obj = self.GetLocalPayloadAttrs(local_payload_dir, legacy_image)
+        if not metadata_obj:
+          with _UPDATE_STAGE_SECONDS.Time('metadata'):
+            metadata_obj = self.GetLocalPayloadAttrs(local_payload_dir,
+                                                     legacy_image)
 
     except AutoupdateError as e:
       # Raised if we fail to generate an update payload.
@@ -740,33 +1713,136 @@ class Autoupdate(object):
       return autoupdate_lib.GetNoUpdateResponse(protocol)
 
     _Log('Responding to client to use url %s to get image', url)
-    return autoupdate_lib.GetUpdateResponse(
-        metadata_obj.sha1, metadata_obj.sha256, metadata_obj.size, url,
-        metadata_obj.is_delta_format, protocol, self.critical_update)
+    with _UPDATE_STAGE_SECONDS.Time('render'):
+      return autoupdate_lib.GetUpdateResponse(
+          metadata_obj.sha1, metadata_obj.sha256, metadata_obj.size, url,
+          metadata_obj.is_delta_format, protocol, self.critical_update)
 
   def HandleHostInfoPing(self, ip):
-    """Returns host info dictionary for the given IP in JSON format."""
+    """Returns host info dictionary for the given IP in JSON format.
+
+    If ip is 'stats', returns statistics about the host info table instead.
+    """
     assert ip, 'No ip provided.'
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).attrs)
+    if ip == 'stats':
+      return json.dumps(self.host_infos.GetStats())
+    host_info = self.host_infos.GetHostInfo(ip)
+    if host_info:
+      return json.dumps(host_info.attrs)
+
+  def _StreamHostLogs(self, since, cursor, last):
+    """Yields a JSON dictionary of logs keyed by host, one entry at a time.
+
+    Logs are fetched from the host info table a batch of hosts at a time, so
+    that they are never all copied out of the table at once.
+    """
+    host_ids = self.host_infos.GetHostIds()
+    yield '{'
+    first_host = True
+    for i in xrange(0, len(host_ids), HOST_LOG_BATCH):
+      for host_id, entries in self.host_infos.GetHostLogs(
+          host_ids[i:i + HOST_LOG_BATCH], since, cursor, last):
+        yield '%s%s: [' % ('' if first_host else ', ', json.dumps(host_id))
+        first_host = False
+        for j, entry in enumerate(entries):
+          yield '%s%s' % (', ' if j else '', json.dumps(entry))
+        yield ']'
+    yield '}'
+
+  def HandleHostLogPing(self, ip, since=None, limit=None, cursor=None):
+    """Returns a log of recent events for host in JSON format.
+
+    The log is returned as an iterable of strings, so that the log of all hosts
+    can be streamed rather than encoded in one go. The sequence number of the
+    last returned event is set in the X-Next-Cursor response header, to be
+    passed as cursor in order to only get events recorded since.
+
+    Args:
+      ip: address of the host, or 'all' for a dictionary of logs keyed by IP.
+      since: if set, only return events recorded at or after this time.
+      limit: if set, return at most this many (oldest) events.
+      cursor: if set, only return events following this sequence number.
+    Returns:
+      An iterable of strings making up the JSON encoded log.
+    """
+    # Entries logged while the logs are read may show up before earlier ones
+    # logged concurrently; they are left for the next read, so that no entry
+    # falls behind the cursor handed out.
+    last_logged = self.host_infos.GetLastLogSeq()
+    host_ids = None if ip == 'all' else [ip]
+
+    # Entries are selected up to the last one within limit, so that they can
+    # be streamed one host after the other.
+    last = self.host_infos.GetLastSelectedLogSeq(host_ids, since, limit,
+                                                 cursor, last_logged)
+    if last is None:
+      last = cursor or 0
+    cherrypy.response.headers['X-Next-Cursor'] = str(last)
 
-  def HandleHostLogPing(self, ip):
-    """Returns a complete log of events for host in JSON format."""
     # If all events requested, return a dictionary of logs keyed by IP address.
     if ip == 'all':
-      return json.dumps(
-          dict([(key, self.host_infos.table[key].log)
-                for key in self.host_infos.table]))
+      return self._StreamHostLogs(since, cursor, last)
+
+    # Otherwise we're looking for a specific IP address, so return its log,
+    # which is empty if no events were logged for it.
+    host_logs = self.host_infos.GetHostLogs(host_ids, since, cursor, last)
+    return [json.dumps(host_logs[0][1] if host_logs else [])]
+
+  def GetMetrics(self):
+    """Returns cache and host table statistics for export by metrics."""
+    cache_stats = self.payload_metadata_cache.GetStats()
+    host_stats = self.host_infos.GetStats()
+    remote_stats = self.remote_payload_cache.GetStats()
+    return [
+        ('devserver_payload_metadata_cache_hits_total', 'counter',
+         'Payload metadata cache hits.', cache_stats['hits']),
+        ('devserver_payload_metadata_cache_misses_total', 'counter',
+         'Payload metadata cache misses.', cache_stats['misses']),
+        ('devserver_payload_metadata_cache_entries', 'gauge',
+         'Payloads whose metadata is cached.', cache_stats['entries']),
+        ('devserver_hosts', 'gauge',
+         'Hosts with recorded information.', host_stats['hosts']),
+        ('devserver_evicted_hosts_total', 'counter',
+         'Hosts evicted from the host info table.',
+         host_stats['evicted_hosts']),
+        ('devserver_host_log_entries', 'gauge',
+         'Recorded host log entries.', host_stats['log_entries']),
+        ('devserver_remote_payload_cache_hits_total', 'counter',
+         'Remote payload lookups answered from a fresh copy.',
+         remote_stats['hits']),
+        ('devserver_remote_payload_cache_stale_hits_total', 'counter',
+         'Remote payload lookups answered from a copy being revalidated.',
+         remote_stats['stale_hits']),
+        ('devserver_remote_payload_cache_misses_total', 'counter',
+         'Remote payload lookups that waited for the remote devserver.',
+         remote_stats['misses']),
+    ] + self._GetPayloadCacheMetrics()
+
+  def _GetPayloadCacheMetrics(self):
+    if not self.payload_cache:
+      return []
+    stats = self.payload_cache.GetStats()
+    return [
+        ('devserver_payload_cache_bytes', 'gauge',
+         'Size of the cached payloads.', stats['bytes']),
+        ('devserver_payload_cache_entries', 'gauge',
+         'Cached payload directories.', stats['entries']),
+        ('devserver_payload_cache_evicted_total', 'counter',
+         'Cached payload directories evicted.', stats['evicted']),
+    ]
 
-    # Otherwise we're looking for a specific IP address, so find its log.
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).log)
+  def HandleCacheStatsPing(self):
+    """Returns payload metadata cache statistics in JSON format."""
+    return json.dumps(self.payload_metadata_cache.GetStats())
 
-    # If no events were logged for this IP, return an empty log.
-    return json.dumps([])
+  def HandlePayloadJobsPing(self):
+    """Returns the state of background payload generation in JSON format."""
+    if not self.payload_scheduler:
+      return json.dumps([])
+    return json.dumps(self.payload_scheduler.GetJobs())
 
   def HandleSetUpdatePing(self, ip, label):
     """Sets forced_update_label for a given host."""
     assert ip, 'No ip provided.'
     assert label, 'No label provided.'
-    self.host_infos.GetInitHostInfo(ip).attrs['forced_update_label'] = label
+    self.host_infos.UpdateHostAttrs(ip, {'forced_update_label': label})
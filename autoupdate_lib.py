@@ -7,7 +7,7 @@
 import datetime
 import os
 import time
-from xml.dom import minidom
+from xml.parsers import expat
 
 
 APP_ID = 'e96281a6-d1af-4bde-9a0a-97b76e56dc57'
@@ -88,6 +88,17 @@ NO_UPDATE_RESPONSE['3.0'] = """<?xml version="1.0" encoding="UTF-8"?>
   """
 
 
+# Placeholder for the elapsed time in compiled responses.
+_TIME_ELAPSED_MARKER = '\0time_elapsed\0'
+
+# Maximum number of compiled responses kept in memory.
+_COMPILED_RESPONSES_KEPT = 64
+
+# Compiled responses, indexed by protocol and payload attributes. See
+# _CompileResponse().
+_compiled_responses = {}
+
+
 class UnknownProtocolRequestedException(Exception):
   """Raised when an supported protocol is specified."""
 
@@ -120,22 +131,11 @@ def GetSubstitutedResponse(response_dict, protocol, response_values):
   return response_xml
 
 
-def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
-                      critical_update=False):
-  """Returns a protocol-specific response to the client for a new update.
-
-  Args:
-    sha1: SHA1 hash of update blob
-    sha256: SHA256 hash of update blob
-    size: size of update blob
-    url: where to find update blob
-    is_delta_format: true if url refers to a delta payload
-    protocol: client's protocol version from the request Xml.
-    critical_update: whether this is a critical update.
-  Returns:
-    Xml string to be passed back to client.
-  """
-  response_values = GetCommonResponseValues()
+def _GetUpdateResponseValues(sha1, sha256, size, url, is_delta_format,
+                             critical_update):
+  """Returns the update-specific values to be substituted in a response."""
+  response_values = {}
+  response_values['appid'] = APP_ID
   response_values['sha1'] = sha1
   response_values['sha256'] = sha256
   response_values['size'] = size
@@ -153,7 +153,79 @@ def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
     extra_attributes.append('deadline="%s"' % date_str)
 
   response_values['extra_attr'] = ' '.join(extra_attributes)
-  return GetSubstitutedResponse(UPDATE_RESPONSE, protocol, response_values)
+  return response_values
+
+
+def _CompileResponse(response_dict, protocol, response_values):
+  """Substitutes everything but the elapsed time in a canned response.
+
+  Args:
+    response_dict: Canned response messages indexed by protocol.
+    protocol: client's protocol version from the request Xml.
+    response_values: Values to be substituted in the canned response, other
+      than time_elapsed.
+  Returns:
+    A (head, tail) pair of strings, such that head, the elapsed time and tail
+    joined together make up the Xml string to be passed back to the client.
+  """
+  response_values = dict(response_values, time_elapsed=_TIME_ELAPSED_MARKER)
+  head, tail = GetSubstitutedResponse(
+      response_dict, protocol, response_values).split(_TIME_ELAPSED_MARKER)
+  return head, tail
+
+
+def _GetNoUpdateResponseValues():
+  """Returns the values to be substituted in a no-update response."""
+  return {'appid': APP_ID}
+
+
+def _GetCompiledResponse(response_dict, protocol, cache_key, get_values,
+                         *args):
+  """Returns a compiled response, compiling and caching it if needed.
+
+  Args:
+    response_dict: Canned response messages indexed by protocol.
+    protocol: client's protocol version from the request Xml.
+    cache_key: Identifies the response among all compiled ones.
+    get_values: Called with args to obtain the response values, if needed.
+  Returns:
+    The (head, tail) pair returned by _CompileResponse().
+  """
+  compiled_response = _compiled_responses.get(cache_key)
+  if not compiled_response:
+    compiled_response = _CompileResponse(response_dict, protocol,
+                                         get_values(*args))
+    # Payloads don't change often, so simply start over once full.
+    if len(_compiled_responses) >= _COMPILED_RESPONSES_KEPT:
+      _compiled_responses.clear()
+    _compiled_responses[cache_key] = compiled_response
+  return compiled_response
+
+
+def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
+                      critical_update=False):
+  """Returns a protocol-specific response to the client for a new update.
+
+  The response for a given payload is only rendered once; subsequent calls
+  just fill in the current time.
+
+  Args:
+    sha1: SHA1 hash of update blob
+    sha256: SHA256 hash of update blob
+    size: size of update blob
+    url: where to find update blob
+    is_delta_format: true if url refers to a delta payload
+    protocol: client's protocol version from the request Xml.
+    critical_update: whether this is a critical update.
+  Returns:
+    Xml string to be passed back to client.
+  """
+  cache_key = (protocol, sha1, sha256, size, url, is_delta_format,
+               critical_update and datetime.date.today())
+  head, tail = _GetCompiledResponse(
+      UPDATE_RESPONSE, protocol, cache_key, _GetUpdateResponseValues,
+      sha1, sha256, size, url, is_delta_format, critical_update)
+  return ''.join((head, str(GetSecondsSinceMidnight()), tail))
 
 
 def GetNoUpdateResponse(protocol):
@@ -164,33 +236,74 @@ def GetNoUpdateResponse(protocol):
   Returns:
     Xml string to be passed back to client.
   """
-  response_values = GetCommonResponseValues()
-  return GetSubstitutedResponse(NO_UPDATE_RESPONSE, protocol, response_values)
+  head, tail = _GetCompiledResponse(
+      NO_UPDATE_RESPONSE, protocol, (protocol,), _GetNoUpdateResponseValues)
+  return ''.join((head, str(GetSecondsSinceMidnight()), tail))
+
+
+class UpdateRequest(object):
+  """Information extracted from an update request.
+
+  Members:
+    protocol:     client's protocol version.
+    app:          dictionary of attributes of the app element, or None.
+    event:        dictionary of attributes of the first event element, or None.
+    update_check: whether the request contains an update check.
+  """
+
+  __slots__ = ('protocol', 'app', 'event', 'update_check')
+
+  def __init__(self):
+    self.protocol = None
+    self.app = None
+    self.event = None
+    self.update_check = False
+
+
+class _UpdateRequestParser(object):
+  """Extracts an UpdateRequest from an update request in a single pass."""
+
+  _SUPPORTED_PROTOCOLS = ('2.0', '3.0')
+
+  def __init__(self):
+    self.request = UpdateRequest()
+    self._element_names = None
+
+  def StartElement(self, name, attrs):
+    """Expat start element handler."""
+    if self._element_names is None:
+      # This is the root element, which holds the protocol version.
+      protocol = attrs.get('protocol', '')
+      if protocol not in self._SUPPORTED_PROTOCOLS:
+        raise UnknownProtocolRequestedException('Supported protocols are %s' %
+                                                (self._SUPPORTED_PROTOCOLS,))
+      self.request.protocol = protocol
+      prefix = 'o:' if protocol == '2.0' else ''
+      self._element_names = dict((prefix + name, name)
+                                 for name in ('app', 'event', 'updatecheck'))
+      return
+
+    element = self._element_names.get(name)
+    if element == 'app' and self.request.app is None:
+      self.request.app = attrs
+    elif element == 'event' and self.request.event is None:
+      self.request.event = attrs
+    elif element == 'updatecheck':
+      self.request.update_check = True
 
 
 def ParseUpdateRequest(request_string):
-  """Returns a tuple containing information parsed from an update request.
+  """Returns information parsed from an update request.
 
   Args:
-    request_dom: an xml string containing the update request.
-  Returns tuple consisting of protocol string, app element, event element and
-    update_check element.
+    request_string: an xml string containing the update request.
+  Returns an UpdateRequest object.
   Raises UnknownProtocolRequestedException if we do not understand the
     protocol.
+  Raises xml.parsers.expat.ExpatError if the request is not valid Xml.
   """
-  request_dom = minidom.parseString(request_string)
-  protocol = request_dom.firstChild.getAttribute('protocol')
-  supported_protocols = '2.0', '3.0'
-  if protocol not in supported_protocols:
-    raise UnknownProtocolRequestedException('Supported protocols are %s' %
-                                            supported_protocols)
-
-  element_dict = {}
-  for name in ['event', 'app', 'updatecheck']:
-    element_dict[name] = 'o:' + name if protocol == '2.0' else name
-
-  app = request_dom.firstChild.getElementsByTagName(element_dict['app'])[0]
-  event = request_dom.getElementsByTagName(element_dict['event'])
-  update_check = request_dom.getElementsByTagName(element_dict['updatecheck'])
-
-  return protocol, app, event, update_check
+  parser = _UpdateRequestParser()
+  expat_parser = expat.ParserCreate()
+  expat_parser.StartElementHandler = parser.StartElement
+  expat_parser.Parse(request_string, True)
+  return parser.request
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for autoupdate_lib module."""
+
+import unittest
+from xml.parsers import expat
+
+import mox
+
+import autoupdate_lib
+
+
+_UPDATE_REQUEST = {}
+_UPDATE_REQUEST['2.0'] = """<?xml version="1.0" encoding="UTF-8"?>
+<o:gupdate xmlns:o="http://www.google.com/update2/request" protocol="2.0">
+  <o:os version="Indy" platform="Chrome OS"></o:os>
+  <o:app appid="{DEV-BUILD}" version="0.11.254" track="dev" board="x86">
+    <o:updatecheck></o:updatecheck>
+    <o:event eventtype="3" eventresult="2" previousversion="0.11.216"></o:event>
+    <o:event eventtype="4" eventresult="1"></o:event>
+  </o:app>
+</o:gupdate>
+"""
+_UPDATE_REQUEST['3.0'] = """<?xml version="1.0" encoding="UTF-8"?>
+<request protocol="3.0">
+  <os version="Indy" platform="Chrome OS"></os>
+  <app appid="{DEV-BUILD}" version="0.11.254" track="dev" board="x86">
+    <event eventtype="3" eventresult="2" previousversion="0.11.216"></event>
+  </app>
+</request>
+"""
+
+
+class AutoupdateLibTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.mox.StubOutWithMock(autoupdate_lib, 'GetSecondsSinceMidnight')
+    autoupdate_lib._compiled_responses.clear()
+    self._update_args = ('sha1hash', 'sha256hash', 1234,
+                         'http://host:8080/static/update.gz', False)
+
+  def _GetExpectedUpdateResponse(self, protocol, time_elapsed,
+                                 critical_update=False):
+    """Renders an update response without using compiled responses."""
+    response_values = autoupdate_lib._GetUpdateResponseValues(
+        *(self._update_args + (critical_update,)))
+    response_values['time_elapsed'] = time_elapsed
+    return autoupdate_lib.GetSubstitutedResponse(
+        autoupdate_lib.UPDATE_RESPONSE, protocol, response_values)
+
+  def testGetUpdateResponse(self):
+    for protocol in ('2.0', '3.0'):
+      autoupdate_lib.GetSecondsSinceMidnight().AndReturn(100)
+      autoupdate_lib.GetSecondsSinceMidnight().AndReturn(200)
+    self.mox.ReplayAll()
+
+    for protocol in ('2.0', '3.0'):
+      for time_elapsed in (100, 200):
+        response = autoupdate_lib.GetUpdateResponse(
+            *(self._update_args + (protocol,)))
+        self.assertEqual(
+            response, self._GetExpectedUpdateResponse(protocol, time_elapsed))
+    self.assertEqual(len(autoupdate_lib._compiled_responses), 2)
+    self.mox.VerifyAll()
+
+  def testGetCriticalUpdateResponse(self):
+    autoupdate_lib.GetSecondsSinceMidnight().AndReturn(100)
+    self.mox.ReplayAll()
+
+    response = autoupdate_lib.GetUpdateResponse(
+        *(self._update_args + ('3.0', True)))
+    self.assertTrue('deadline="' in response)
+    self.assertEqual(
+        response, self._GetExpectedUpdateResponse('3.0', 100, True))
+    self.mox.VerifyAll()
+
+  def testGetNoUpdateResponse(self):
+    autoupdate_lib.GetSecondsSinceMidnight().AndReturn(42)
+    self.mox.ReplayAll()
+
+    response = autoupdate_lib.GetNoUpdateResponse('2.0')
+    self.assertEqual(
+        response,
+        autoupdate_lib.NO_UPDATE_RESPONSE['2.0'] %
+        {'appid': autoupdate_lib.APP_ID, 'time_elapsed': 42})
+    self.mox.VerifyAll()
+
+  def testParseUpdateRequest(self):
+    for protocol, update_check in (('2.0', True), ('3.0', False)):
+      request = autoupdate_lib.ParseUpdateRequest(_UPDATE_REQUEST[protocol])
+      self.assertEqual(request.protocol, protocol)
+      self.assertEqual(request.app,
+                       {'appid': '{DEV-BUILD}', 'version': '0.11.254',
+                        'track': 'dev', 'board': 'x86'})
+      # Only the first event is reported.
+      self.assertEqual(request.event,
+                       {'eventtype': '3', 'eventresult': '2',
+                        'previousversion': '0.11.216'})
+      self.assertEqual(request.update_check, update_check)
+
+  def testParseUpdateRequestWithoutApp(self):
+    request = autoupdate_lib.ParseUpdateRequest(
+        '<request protocol="3.0"><updatecheck/></request>')
+    self.assertEqual(request.app, None)
+    self.assertEqual(request.event, None)
+    self.assertTrue(request.update_check)
+
+  def testParseBadUpdateRequest(self):
+    self.assertRaises(autoupdate_lib.UnknownProtocolRequestedException,
+                      autoupdate_lib.ParseUpdateRequest,
+                      _UPDATE_REQUEST['3.0'].replace('3.0', '1.0'))
+    self.assertRaises(expat.ExpatError, autoupdate_lib.ParseUpdateRequest,
+                      '<request protocol="3.0">')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -6,10 +6,14 @@
 
 """Unit tests for autoupdate.py."""
 
+import base64
 import json
 import os
 import shutil
 import socket
+import tempfile
+import threading
+import time
 import unittest
 
 import cherrypy
@@ -18,6 +22,7 @@ import mox
 import autoupdate
 import autoupdate_lib
 import common_util
+import payload_jobs
 
 
 _TEST_REQUEST = """
@@ -32,8 +37,7 @@ class AutoupdateTest(mox.MoxTestBase):
   def setUp(self):
     mox.MoxTestBase.setUp(self)
     self.mox.StubOutWithMock(common_util, 'GetFileSize')
-    self.mox.StubOutWithMock(common_util, 'GetFileSha1')
-    self.mox.StubOutWithMock(common_util, 'GetFileSha256')
+    self.mox.StubOutWithMock(common_util, 'GetFileSha1AndSha256')
     self.mox.StubOutWithMock(autoupdate_lib, 'GetUpdateResponse')
     self.mox.StubOutWithMock(autoupdate.Autoupdate, '_GetLatestImageDir')
     self.mox.StubOutWithMock(autoupdate.Autoupdate, '_GetRemotePayloadAttrs')
@@ -70,6 +74,35 @@ class AutoupdateTest(mox.MoxTestBase):
     dummy = autoupdate.Autoupdate(static_dir=self.static_image_dir, **kwargs)
     return dummy
 
+  def testRegisterPayload(self):
+    """Tests that the forced payload is placed and hashed only once."""
+    payload_dir = tempfile.mkdtemp('autoupdate_unittest')
+    try:
+      payload_path = os.path.join(payload_dir, 'my_payload.gz')
+      with open(payload_path, 'w') as fh:
+        fh.write(self.payload)
+      update_payload = os.path.join(self.static_image_dir,
+                                    autoupdate.UPDATE_FILE)
+      common_util.GetFileSha1AndSha256(update_payload).AndReturn(
+          (self.sha1, self.sha256))
+      common_util.GetFileSize(update_payload).AndReturn(self.size)
+      self.mox.ReplayAll()
+
+      au_mock = self._DummyAutoupdateConstructor(payload_path=payload_path)
+      metadata_obj = au_mock.RegisterPayload(self.static_image_dir, True)
+      self.assertTrue(os.path.samefile(payload_path, update_payload))
+      self.assertEqual(metadata_obj.size, self.size)
+      # Later update checks don't touch the payload.
+      os.unlink(update_payload)
+      self.assertEqual(
+          au_mock.GenerateUpdatePayload(None, None, self.static_image_dir,
+                                        True), None)
+      self.assertEqual(au_mock.RegisterPayload(self.static_image_dir, True),
+                       metadata_obj)
+      self.mox.VerifyAll()
+    finally:
+      shutil.rmtree(payload_dir)
+
   def testGetRightSignedDeltaPayloadDir(self):
     """Test that our directory is what we expect it to be for signed updates."""
     self.mox.StubOutWithMock(common_util, 'GetFileMd5')
@@ -93,6 +126,205 @@ class AutoupdateTest(mox.MoxTestBase):
                      (src_hash, target_hash, key_hash))
     self.mox.VerifyAll()
 
+  def testGenerateUpdateImageWithCacheSingleFlight(self):
+    """Tests that concurrent requests for a payload generate it only once."""
+    self.mox.StubOutWithMock(autoupdate.Autoupdate,
+                             'FindCachedUpdateImageSubDir')
+    au_mock = self._DummyAutoupdateConstructor(copy_to_static_root=False)
+    cache_dir = os.path.join(self.static_image_dir, 'cache', 'some_hash')
+    generated = []
+
+    def _FakeGenerateUpdateFile(_src_image, _image_path, output_dir,
+                                _legacy_image):
+      generated.append(output_dir)
+      # Give the other threads a chance to find the payload missing.
+      time.sleep(0.1)
+      with open(os.path.join(output_dir, autoupdate.UPDATE_FILE), 'w') as fh:
+        fh.write('payload')
+    self.stubs.Set(au_mock, 'GenerateUpdateFile', _FakeGenerateUpdateFile)
+
+    num_threads = 4
+    au_mock.FindCachedUpdateImageSubDir(
+        '', self.forced_image_path).MultipleTimes().AndReturn(cache_dir)
+    common_util.GetFileSha1AndSha256(
+        os.path.join(cache_dir, autoupdate.UPDATE_FILE)).AndReturn(
+            (self.sha1, self.sha256))
+    common_util.GetFileSize(
+        os.path.join(cache_dir, autoupdate.UPDATE_FILE)).AndReturn(self.size)
+    self.mox.ReplayAll()
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(au_mock.GenerateUpdateImageWithCache(
+            self.forced_image_path, self.static_image_dir, True)))
+               for _ in range(num_threads)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # The payload is generated aside and then moved into place.
+    self.assertEqual(len(generated), 1)
+    self.assertNotEqual(generated[0], cache_dir)
+    self.assertTrue(os.path.exists(
+        os.path.join(cache_dir, autoupdate.UPDATE_FILE)))
+    self.assertFalse(os.path.exists(generated[0]))
+    self.assertEqual(results, [cache_dir] * num_threads)
+    self.mox.VerifyAll()
+
+  def testGenerateUpdateImageWithCacheInBackground(self):
+    """Tests that a missing payload is queued for generation."""
+    self.mox.StubOutWithMock(autoupdate.Autoupdate,
+                             'FindCachedUpdateImageSubDir')
+    scheduler = self.mox.CreateMock(payload_jobs.PayloadJobScheduler)
+    au_mock = self._DummyAutoupdateConstructor(payload_scheduler=scheduler)
+    cache_dir = os.path.join(self.static_image_dir, 'cache', 'some_hash')
+    cache_update_payload = os.path.join(cache_dir, autoupdate.UPDATE_FILE)
+
+    au_mock.FindCachedUpdateImageSubDir(
+        '', self.forced_image_path, hash_files=False).AndReturn(cache_dir)
+    scheduler.GetJob(cache_update_payload).AndReturn(None)
+    scheduler.Submit(cache_update_payload, au_mock._GenerateCachedUpdateImage,
+                     self.forced_image_path, cache_dir, True)
+    self.mox.ReplayAll()
+
+    self.assertRaises(autoupdate.AutoupdateError,
+                      au_mock.GenerateUpdateImageWithCache,
+                      self.forced_image_path, self.static_image_dir, True)
+    self.mox.VerifyAll()
+
+  def testGenerateUpdateImageWithCacheHashesInBackground(self):
+    """Tests that images are hashed by a job, not by the update check."""
+    self.mox.StubOutWithMock(autoupdate.Autoupdate,
+                             'FindCachedUpdateImageSubDir')
+    scheduler = self.mox.CreateMock(payload_jobs.PayloadJobScheduler)
+    au_mock = self._DummyAutoupdateConstructor(payload_scheduler=scheduler)
+    cache_dir = os.path.join(self.static_image_dir, 'cache', 'some_hash')
+    cache_update_payload = os.path.join(cache_dir, autoupdate.UPDATE_FILE)
+
+    au_mock.FindCachedUpdateImageSubDir(
+        '', self.forced_image_path, hash_files=False).AndReturn(None)
+    scheduler.Submit(mox.IsA(str), au_mock._SubmitCachedUpdateImage,
+                     self.forced_image_path, self.static_image_dir, True)
+    # The job hashes the images, then queues the payload's generation.
+    au_mock.FindCachedUpdateImageSubDir(
+        '', self.forced_image_path).AndReturn(cache_dir)
+    scheduler.Submit(cache_update_payload, au_mock._GenerateCachedUpdateImage,
+                     self.forced_image_path, cache_dir, True)
+    self.mox.ReplayAll()
+
+    self.assertRaises(autoupdate.AutoupdateError,
+                      au_mock.GenerateUpdateImageWithCache,
+                      self.forced_image_path, self.static_image_dir, True)
+    au_mock._SubmitCachedUpdateImage(self.forced_image_path,
+                                     self.static_image_dir, True)
+    self.mox.VerifyAll()
+
+  def testFindCachedUpdateImageSubDirWithoutHashing(self):
+    """Tests that only MD5s already computed are used without hashing."""
+    image_path = os.path.join(self.static_image_dir, 'image.bin')
+    with open(image_path, 'w') as fh:
+      fh.write('image')
+    self.mox.StubOutWithMock(common_util, 'GetFileMd5')
+    common_util.GetFileMd5(image_path).AndReturn('abcde')
+    self.mox.ReplayAll()
+    au_mock = self._DummyAutoupdateConstructor()
+
+    self.assertEqual(au_mock.FindCachedUpdateImageSubDir(
+        None, image_path, hash_files=False), None)
+    update_dir = au_mock.FindCachedUpdateImageSubDir(None, image_path)
+    self.assertEqual(au_mock.FindCachedUpdateImageSubDir(
+        None, image_path, hash_files=False), update_dir)
+    self.mox.VerifyAll()
+
+  def _CreateImage(self, images_dir, version):
+    """Creates an image directory for version; returns the image path."""
+    image_dir = os.path.join(images_dir, version + '-a1')
+    os.makedirs(image_dir)
+    with open(os.path.join(image_dir, 'version.txt'), 'w') as fh:
+      fh.write('COREOS_VERSION=%s\n' % version)
+    image_path = os.path.join(image_dir, 'coreos_developer_image.bin')
+    with open(image_path, 'w') as fh:
+      fh.write(version)
+    return image_path
+
+  def testPreGenerateDeltas(self):
+    """Tests that deltas are made from the most common versions, and used."""
+    self.mox.StubOutWithMock(autoupdate.Autoupdate,
+                             'FindCachedUpdateImageSubDir')
+    scheduler = self.mox.CreateMock(payload_jobs.PayloadJobScheduler)
+    au_mock = self._DummyAutoupdateConstructor(
+        board=self.test_board, payload_scheduler=scheduler, delta_sources=2,
+        host_log=True)
+    images_dir = os.path.join(self.static_image_dir, 'images')
+    latest_image = self._CreateImage(images_dir, '3.0.0')
+    common_image = self._CreateImage(images_dir, '1.0.0')
+    rare_image = self._CreateImage(images_dir, '2.0.0')
+    self._CreateImage(images_dir, '0.5.0')
+    common_sub_dir = os.path.join('cache', 'common_latest')
+    rare_sub_dir = os.path.join('cache', 'rare_latest')
+    rare_payload = os.path.join(self.static_image_dir, rare_sub_dir,
+                                autoupdate.KERNEL_UPDATE_FILE)
+
+    # Hosts on the latest version, or one without an image, need no delta.
+    for host, version in (('h1', '1.0.0'), ('h2', '1.0.0'), ('h3', '1.0.0'),
+                          ('h4', '0.9.0'), ('h5', '0.9.0'), ('h6', '3.0.0'),
+                          ('h7', '3.0.0'), ('h8', '2.0.0'), ('h9', '2.0.0'),
+                          ('h10', '0.5.0')):
+      au_mock.host_infos.UpdateHostAttrs(host,
+                                         {'last_known_version': version})
+
+    au_mock._GetLatestImageDir(self.test_board).MultipleTimes().AndReturn(
+        os.path.dirname(latest_image))
+    au_mock.FindCachedUpdateImageSubDir(
+        common_image, latest_image).AndReturn(common_sub_dir)
+    au_mock.FindCachedUpdateImageSubDir(
+        rare_image, latest_image).AndReturn(rare_sub_dir)
+    scheduler.Submit(
+        os.path.join(self.static_image_dir, common_sub_dir,
+                     autoupdate.KERNEL_UPDATE_FILE),
+        au_mock._GenerateCachedUpdateImage, latest_image,
+        os.path.join(self.static_image_dir, common_sub_dir), False,
+        common_image)
+    self.mox.ReplayAll()
+
+    # The delta from 2.0.0 is already there.
+    os.makedirs(os.path.dirname(rare_payload))
+    with open(rare_payload, 'w') as fh:
+      fh.write('delta')
+
+    self.assertEqual(au_mock.PreGenerateDeltas(), ['1.0.0', '2.0.0'])
+    self.assertEqual(
+        au_mock.GenerateLatestUpdateImage(self.test_board, '2.0.0',
+                                          self.static_image_dir, False,
+                                          host_id='h8'),
+        rare_sub_dir)
+    # Legacy clients don't get deltas, and neither do those whose delta is
+    # still being generated, or who failed to update from their version.
+    au_mock.host_infos.AddLogEntry(
+        'h9', {'version': '2.0.0', 'event_type': 3,
+               'event_result': autoupdate.EVENT_RESULT_ERROR})
+    self.mox.StubOutWithMock(au_mock, 'GenerateUpdateImageWithCache')
+    au_mock.GenerateUpdateImageWithCache(
+        latest_image, static_image_dir=self.static_image_dir,
+        legacy_image=True).AndReturn(None)
+    for _ in range(2):
+      au_mock.GenerateUpdateImageWithCache(
+          latest_image, static_image_dir=self.static_image_dir,
+          legacy_image=False).AndReturn(None)
+    self.mox.ReplayAll()
+    self.assertEqual(
+        au_mock.GenerateLatestUpdateImage(self.test_board, '2.0.0',
+                                          self.static_image_dir, True), None)
+    self.assertEqual(
+        au_mock.GenerateLatestUpdateImage(self.test_board, '1.0.0',
+                                          self.static_image_dir, False), None)
+    self.assertEqual(
+        au_mock.GenerateLatestUpdateImage(self.test_board, '2.0.0',
+                                          self.static_image_dir, False,
+                                          host_id='h9'), None)
+    self.mox.VerifyAll()
+
   def testGenerateLatestUpdateImageWithForced(self):
     self.mox.StubOutWithMock(autoupdate.Autoupdate,
                              'GenerateUpdateImageWithCache')
@@ -125,10 +357,8 @@ class AutoupdateTest(mox.MoxTestBase):
     au_mock.GenerateUpdateImageWithCache(
         self.forced_image_path,
         static_image_dir=self.static_image_dir).AndReturn(None)
-    common_util.GetFileSha1(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha256)
+    common_util.GetFileSha1AndSha256(os.path.join(
+        self.static_image_dir, 'update.gz')).AndReturn((self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         self.static_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(self.static_image_dir,
@@ -156,10 +386,8 @@ class AutoupdateTest(mox.MoxTestBase):
 
     au_mock.GenerateLatestUpdateImage(
         self.test_board, 'ForcedUpdate', self.static_image_dir).AndReturn(None)
-    common_util.GetFileSha1(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha256)
+    common_util.GetFileSha1AndSha256(os.path.join(
+        self.static_image_dir, 'update.gz')).AndReturn((self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         self.static_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(self.static_image_dir,
@@ -179,6 +407,75 @@ class AutoupdateTest(mox.MoxTestBase):
                      self.test_dict['event_result'])
     self.mox.VerifyAll()
 
+  def testGetLocalPayloadAttrsCached(self):
+    """Tests that metadata of an unchanged payload is served from memory."""
+    au_mock = self._DummyAutoupdateConstructor()
+    update_gz = os.path.join(self.static_image_dir, autoupdate.UPDATE_FILE)
+    with open(update_gz, 'w') as fh:
+      fh.write('payload')
+
+    # The payload is only hashed once.
+    common_util.GetFileSha1AndSha256(update_gz).AndReturn(
+        (self.sha1, self.sha256))
+    common_util.GetFileSize(update_gz).AndReturn(self.size)
+
+    self.mox.ReplayAll()
+    for _ in range(3):
+      metadata_obj = au_mock.GetLocalPayloadAttrs(self.static_image_dir, True)
+      self.assertEqual(metadata_obj.sha1, self.sha1)
+      self.assertEqual(metadata_obj.size, self.size)
+    self.assertEqual(au_mock.payload_metadata_cache.GetStats(),
+                     {'entries': 1, 'max_entries': 64, 'hits': 2, 'misses': 1})
+
+    # Replacing the payload invalidates its entry.
+    os.remove(update_gz)
+    self.assertRaises(autoupdate.AutoupdateError,
+                      au_mock.GetLocalPayloadAttrs, self.static_image_dir, True)
+    with open(update_gz, 'w') as fh:
+      fh.write('new payload')
+    au_mock.GetLocalPayloadAttrs(self.static_image_dir, True)
+    self.assertEqual(au_mock.payload_metadata_cache.misses, 2)
+    self.mox.VerifyAll()
+
+  def testGetPayloadETag(self):
+    """Tests that ETags come from the metadata cache without counting."""
+    au_mock = self._DummyAutoupdateConstructor()
+    update_gz = os.path.join(self.static_image_dir, autoupdate.UPDATE_FILE)
+    with open(update_gz, 'w') as fh:
+      fh.write('payload')
+    sha256 = base64.b64encode('\x01' * 32)
+    common_util.GetFileSha1AndSha256(update_gz).AndReturn((self.sha1, sha256))
+    common_util.GetFileSize(update_gz).AndReturn(self.size)
+    self.mox.ReplayAll()
+
+    au_mock.GetLocalPayloadAttrs(self.static_image_dir, True)
+    link_dir = tempfile.mkdtemp('autoupdate_unittest')
+    try:
+      # Downloads may go through symlinks to the static directory.
+      link = os.path.join(link_dir, 'static')
+      os.symlink(self.static_image_dir, link)
+      link_path = os.path.join(link, autoupdate.UPDATE_FILE)
+      self.assertEqual(au_mock.GetPayloadETag(link_path, os.stat(link_path)),
+                       '01' * 32)
+    finally:
+      shutil.rmtree(link_dir)
+    stats = au_mock.payload_metadata_cache.GetStats()
+    self.assertEqual((stats['hits'], stats['misses']), (0, 1))
+    # After a restart, the same tag comes from the metadata file.
+    restarted = self._DummyAutoupdateConstructor()
+    self.assertEqual(restarted.GetPayloadETag(update_gz, os.stat(update_gz)),
+                     '01' * 32)
+    self.mox.VerifyAll()
+
+  def testPayloadMetadataCacheEviction(self):
+    cache = autoupdate.PayloadMetadataCache(max_entries=2)
+    file_stat = os.stat(self.static_image_dir)
+    for name in ('a', 'b', 'c'):
+      cache.Put(name, file_stat, name)
+    self.assertEqual(cache.Get('a', file_stat), None)
+    self.assertEqual(cache.Get('b', file_stat), 'b')
+    self.assertEqual(cache.Get('c', file_stat), 'c')
+
   def testChangeUrlPort(self):
     r = autoupdate._ChangeUrlPort('http://fuzzy:8080/static', 8085)
     self.assertEqual(r, 'http://fuzzy:8085/static')
@@ -192,6 +489,19 @@ class AutoupdateTest(mox.MoxTestBase):
     r = autoupdate._ChangeUrlPort('ftp://fuzzy', 8085)
     self.assertEqual(r, 'ftp://fuzzy:8085')
 
+  def testGetStaticUrl(self):
+    au_mock = self._DummyAutoupdateConstructor(proxy_port=8085)
+    self.mox.StubOutWithMock(autoupdate, '_ChangeUrlPort')
+    autoupdate._ChangeUrlPort('http://fuzzy:8080/static', 8085).AndReturn(
+        'http://fuzzy:8085/static')
+    self.mox.ReplayAll()
+
+    # The URL base is only worked out once per host.
+    for _ in range(2):
+      self.assertEqual(au_mock._GetStaticUrl('http://fuzzy:8080'),
+                       'http://fuzzy:8085/static')
+    self.mox.VerifyAll()
+
   def testHandleHostInfoPing(self):
     au_mock = self._DummyAutoupdateConstructor()
     self.assertRaises(AssertionError, au_mock.HandleHostInfoPing, None)
@@ -202,6 +512,153 @@ class AutoupdateTest(mox.MoxTestBase):
     self.assertEqual(
         json.loads(au_mock.HandleHostInfoPing(test_ip)), self.test_dict)
 
+  def testHostInfoTableEviction(self):
+    """Tests that the longest idle hosts and oldest log entries are dropped."""
+    table = autoupdate.HostInfoTable(max_hosts=2, max_log_entries=2,
+                                     num_shards=1)
+    for host_id in ('1.1.1.1', '2.2.2.2'):
+      table.GetInitHostInfo(host_id)
+    # Pinging the first host makes the second one the longest idle.
+    for version in ('1', '2', '3'):
+      table.GetInitHostInfo('1.1.1.1').AddLogEntry({'version': version})
+    table.GetInitHostInfo('3.3.3.3')
+
+    self.assertEqual([host_id for host_id, _ in table.GetHostInfos()],
+                     ['1.1.1.1', '3.3.3.3'])
+    log = table.GetHostInfo('1.1.1.1').GetLog()
+    self.assertEqual([entry['version'] for entry in log], ['2', '3'])
+    self.assertTrue('timestamp' in log[0])
+
+    stats = table.GetStats()
+    self.assertEqual(stats['hosts'], 2)
+    self.assertEqual(stats['evicted_hosts'], 1)
+    self.assertEqual(stats['log_entries'], 2)
+    self.assertTrue(stats['memory_bytes'] > 0)
+
+  def testHostInfoTableShards(self):
+    """Tests that hosts are bounded in total when spread over shards."""
+    table = autoupdate.HostInfoTable(max_hosts=10, num_shards=4)
+    for i in range(100):
+      table.GetInitHostInfo('1.1.1.%d' % i)
+    stats = table.GetStats()
+    self.assertEqual(stats['hosts'], 10)
+    self.assertEqual(stats['evicted_hosts'], 90)
+    self.assertTrue(table.GetHostInfo('1.1.1.99'))
+
+  def testHostInfoTableUnevenShards(self):
+    """Tests that hosts hashing to the same shard don't evict each other."""
+    table = autoupdate.HostInfoTable(max_hosts=32, num_shards=16)
+    table._GetShard = lambda host_id: table._shards[0]
+    for i in range(32):
+      table.GetInitHostInfo('1.1.1.%d' % i)
+    self.assertEqual(table.GetStats()['hosts'], 32)
+    self.assertEqual(table.GetStats()['evicted_hosts'], 0)
+    table.AddLogEntry('2.2.2.2', {'version': '2'})
+    self.assertEqual(table.GetStats()['hosts'], 32)
+    self.assertFalse(table.GetHostInfo('1.1.1.0'))
+    self.assertTrue(table.GetHostInfo('2.2.2.2'))
+
+  def testHostInfoTableSelection(self):
+    """Tests that logs and attributes are selected within the table."""
+    table = autoupdate.HostInfoTable()
+    for host_id, version in (('1.1.1.1', '1'), ('2.2.2.2', '1'),
+                             ('3.3.3.3', '2')):
+      table.UpdateHostAttrs(host_id, {'last_known_version': version})
+      table.AddLogEntry(host_id, {'version': version})
+    table.GetInitHostInfo('4.4.4.4')
+
+    self.assertEqual(table.GetAttrCounts('last_known_version'),
+                     {'1': 2, '2': 1})
+    last = table.GetLastLogSeq()
+    self.assertEqual(table.GetLastSelectedLogSeq(None, None, 2, None, last),
+                     last - 1)
+    host_logs = table.GetHostLogs(['3.3.3.3', '4.4.4.4', '5.5.5.5'], None,
+                                  None, last)
+    self.assertEqual([(host_id, [entry['version'] for entry in entries])
+                      for host_id, entries in host_logs],
+                     [('3.3.3.3', ['2'])])
+
+  def testUpdateHostAttrs(self):
+    """Tests that attributes are copied on write and popped exactly once."""
+    table = autoupdate.HostInfoTable()
+    table.UpdateHostAttrs('1.1.1.1', {'forced_update_label': 'label'})
+    snapshot = table.GetHostInfo('1.1.1.1').attrs
+
+    popped = []
+    def _Ping():
+      popped.append(table.UpdateHostAttrs(
+          '1.1.1.1', {'last_known_version': '1.0'},
+          pop_attr='forced_update_label'))
+    threads = [threading.Thread(target=_Ping) for _ in range(10)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(popped.count('label'), 1)
+    self.assertEqual(table.GetHostInfo('1.1.1.1').attrs,
+                     {'last_known_version': '1.0'})
+    self.assertEqual(snapshot, {'forced_update_label': 'label'})
+
+  def testHandleHostLogPing(self):
+    au_mock = self._DummyAutoupdateConstructor()
+    test_ip = '1.2.3.4'
+    au_mock.host_infos.AddLogEntry(
+        test_ip, {'version': 'ForcedUpdate', 'event_type': 3,
+                  'event_result': 2})
+
+    log = json.loads(''.join(au_mock.HandleHostLogPing(test_ip)))
+    self.assertEqual(len(log), 1)
+    self.assertEqual(log[0]['version'], 'ForcedUpdate')
+    self.assertEqual(log[0]['event_type'], 3)
+    self.assertFalse('previous_version' in log[0])
+    self.assertEqual(json.loads(''.join(au_mock.HandleHostLogPing('all'))),
+                     {test_ip: log})
+    self.assertEqual(
+        json.loads(''.join(au_mock.HandleHostLogPing('4.3.2.1'))), [])
+    self.assertEqual(
+        json.loads(au_mock.HandleHostInfoPing('stats'))['hosts'], 1)
+
+  def testHandleHostLogPingPaginated(self):
+    au_mock = self._DummyAutoupdateConstructor()
+    for version in range(5):
+      for test_ip in ('1.1.1.1', '2.2.2.2'):
+        au_mock.host_infos.AddLogEntry(
+            test_ip, {'version': '%s-%d' % (test_ip, version)})
+
+    # Tail the logs of all hosts, three events at a time.
+    versions = []
+    cursor = None
+    for expected_entries in (3, 3, 3, 1, 0):
+      logs = json.loads(''.join(au_mock.HandleHostLogPing(
+          'all', limit=3, cursor=cursor)))
+      page_versions = [entry['version']
+                       for log in logs.itervalues() for entry in log]
+      self.assertEqual(len(page_versions), expected_entries)
+      versions += page_versions
+      cursor = int(cherrypy.response.headers['X-Next-Cursor'])
+    self.assertEqual(sorted(versions),
+                     ['%s-%d' % (test_ip, version)
+                      for test_ip in ('1.1.1.1', '2.2.2.2')
+                      for version in range(5)])
+
+    # Nothing was logged in the future.
+    self.assertEqual(json.loads(''.join(au_mock.HandleHostLogPing(
+        '1.1.1.1', since=time.time() + 60))), [])
+
+  def testHandleHostLogPingSkipsEntriesBeingLogged(self):
+    """Tests that the cursor never passes an entry still being logged."""
+    au_mock = self._DummyAutoupdateConstructor()
+    au_mock.host_infos.AddLogEntry('1.1.1.1', {'version': 'logged'})
+    # An entry numbered but not yet added through the table.
+    au_mock.host_infos.GetInitHostInfo('2.2.2.2').AddLogEntry(
+        {'version': 'in flight'})
+
+    logs = json.loads(''.join(au_mock.HandleHostLogPing('all')))
+    self.assertEqual(logs.keys(), ['1.1.1.1'])
+    self.assertEqual(int(cherrypy.response.headers['X-Next-Cursor']),
+                     au_mock.host_infos.GetLastLogSeq())
+
   def testHandleSetUpdatePing(self):
     au_mock = self._DummyAutoupdateConstructor()
     test_ip = '1.2.3.4'
@@ -237,10 +694,8 @@ class AutoupdateTest(mox.MoxTestBase):
     with open(update_gz, 'w') as fh:
       fh.write('')
 
-    common_util.GetFileSha1(os.path.join(
-        new_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        new_image_dir, 'update.gz')).AndReturn(self.sha256)
+    common_util.GetFileSha1AndSha256(os.path.join(
+        new_image_dir, 'update.gz')).AndReturn((self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         new_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(new_image_dir,
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Micro-benchmarks for devserver hot paths.
+
+Usage:
+  benchmark.py hashing [--size_mb=2048] [--dir=/tmp]
+  benchmark.py cachekey [--size_mb=2048] [--dir=/tmp]
+  benchmark.py responses [--iterations=100000]
+"""
+
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+import autoupdate_lib
+import common_util
+
+
+# Block size used by the devserver before payload hashing was reworked.
+_LEGACY_HASH_BLOCK_SIZE = 8192
+
+
+def _Measure(func, *args, **kwargs):
+  """Runs func and returns the number of seconds it took."""
+  start = time.time()
+  func(*args, **kwargs)
+  return time.time() - start
+
+
+def _CreateSyntheticFile(dir_path, size_mb):
+  """Creates a file of size_mb MB of pseudo-random data, returns its path."""
+  chunk = os.urandom(1024 * 1024)
+  fd, file_path = tempfile.mkstemp(prefix='benchmark', dir=dir_path)
+  with os.fdopen(fd, 'wb') as f:
+    for _ in xrange(size_mb):
+      f.write(chunk)
+  return file_path
+
+
+def _LegacySha1AndSha256(file_path):
+  """Hashes a file the way payload metadata used to: two passes, 8KB reads."""
+  common_util.GetFileHashes(file_path, do_sha1=True,
+                            block_size=_LEGACY_HASH_BLOCK_SIZE)
+  common_util.GetFileHashes(file_path, do_sha256=True,
+                            block_size=_LEGACY_HASH_BLOCK_SIZE)
+
+
+def BenchmarkHashing(options):
+  """Compares SHA1+SHA256 payload hashing throughput, in MB/s."""
+  file_path = _CreateSyntheticFile(options.dir, options.size_mb)
+  try:
+    # Warm up the page cache so both runs measure hashing, not the disk.
+    common_util.GetFileHashes(file_path, do_md5=True)
+    for name, func in (('two-pass, 8KB reads', _LegacySha1AndSha256),
+                       ('single-pass, 1MB reads',
+                        common_util.GetFileSha1AndSha256)):
+      elapsed = _Measure(func, file_path)
+      print '%-28s %8.2fs %8.1f MB/s' % (name, elapsed,
+                                        options.size_mb / elapsed)
+  finally:
+    os.remove(file_path)
+
+
+def BenchmarkCacheKey(options):
+  """Compares serial and parallel MD5+SHA1+SHA256 hashing, in MB/s.
+
+  This is the work done the first time an image is used to derive a payload
+  cache directory.
+  """
+  file_path = _CreateSyntheticFile(options.dir, options.size_mb)
+  try:
+    common_util.GetFileHashes(file_path, do_md5=True)
+    for name, parallel in (('serial digests', False),
+                           ('parallel digests', True)):
+      elapsed = _Measure(common_util.GetFileHashes, file_path, do_sha1=True,
+                         do_sha256=True, do_md5=True, parallel=parallel)
+      print '%-28s %8.2fs %8.1f MB/s' % (name, elapsed,
+                                        options.size_mb / elapsed)
+  finally:
+    os.remove(file_path)
+
+
+def _RenderUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
+                          critical_update=False):
+  """Renders an update response from scratch, without compiled responses."""
+  # pylint: disable=W0212
+  response_values = autoupdate_lib._GetUpdateResponseValues(
+      sha1, sha256, size, url, is_delta_format, critical_update)
+  response_values.update(autoupdate_lib.GetCommonResponseValues())
+  return autoupdate_lib.GetSubstitutedResponse(
+      autoupdate_lib.UPDATE_RESPONSE, protocol, response_values)
+
+
+def BenchmarkResponses(options):
+  """Compares update response rendering rates, in responses/sec."""
+  args = ('kGcOinJ0vA8vdYX53FN0F5BdwfY=',
+          'Y2FmZWJhYmVjYWZlYmFiZWNhZmViYWJlY2FmZWJhYmU=', 123456789,
+          'http://devserver:8080/static/update.gz', False)
+  for protocol in ('2.0', '3.0'):
+    for name, func in (('rendered', _RenderUpdateResponse),
+                       ('compiled', autoupdate_lib.GetUpdateResponse)):
+      def _Run():
+        for _ in xrange(options.iterations):
+          func(*(args + (protocol,)))
+      elapsed = _Measure(_Run)
+      print 'protocol %s %-10s %12.0f responses/s' % (
+          protocol, name, options.iterations / elapsed)
+
+
+_BENCHMARKS = {
+    'cachekey': BenchmarkCacheKey,
+    'hashing': BenchmarkHashing,
+    'responses': BenchmarkResponses,
+}
+
+
+def main():
+  usage = 'usage: %%prog [options] {%s}' % '|'.join(sorted(_BENCHMARKS))
+  parser = optparse.OptionParser(usage=usage)
+  parser.add_option('--dir', default=tempfile.gettempdir(),
+                    help='directory to create synthetic payloads in')
+  parser.add_option('--iterations', default=100000, type='int',
+                    help='number of responses to render (default: 100000)')
+  parser.add_option('--size_mb', default=2048, type='int',
+                    help='size of the synthetic payload (default: 2048)')
+  options, args = parser.parse_args()
+  if len(args) != 1 or args[0] not in _BENCHMARKS:
+    parser.error('Expected exactly one benchmark name.')
+
+  _BENCHMARKS[args[0]](options)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
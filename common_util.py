@@ -8,11 +8,15 @@ import base64
 import binascii
 import distutils.version
 import errno
+import fcntl
 import hashlib
 import os
+import Queue
 import random
 import re
 import shutil
+import tempfile
+import threading
 import time
 
 import lockfile
@@ -32,7 +36,26 @@ MTON_DIR_SUFFIX = '_mton'
 UPLOADED_LIST = 'UPLOADED'
 DEVSERVER_LOCK_FILE = 'devserver'
 
-_HASH_BLOCK_SIZE = 8192
+# Default read size when hashing files. Payloads and images are typically
+# several GB, so large reads keep the number of syscalls and Python-level
+# hasher updates low.
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+# ioctl cloning a whole file into another, sharing its extents (Linux
+# FICLONE, formerly BTRFS_IOC_CLONE).
+_FICLONE = 0x40049409
+
+# Errors meaning a file can't be linked or cloned to a destination, and has to
+# be copied instead.
+_NO_SHARING_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL,
+                      errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS)
+
+# Files at least this large have multiple digests computed in parallel; below
+# that, the cost of starting threads outweighs the gain.
+_PARALLEL_HASH_MIN_SIZE = 32 * 1024 * 1024
+
+# Maximum number of blocks queued up for each hashing thread.
+_PARALLEL_HASH_QUEUE_DEPTH = 8
 
 
 def CommaSeparatedList(value_list, is_quoted=False):
@@ -57,6 +80,32 @@ class CommonUtilError(Exception):
   pass
 
 
+class LockDict(object):
+  """A dictionary of locks.
+
+  This class provides a thread-safe store of threading.Lock objects, which can
+  be used to regulate access to any set of hashable resources.  Usage:
+
+    foo_lock_dict = LockDict()
+    ...
+    with foo_lock_dict.lock('bar'):
+      # Critical section for 'bar'
+  """
+  def __init__(self):
+    self._lock = self._new_lock()
+    self._dict = {}
+
+  def _new_lock(self):
+    return threading.Lock()
+
+  def lock(self, key):
+    with self._lock:
+      lock = self._dict.get(key)
+      if not lock:
+        lock = self._new_lock()
+        self._dict[key] = lock
+      return lock
+
 
 def SafeSandboxAccess(static_dir, path):
   """Verify that the path is in static_dir.
@@ -257,45 +306,89 @@ def GetFileSize(file_path):
 
 # Hashlib is strange and doesn't actually define these in a sane way that
 # pylint can find them. Disable checks for them.
-# pylint: disable=E1101,W0106
-def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False):
+# pylint: disable=E1101
+def _HashBlocks(fd, hashers, block_size):
+  """Reads fd to the end, updating each of the hashers with every block."""
+  while True:
+    block = fd.read(block_size)
+    if not block:
+      break
+    for hasher in hashers:
+      hasher.update(block)
+
+
+def _HashBlocksInParallel(fd, hashers, block_size):
+  """Like _HashBlocks, but runs each hasher in a thread of its own.
+
+  The file is still read only once, by the calling thread, which hands every
+  block to all hashing threads. hashlib releases the GIL while digesting large
+  buffers, so the digests are computed concurrently.
+  """
+  def _UpdateHasher(hasher, block_queue):
+    for block in iter(block_queue.get, None):
+      hasher.update(block)
+
+  block_queues = [Queue.Queue(_PARALLEL_HASH_QUEUE_DEPTH) for _ in hashers]
+  threads = [threading.Thread(target=_UpdateHasher, args=args)
+             for args in zip(hashers, block_queues)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  try:
+    while True:
+      block = fd.read(block_size)
+      if not block:
+        break
+      for block_queue in block_queues:
+        block_queue.put(block)
+  finally:
+    for block_queue in block_queues:
+      block_queue.put(None)
+    for thread in threads:
+      thread.join()
+
+
+def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False,
+                  block_size=_HASH_BLOCK_SIZE, parallel=None):
   """Computes and returns a list of requested hashes.
 
+  All requested hashes are computed in a single pass over the file. When more
+  than one hash of a large file is requested, they are computed in parallel.
+
   Args:
-    file_path: path to file to be hashed
-    do_sha1:   whether or not to compute a SHA1 hash
-    do_sha256: whether or not to compute a SHA256 hash
-    do_md5:    whether or not to compute a MD5 hash
+    file_path:  path to file to be hashed
+    do_sha1:    whether or not to compute a SHA1 hash
+    do_sha256:  whether or not to compute a SHA256 hash
+    do_md5:     whether or not to compute a MD5 hash
+    block_size: number of bytes to read from the file at a time
+    parallel:   whether to compute multiple hashes in parallel; by default,
+                this is only done for large files
   Returns:
     A dictionary containing binary hash values, keyed by 'sha1', 'sha256' and
     'md5', respectively.
   """
-  hashes = {}
-  if (do_sha1 or do_sha256 or do_md5):
-    # Initialize hashers.
-    hasher_sha1 = hashlib.sha1() if do_sha1 else None
-    hasher_sha256 = hashlib.sha256() if do_sha256 else None
-    hasher_md5 = hashlib.md5() if do_md5 else None
-
-    # Read blocks from file, update hashes.
-    with open(file_path, 'rb') as fd:
-      while True:
-        block = fd.read(_HASH_BLOCK_SIZE)
-        if not block:
-          break
-        hasher_sha1 and hasher_sha1.update(block)
-        hasher_sha256 and hasher_sha256.update(block)
-        hasher_md5 and hasher_md5.update(block)
-
-    # Update return values.
-    if hasher_sha1:
-      hashes['sha1'] = hasher_sha1.digest()
-    if hasher_sha256:
-      hashes['sha256'] = hasher_sha256.digest()
-    if hasher_md5:
-      hashes['md5'] = hasher_md5.digest()
-
-  return hashes
+  # Initialize hashers.
+  hashers = {}
+  if do_sha1:
+    hashers['sha1'] = hashlib.sha1()
+  if do_sha256:
+    hashers['sha256'] = hashlib.sha256()
+  if do_md5:
+    hashers['md5'] = hashlib.md5()
+  if not hashers:
+    return {}
+
+  # Read blocks from file, update hashes.
+  with open(file_path, 'rb') as fd:
+    if parallel is None:
+      parallel = os.fstat(fd.fileno()).st_size >= _PARALLEL_HASH_MIN_SIZE
+    if parallel and len(hashers) > 1:
+      _HashBlocksInParallel(fd, hashers.values(), block_size)
+    else:
+      _HashBlocks(fd, hashers.values(), block_size)
+
+  return dict((name, hasher.digest()) for name, hasher in hashers.iteritems())
 
 
 def GetFileSha1(file_path):
@@ -308,6 +401,15 @@ def GetFileSha256(file_path):
   return base64.b64encode(GetFileHashes(file_path, do_sha256=True)['sha256'])
 
 
+def GetFileSha1AndSha256(file_path):
+  """Returns the SHA1 and SHA256 checksums of the file given (base64 encoded).
+
+  Both checksums are computed in a single pass over the file.
+  """
+  hashes = GetFileHashes(file_path, do_sha1=True, do_sha256=True)
+  return base64.b64encode(hashes['sha1']), base64.b64encode(hashes['sha256'])
+
+
 def GetFileMd5(file_path):
   """Returns the MD5 checksum of the file given (hex encoded)."""
   return binascii.hexlify(GetFileHashes(file_path, do_md5=True)['md5'])
@@ -317,3 +419,63 @@ def CopyFile(source, dest):
   """Copies a file from |source| to |dest|."""
   _Log('Copy File %s -> %s' % (source, dest))
   shutil.copy(source, dest)
+
+
+def _CloneFile(source, dest):
+  """Clones |source| to the existing, empty file |dest|, sharing its extents.
+
+  Raises:
+    IOError if the file system doesn't support it.
+  """
+  with open(source, 'rb') as source_file:
+    with open(dest, 'wb') as dest_file:
+      fcntl.ioctl(dest_file.fileno(), _FICLONE, source_file.fileno())
+
+
+def PublishFile(source, dest):
+  """Makes |dest| hold the contents of |source|, without copying if possible.
+
+  |dest| is replaced atomically, by a hard link to |source| if both are on the
+  same file system, by a reflink clone if the file system supports it, and by
+  a copy otherwise. Nothing is done if |dest| already is |source|. |source|
+  must not be modified in place afterwards, as it may share storage with
+  |dest|.
+
+  Returns:
+    How |dest| was published: 'unchanged', 'link', 'clone' or 'copy'.
+  """
+  try:
+    if os.path.samefile(source, dest):
+      return 'unchanged'
+  except OSError:
+    pass
+
+  dest_dir, dest_name = os.path.split(os.path.abspath(dest))
+  fd, temp_file = tempfile.mkstemp(prefix='.%s.' % dest_name, dir=dest_dir)
+  os.close(fd)
+  try:
+    method = 'link'
+    try:
+      # os.link() won't replace the temporary file; remove it first.
+      os.unlink(temp_file)
+      os.link(source, temp_file)
+    except OSError as e:
+      if e.errno not in _NO_SHARING_ERRNOS:
+        raise
+      method = 'clone'
+      try:
+        _CloneFile(source, temp_file)
+      except IOError as e:
+        if e.errno not in _NO_SHARING_ERRNOS:
+          raise
+        method = 'copy'
+        shutil.copyfile(source, temp_file)
+      shutil.copymode(source, temp_file)
+    os.rename(temp_file, dest)
+  finally:
+    # Only left behind on failure.
+    if os.path.lexists(temp_file):
+      os.unlink(temp_file)
+
+  _Log('Published %s -> %s (%s)', source, dest, method)
+  return method
@@ -6,6 +6,9 @@
 
 """Unit tests for common_util module."""
 
+import base64
+import errno
+import hashlib
 import os
 import shutil
 import subprocess
@@ -147,5 +150,57 @@ class CommonUtilTest(mox.MoxTestBase):
         os.path.join('server', 'site_tests', 'network_VPN', 'control'))
     self.assertEqual(control_content, 'hello!')
 
+  def testGetFileHashes(self):
+    """Tests that all digests match hashlib regardless of the block size."""
+    file_path = os.path.join(self._static_dir, 'payload')
+    data = os.urandom(100000)
+    with open(file_path, 'wb') as f:
+      f.write(data)
+
+    for parallel in (False, True):
+      for block_size in (7, 4096, 1024 * 1024):
+        hashes = common_util.GetFileHashes(file_path, do_sha1=True,
+                                           do_sha256=True, do_md5=True,
+                                           block_size=block_size,
+                                           parallel=parallel)
+        self.assertEqual(hashes['sha1'], hashlib.sha1(data).digest())
+        self.assertEqual(hashes['sha256'], hashlib.sha256(data).digest())
+        self.assertEqual(hashes['md5'], hashlib.md5(data).digest())
+
+    self.assertEqual(
+        common_util.GetFileSha1AndSha256(file_path),
+        (base64.b64encode(hashlib.sha1(data).digest()),
+         base64.b64encode(hashlib.sha256(data).digest())))
+    self.assertEqual(common_util.GetFileHashes(file_path), {})
+
+  def testPublishFile(self):
+    """Tests that files are linked when possible, and copied otherwise."""
+    source = os.path.join(self._static_dir, 'update.gz')
+    dest = os.path.join(self._install_dir, 'update.gz')
+    with open(source, 'w') as f:
+      f.write('payload')
+    with open(dest, 'w') as f:
+      f.write('old payload')
+
+    self.assertEqual(common_util.PublishFile(source, dest), 'link')
+    self.assertTrue(os.path.samefile(source, dest))
+    self.assertEqual(common_util.PublishFile(source, dest), 'unchanged')
+
+    self.mox.StubOutWithMock(os, 'link')
+    self.mox.StubOutWithMock(common_util, '_CloneFile')
+    os.link(source, mox.IgnoreArg()).AndRaise(
+        OSError(errno.EXDEV, 'cross-device link'))
+    common_util._CloneFile(source, mox.IgnoreArg()).AndRaise(
+        IOError(errno.EXDEV, 'cross-device clone'))
+    self.mox.ReplayAll()
+    dest = os.path.join(self._install_dir, 'copy.gz')
+    self.assertEqual(common_util.PublishFile(source, dest), 'copy')
+    self.assertFalse(os.path.samefile(source, dest))
+    with open(dest) as f:
+      self.assertEqual(f.read(), 'payload')
+    self.assertEqual(sorted(os.listdir(self._install_dir)),
+                     ['copy.gz', 'update.gz'])
+    self.mox.VerifyAll()
+
 if __name__ == '__main__':
   unittest.main()
@@ -7,21 +7,32 @@
 """A CherryPy-based webserver to host images and build packages."""
 
 import cherrypy
+from cherrypy.lib import cptools
+from cherrypy.process import plugins
 import json
 import logging
 import optparse
 import os
 import re
 import socket
+import sqlite3
 import sys
 import subprocess
 import tempfile
-import threading
 import types
 
+import async_frontend
 import autoupdate
 import common_util
+import hash_index
+import host_log_store
+import image_catalog
 import log_util
+import metrics
+import payload_cache
+import payload_jobs
+import payload_server
+import prefork
 
 
 # Module-local log function.
@@ -29,7 +40,8 @@ def _Log(message, *args):
   return log_util.LogWithTag('DEVSERVER', message, *args)
 
 
-CACHED_ENTRIES = 12
+# Seconds between updates of the set of delta payloads to pre-generate.
+DELTA_PREGENERATION_INTERVAL = 300
 
 # Sets up global to share between classes.
 updater = None
@@ -40,31 +52,24 @@ class DevServerError(Exception):
   pass
 
 
-class LockDict(object):
-  """A dictionary of locks.
+# Time spent in DevServerRoot handlers, recorded with --metrics.
+_REQUEST_SECONDS = metrics.Histogram(
+    'devserver_request_seconds', 'Time spent handling requests, by handler.',
+    label='handler')
 
-  This class provides a thread-safe store of threading.Lock objects, which can
-  be used to regulate access to any set of hashable resources.  Usage:
 
-    foo_lock_dict = LockDict()
-    ...
-    with foo_lock_dict.lock('bar'):
-      # Critical section for 'bar'
-  """
-  def __init__(self):
-    self._lock = self._new_lock()
-    self._dict = {}
+def _StartRequestTimer():
+  """Times the current request, until its response has been sent."""
+  request = cherrypy.serving.request
+  handler = getattr(request.handler, 'callable', None)
+  timer = _REQUEST_SECONDS.Time(getattr(handler, '__name__', 'unknown'))
+  timer.__enter__()
+  request.hooks.attach('on_end_request', lambda: timer.__exit__(None, None,
+                                                                 None))
 
-  def _new_lock(self):
-    return threading.Lock()
 
-  def lock(self, key):
-    with self._lock:
-      lock = self._dict.get(key)
-      if not lock:
-        lock = self._new_lock()
-        self._dict[key] = lock
-      return lock
+cherrypy.tools.request_timer = cherrypy.Tool('before_handler',
+                                             _StartRequestTimer)
 
 
 def _LeadingWhiteSpaceCount(string):
@@ -141,19 +146,91 @@ def _GetConfig(options):
                     'request.process_request_body': False,
                     'response.timeout': 10000,
                   },
-                  # Sets up the static dir for file hosting.
+                  # File hosting from the static dir, see DevServerRoot.static.
                   '/static':
-                  { 'tools.staticdir.dir': 'static',
-                    'tools.staticdir.on': True,
+                  { 'response.stream': True,
                     'response.timeout': 10000,
                   },
                 }
   if options.production:
     base_config['global'].update({'server.thread_pool': 75})
+  if options.metrics:
+    base_config['global'].update({'tools.request_timer.on': True})
 
   return base_config
 
 
+def _CreateImageCatalog(scripts_dir):
+  """Returns a catalog of the images in the build root of the SDK.
+
+  Images are looked for where get_latest_image.sh looks for them.
+  """
+  build_root = os.environ.get(
+      'CHROMEOS_BUILD_ROOT', os.path.join(os.path.dirname(scripts_dir),
+                                          'build'))
+  return image_catalog.ImageCatalog(os.path.join(build_root, 'images'))
+
+
+def _OpenHashIndex(static_dir):
+  """Returns the persistent hash index of static_dir, or None if unavailable.
+
+  Hashes of images and payloads are kept across restarts, so that large files
+  are only hashed again when they change.
+  """
+  try:
+    return hash_index.HashIndex(
+        os.path.join(static_dir, hash_index.HASH_INDEX_FILE))
+  except sqlite3.Error as e:
+    _Log('Not using a persistent hash index: %s' % e)
+    return None
+
+
+def _CreateHostLogStore(options):
+  """Returns the host log store requested by options, or None.
+
+  Host update events are written to disk behind the requests recording them.
+  """
+  if not options.host_log_dir:
+    return None
+  return host_log_store.HostLogStore(options.host_log_dir,
+                                     options.host_log_entries)
+
+
+def _StartPayloadScheduler(options):
+  """Starts generating payloads in the background, if so requested.
+
+  Called once requests are about to be served; pre-generation always runs in
+  the foreground.
+  """
+  if options.payload_workers > 0:
+    updater.payload_scheduler = payload_jobs.PayloadJobScheduler(
+        options.payload_workers)
+
+
+def _PreGenerateDeltas():
+  try:
+    versions = updater.PreGenerateDeltas()
+  except (autoupdate.AutoupdateError, IOError, OSError) as e:
+    _Log('Failed to pre-generate delta payloads: %s', e)
+  else:
+    _Log('Delta payloads pre-generated from versions: %s',
+         ', '.join(versions) or 'none')
+
+
+def _StartDeltaPreGeneration(options):
+  """Periodically pre-generates delta payloads, if so requested."""
+  if options.delta_sources > 0:
+    plugins.Monitor(cherrypy.engine, _PreGenerateDeltas,
+                    frequency=DELTA_PREGENERATION_INTERVAL,
+                    name='DeltaPreGeneration').subscribe()
+
+
+def _StartAsyncLogging():
+  """Moves writing of log messages off request threads, until engine exit."""
+  log_util.StartAsyncWriter()
+  cherrypy.engine.subscribe('exit', log_util.StopAsyncWriter)
+
+
 def _PrepareToServeUpdatesOnly(image_dir, static_dir):
   """Sets up symlink to image_dir for serving purposes."""
   assert os.path.exists(image_dir), '%s must exist.' % image_dir
@@ -267,7 +344,7 @@ class ApiRoot(object):
     """Returns a JSON dictionary containing information about the given ip.
 
     Args:
-      ip: address of host whose info is requested
+      ip: address of host whose info is requested, or `stats'
     Returns:
       A JSON dictionary containing all or some of the following fields:
         last_event_type (int):        last update event type received
@@ -279,26 +356,107 @@ class ApiRoot(object):
       event type and status code definitions. If the ip does not exist an empty
       string is returned.
 
+      If ip is `stats', a JSON dictionary describing the host info table:
+        hosts (int):                    number of hosts with recorded info
+        max_hosts (int):                maximum number of hosts kept, beyond
+                                        which the longest idle are evicted
+        evicted_hosts (int):            number of hosts evicted so far
+        log_entries (int):              total number of host log entries
+        max_log_entries_per_host (int): maximum number of log entries per host
+        memory_bytes (int):             estimated memory used by the table
+
     Example URL:
       http://myhost/api/hostinfo?ip=192.168.1.5
+      http://myhost/api/hostinfo?ip=stats
     """
     return updater.HandleHostInfoPing(ip)
 
   @cherrypy.expose
-  def hostlog(self, ip):
+  def hostlog(self, ip, since=None, limit=None, cursor=None):
     """Returns a JSON object containing a log of host event.
 
     Args:
       ip: address of host whose event log is requested, or `all'
+      since: only return events recorded at or after this time (seconds since
+             the epoch)
+      limit: return at most this many events, oldest first
+      cursor: only return events recorded after the one with this sequence
+              number (`seq')
     Returns:
       A JSON encoded list (log) of dictionaries (events), each of which
-      containing a `timestamp' and other event fields, as described under
-      /api/hostinfo.
+      containing a `timestamp', a sequence number `seq' and other event fields,
+      as described under /api/hostinfo. If ip is `all', a JSON dictionary of
+      such logs keyed by host address, streamed one host at a time.
+
+      The X-Next-Cursor response header holds the sequence number to pass as
+      cursor in order to get the events that follow the returned ones.
 
     Example URL:
       http://myhost/api/hostlog?ip=192.168.1.5
+      http://myhost/api/hostlog?ip=all&cursor=1234&limit=1000
     """
-    return updater.HandleHostLogPing(ip)
+    try:
+      since = float(since) if since else None
+      limit = int(limit) if limit else None
+      cursor = int(cursor) if cursor else None
+    except ValueError as e:
+      raise cherrypy.HTTPError(400, 'Invalid hostlog parameter: %s' % e)
+    return updater.HandleHostLogPing(ip, since=since, limit=limit,
+                                     cursor=cursor)
+
+  # Logs of all hosts may be large, so send them out as they are encoded.
+  hostlog._cp_config = {'response.stream': True}
+
+  @cherrypy.expose
+  def cachestats(self):
+    """Returns a JSON dictionary of payload metadata cache statistics.
+
+    Returns:
+      A JSON dictionary containing the following fields:
+        entries (int):     number of payloads currently cached
+        max_entries (int): maximum number of payloads cached
+        hits (int):        update checks answered without reading the payload
+        misses (int):      update checks that read the payload or its metadata
+
+    Example URL:
+      http://myhost/api/cachestats
+    """
+    return updater.HandleCacheStatsPing()
+
+  @cherrypy.expose
+  def metrics(self):
+    """Returns request timings and cache statistics.
+
+    Returns:
+      The metrics in the Prometheus text exposition format. Timings are only
+      recorded when the devserver runs with --metrics; with several --workers,
+      each worker reports its own timings.
+
+    Example URL:
+      http://myhost/api/metrics
+    """
+    cherrypy.response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return metrics.Export()
+
+  @cherrypy.expose
+  def payloadjobs(self):
+    """Returns a JSON list of background payload generation jobs.
+
+    Returns:
+      A JSON encoded list of dictionaries, oldest first, each containing the
+      following fields:
+        key (string):      path of the payload being generated
+        status (string):   one of pending, running, done or failed
+        error (string):    why the job failed, if it did
+        submitted (float): time the job was submitted (seconds since epoch)
+        started (float):   time the job started running, if it did
+        finished (float):  time the job finished, if it did
+      The list is empty unless the devserver runs with --payload_workers.
+
+    Example URL:
+      http://myhost/api/payloadjobs
+    """
+    return updater.HandlePayloadJobsPing()
 
   @cherrypy.expose
   def setnextupdate(self, ip):
@@ -329,6 +487,9 @@ class ApiRoot(object):
         size (int):      the file size in bytes
         sha1 (string):   a base64 encoded SHA1 hash
         sha256 (string): a base64 encoded SHA256 hash
+      The response has an ETag derived from the file's stat, so that requests
+      with a matching If-None-Match get 304 Not Modified without the file
+      being hashed.
 
     Example URL:
       http://myhost/api/fileinfo/some/path/to/file
@@ -337,9 +498,12 @@ class ApiRoot(object):
     if not os.path.exists(file_path):
       raise DevServerError('file not found: %s' % file_path)
     try:
-      file_size = os.path.getsize(file_path)
-      file_sha1 = common_util.GetFileSha1(file_path)
-      file_sha256 = common_util.GetFileSha256(file_path)
+      file_stat = os.stat(file_path)
+      cherrypy.response.headers['ETag'] = '"%s"' % payload_server.GetStatETag(
+          file_stat)
+      cptools.validate_etags()
+      file_size = file_stat.st_size
+      file_sha1, file_sha256 = updater.GetFileSha1AndSha256(file_path)
     except os.error, e:
       raise DevServerError('failed to get info for file %s: %s' %
                            (file_path, str(e)))
@@ -364,7 +528,39 @@ class DevServerRoot(object):
 
   def __init__(self):
     self._builder = None
-    self._download_lock_dict = LockDict()
+    self._download_lock_dict = common_util.LockDict()
+    self._static_root = os.path.join(
+        os.path.dirname(os.path.abspath(sys.argv[0])), 'static')
+
+  @cherrypy.expose
+  def static(self, *path_args, **kwargs):  # pylint: disable=W0613
+    """Serves a file from the static directory.
+
+    Downloads can be resumed using a Range request, optionally conditional on
+    If-Range. The ETag of a payload whose hash is known is its hex SHA256.
+
+    Args:
+      path_args: path to the file inside the static directory
+      kwargs: query parameters, which are ignored
+    Returns:
+      The contents of the file, or the requested byte range of it.
+
+    Example URL:
+      http://myhost/static/archive/update.gz
+    """
+    file_path = os.path.normpath(os.path.join(self._static_root, *path_args))
+    if not file_path.startswith(self._static_root + os.sep):
+      raise cherrypy.HTTPError(403)
+    # Keep a cached payload from being evicted while it's being sent.
+    if updater.payload_cache:
+      entry_name = payload_cache.GetEntryName(
+          os.path.join(self._static_root, autoupdate.CACHE_DIR), file_path)
+      if entry_name:
+        updater.payload_cache.Acquire(entry_name)
+        cherrypy.request.hooks.attach(
+            'on_end_request',
+            lambda: updater.payload_cache.Release(entry_name))
+    return payload_server.ServeFile(file_path, updater.GetPayloadETag)
 
   @cherrypy.expose
   def build(self, board, pkg, **kwargs):
@@ -525,28 +721,6 @@ class DevServerRoot(object):
     return updater.HandleUpdatePing(data, label)
 
 
-def _CleanCache(cache_dir, wipe):
-  """Wipes any excess cached items in the cache_dir.
-
-  Args:
-    cache_dir: the directory we are wiping from.
-    wipe: If True, wipe all the contents -- not just the excess.
-  """
-  if wipe:
-    # Clear the cache and exit on error.
-    cmd = 'rm -rf %s/*' % cache_dir
-    if os.system(cmd) != 0:
-      _Log('Failed to clear the cache with %s' % cmd)
-      sys.exit(1)
-  else:
-    # Clear all but the last N cached updates
-    cmd = ('cd %s; ls -tr | head --lines=-%d | xargs rm -rf' %
-           (cache_dir, CACHED_ENTRIES))
-    if os.system(cmd) != 0:
-      _Log('Failed to clean up old delta cache files with %s' % cmd)
-      sys.exit(1)
-
-
 def main():
   devkey = "/usr/share/update_engine/update-payload-key.key.pem"
   devserver_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
@@ -559,14 +733,31 @@ def main():
   parser.add_option('--archive_dir',
                     metavar='PATH',
                     help='Enables serve-only mode. Serves archived builds only')
+  parser.add_option('--async_port',
+                    metavar='PORT', type='int',
+                    help='also answer /update and the host info and status '
+                    '/api calls on this port, from an event-driven front end '
+                    'suited to many idle keep-alive clients')
   parser.add_option('--board', default=_GetDefaultBoardID(scripts_dir),
                     help='when pre-generating update, board for latest image')
+  parser.add_option('--cache_size',
+                    metavar='MB', type='int',
+                    default=payload_cache.MAX_BYTES / (1024 * 1024),
+                    help='evict the least recently used cached updates once '
+                    'they take up more than MB megabytes (default: '
+                    '%default)')
   parser.add_option('--clear_cache',
                     action='store_true', default=False,
                     help='clear out all cached updates and exit')
   parser.add_option('--critical_update',
                     action='store_true', default=False,
                     help='present update payload as critical')
+  parser.add_option('--delta_sources',
+                    metavar='NUM', default=0, type='int',
+                    help='pre-generate delta payloads to the latest image from '
+                    'the NUM versions most reported by hosts, and serve them '
+                    'to clients running those versions; needs '
+                    '--payload_workers')
   parser.add_option('--data_dir',
                     metavar='PATH',
                     default=os.path.dirname(os.path.abspath(sys.argv[0])),
@@ -580,18 +771,47 @@ def main():
   parser.add_option('--host_log',
                     action='store_true', default=False,
                     help='record history of host update events (/api/hostlog)')
+  parser.add_option('--host_log_dir',
+                    metavar='PATH',
+                    help='persist the history of host update events to this '
+                    'directory and restore it on startup; implies --host_log')
+  parser.add_option('--host_log_entries',
+                    metavar='NUM', default=autoupdate.HOST_LOG_ENTRIES,
+                    type='int',
+                    help='number of most recent events to record per host '
+                    '(default: %default)')
   parser.add_option('--image',
                     metavar='FILE',
                     help='Force update using this image. Can only be used when '
                     'not in serve-only mode as it is used to generate a '
                     'payload.')
+  parser.add_option('--log_level',
+                    metavar='[TAG=]LEVEL,...', default='info',
+                    help='minimum level (debug, info, warning or error) of '
+                    'messages to log, by default or for messages with the '
+                    'given tag, e.g. "warning,UPDATE=debug" (default: '
+                    '%default)')
   parser.add_option('--logfile',
                     metavar='PATH',
                     help='log output to this file instead of stdout')
+  parser.add_option('--max_hosts',
+                    metavar='NUM', default=autoupdate.MAX_HOSTS, type='int',
+                    help='maximum number of hosts to keep information on; the '
+                    'longest idle hosts are forgotten first (default: '
+                    '%default)')
   parser.add_option('--max_updates',
                     metavar='NUM', default=-1, type='int',
                     help='maximum number of update checks handled positively '
                          '(default: unlimited)')
+  parser.add_option('--metrics',
+                    action='store_true', default=False,
+                    help='record request and update stage timings, exported '
+                    'at /api/metrics')
+  parser.add_option('--payload_workers',
+                    metavar='NUM', default=0, type='int',
+                    help='generate payloads in NUM background threads, '
+                    'answering update checks with no update until their '
+                    'payload is ready (default: generate during the request)')
   parser.add_option('-p', '--pregenerate_update',
                     action='store_true', default=False,
                     help='pre-generate update payload. Can only be used when '
@@ -624,8 +844,17 @@ def main():
   parser.add_option('-u', '--urlbase',
                     metavar='URL',
                     help='base URL for update images, other than the devserver')
+  parser.add_option('--workers',
+                    metavar='NUM', default=1, type='int',
+                    help='number of processes serving requests on the same '
+                    'port, sharing host and payload state (default: %default)')
   (options, _) = parser.parse_args()
 
+  try:
+    log_util.ConfigureLevels(options.log_level)
+  except ValueError as e:
+    parser.error(str(e))
+
   static_dir = os.path.realpath('%s/static' % options.data_dir)
   os.system('mkdir -p %s' % static_dir)
 
@@ -644,7 +873,8 @@ def main():
     static_dir = os.path.realpath(archive_dir)
     serve_only = True
 
-  cache_dir = os.path.join(static_dir, 'cache')
+  cache_dir = os.path.join(static_dir, autoupdate.CACHE_DIR)
+  cache = None
   # If our devserver is only supposed to serve payloads, we shouldn't be mucking
   # with the cache at all. If the devserver hadn't previously generated a cache
   # and is expected, the caller is using it wrong.
@@ -654,16 +884,56 @@ def main():
         options.image):
       parser.error('Incompatible flags detected for serve_only mode.')
 
-  elif os.path.exists(cache_dir):
-    _CleanCache(cache_dir, options.clear_cache)
   else:
-    os.makedirs(cache_dir)
+    cache = payload_cache.PayloadCache(cache_dir,
+                                       options.cache_size * 1024 * 1024)
+    if options.clear_cache:
+      cache.Clear()
 
   _Log('Using cache directory %s' % cache_dir)
   _Log('Data dir is %s' % options.data_dir)
   _Log('Source root is %s' % root_dir)
   _Log('Serving from %s' % static_dir)
 
+  if options.host_log_dir:
+    options.host_log = True
+
+  if options.async_port and options.workers > 1:
+    parser.error('--async_port cannot be used with several --workers.')
+
+  # Each worker would count updates separately.
+  if options.max_updates >= 0 and options.workers > 1:
+    parser.error('--max_updates cannot be used with several --workers.')
+
+  if options.delta_sources > 0:
+    if options.payload_workers <= 0:
+      parser.error('--delta_sources needs --payload_workers.')
+    if options.workers > 1:
+      parser.error('--delta_sources cannot be used with several --workers.')
+    if (serve_only or options.image or options.payload or
+        options.remote_payload):
+      parser.error('--delta_sources only applies to updates to the latest '
+                   'image.')
+
+  # With several workers, host info and payload metadata are kept in a state
+  # process shared by all workers, and created there.
+  log_store = None
+  if options.workers > 1:
+    prefork.RegisterSharedObject(
+        'HostInfoTable', lambda: autoupdate.HostInfoTable(
+            options.max_hosts, options.host_log_entries,
+            _CreateHostLogStore(options)))
+    prefork.RegisterSharedObject('PayloadMetadataCache',
+                                 autoupdate.PayloadMetadataCache)
+    # The state process is forked from this one, and takes over the cache
+    # already scanned here.
+    if cache:
+      prefork.RegisterSharedObject('PayloadCache', lambda: cache)
+  else:
+    log_store = _CreateHostLogStore(options)
+    if log_store:
+      cherrypy.engine.subscribe('stop', log_store.Close)
+
   # We allow global use here to share with cherrypy classes.
   # pylint: disable=W0603
   global updater
@@ -686,8 +956,26 @@ def main():
       remote_payload=options.remote_payload,
       max_updates=options.max_updates,
       host_log=options.host_log,
+      max_hosts=options.max_hosts,
+      host_log_entries=options.host_log_entries,
+      host_log_store=log_store,
+      delta_sources=options.delta_sources,
+      payload_cache=cache,
+      image_catalog=_CreateImageCatalog(scripts_dir),
+      hash_index=_OpenHashIndex(static_dir),
   )
 
+  if options.metrics:
+    metrics.Enable()
+  metrics.RegisterCollector(updater.GetMetrics)
+
+  # Place the forced payload once, rather than on every update check.
+  if options.payload and not (serve_only or options.remote_payload):
+    try:
+      updater.RegisterPayload(static_dir, legacy_image=True)
+    except autoupdate.AutoupdateError as e:
+      parser.error(str(e))
+
   if options.pregenerate_update:
     updater.PreGenerateUpdate()
 
@@ -702,7 +990,39 @@ def main():
       cherrypy.config.update({'log.error_file': options.logfile,
                               'log.access_file': options.logfile})
 
-    cherrypy.quickstart(DevServerRoot(), config=_GetConfig(options))
+    if options.workers > 1:
+      manager = prefork.StartSharedStateManager()
+
+      def _RunWorker():
+        # Neither threads nor database connections survive the fork.
+        updater.host_infos = manager.HostInfoTable()
+        updater.payload_metadata_cache = manager.PayloadMetadataCache()
+        if cache:
+          updater.payload_cache = manager.PayloadCache()
+        updater.hash_index = _OpenHashIndex(static_dir)
+        # Each worker has to read its own inotify events.
+        updater.image_catalog = _CreateImageCatalog(scripts_dir)
+        _StartAsyncLogging()
+        _StartPayloadScheduler(options)
+        prefork.Serve(DevServerRoot(), _GetConfig(options))
+
+      try:
+        prefork.RunWorkers(options.workers, _RunWorker)
+      finally:
+        # No CherryPy engine runs in the state process to close the store.
+        if options.host_log_dir:
+          manager.HostInfoTable().Close()
+        manager.shutdown()
+    else:
+      _StartAsyncLogging()
+      _StartPayloadScheduler(options)
+      _StartDeltaPreGeneration(options)
+      config = _GetConfig(options)
+      if options.async_port:
+        async_frontend.AsyncFrontEnd(
+            updater, config['global']['server.socket_host'],
+            options.async_port, options.port).Start()
+      cherrypy.quickstart(DevServerRoot(), config=config)
 
 
 if __name__ == '__main__':
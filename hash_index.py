@@ -0,0 +1,120 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Persistent index of file content hashes."""
+
+import base64
+import binascii
+import os
+import sqlite3
+import threading
+
+import common_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HASH_INDEX', message, *args)
+
+
+# Name of the index database, relative to the static directory.
+HASH_INDEX_FILE = '.hash_index.db'
+
+_HASH_NAMES = ('md5', 'sha1', 'sha256')
+
+
+def _GetStatKey(file_stat):
+  """Returns the part of a stat result that identifies a file's content."""
+  return (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+
+
+class HashIndex(object):
+  """A persistent, thread-safe index of file content hashes.
+
+  Hashes are stored in a sqlite database, indexed by the file's real path and
+  validated against its inode, mtime and size. Whenever a file has to be
+  hashed, all supported digests are computed in that same pass, so a file is
+  read at most once per change no matter which digests are asked for later,
+  including across devserver restarts.
+  """
+
+  def __init__(self, db_path):
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(db_path, check_same_thread=False)
+    with self._lock:
+      self._conn.execute(
+          'CREATE TABLE IF NOT EXISTS hashes ('
+          'path TEXT PRIMARY KEY, inode INTEGER, mtime REAL, size INTEGER, '
+          'md5 TEXT, sha1 TEXT, sha256 TEXT)')
+      self._conn.commit()
+
+  def _Lookup(self, file_path, file_stat):
+    """Returns a dictionary of hex digests if file_path is indexed and valid."""
+    with self._lock:
+      row = self._conn.execute(
+          'SELECT inode, mtime, size, md5, sha1, sha256 FROM hashes '
+          'WHERE path = ?', (file_path,)).fetchone()
+    if row and tuple(row[:3]) == _GetStatKey(file_stat):
+      return dict(zip(_HASH_NAMES, row[3:]))
+
+  def _Store(self, file_path, file_stat, hex_hashes):
+    """Records the hex digests of file_path."""
+    with self._lock:
+      self._conn.execute(
+          'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+          (file_path,) + _GetStatKey(file_stat) +
+          tuple(hex_hashes[name] for name in _HASH_NAMES))
+      self._conn.commit()
+
+  def LookupFileHashes(self, file_path, file_stat):
+    """Returns the binary hashes of a file if indexed, without hashing it.
+
+    Args:
+      file_path: path to the file
+      file_stat: stat result of the file
+    Returns:
+      A dictionary like the one returned by GetFileHashes(), or None if the
+      file isn't indexed or has changed since.
+    """
+    hex_hashes = self._Lookup(os.path.realpath(file_path), file_stat)
+    if hex_hashes:
+      return dict((name, binascii.unhexlify(value))
+                  for name, value in hex_hashes.iteritems())
+
+  def GetFileHashes(self, file_path):
+    """Returns the binary MD5, SHA1 and SHA256 hashes of a file.
+
+    Args:
+      file_path: path to file to be hashed
+    Returns:
+      A dictionary containing binary hash values, keyed by 'sha1', 'sha256' and
+      'md5', respectively.
+    Raises:
+      OSError or IOError if the file cannot be read.
+    """
+    file_path = os.path.realpath(file_path)
+    file_stat = os.stat(file_path)
+    hashes = self.LookupFileHashes(file_path, file_stat)
+    if hashes:
+      return hashes
+
+    _Log('Hashing %s', file_path)
+    hashes = common_util.GetFileHashes(file_path, do_sha1=True, do_sha256=True,
+                                       do_md5=True)
+    # Don't record hashes of a file that was modified while we were reading it.
+    if _GetStatKey(os.stat(file_path)) == _GetStatKey(file_stat):
+      self._Store(file_path, file_stat,
+                  dict((name, binascii.hexlify(value))
+                       for name, value in hashes.iteritems()))
+    return hashes
+
+  def GetFileSha1AndSha256(self, file_path):
+    """Returns the SHA1 and SHA256 checksums of a file (base64 encoded)."""
+    hashes = self.GetFileHashes(file_path)
+    return base64.b64encode(hashes['sha1']), base64.b64encode(hashes['sha256'])
+
+  def GetFileMd5(self, file_path):
+    """Returns the MD5 checksum of a file (hex encoded)."""
+    return binascii.hexlify(self.GetFileHashes(file_path)['md5'])
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for hash_index module."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+import common_util
+import hash_index
+
+
+class HashIndexTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._static_dir = tempfile.mkdtemp('hash_index_unittest')
+    self._db_path = os.path.join(self._static_dir, hash_index.HASH_INDEX_FILE)
+    self._file_path = os.path.join(self._static_dir, 'image.bin')
+    self._WriteFile('image contents')
+
+  def tearDown(self):
+    shutil.rmtree(self._static_dir)
+
+  def _WriteFile(self, data):
+    with open(self._file_path, 'w') as f:
+      f.write(data)
+
+  def testHashesComputedOnce(self):
+    """Tests that a file is hashed once, even across index instances."""
+    self.mox.StubOutWithMock(common_util, 'GetFileHashes')
+    common_util.GetFileHashes(
+        self._file_path, do_sha1=True, do_sha256=True, do_md5=True).AndReturn(
+            {'md5': 'md5-digest', 'sha1': 'sha1-digest',
+             'sha256': 'sha256-digest'})
+    self.mox.ReplayAll()
+
+    index = hash_index.HashIndex(self._db_path)
+    self.assertEqual(index.GetFileMd5(self._file_path),
+                     'md5-digest'.encode('hex'))
+    self.assertEqual(index.GetFileSha1AndSha256(self._file_path),
+                     ('sha1-digest'.encode('base64').strip(),
+                      'sha256-digest'.encode('base64').strip()))
+
+    # A new index backed by the same database doesn't rehash the file.
+    index = hash_index.HashIndex(self._db_path)
+    self.assertEqual(index.GetFileHashes(self._file_path)['sha256'],
+                     'sha256-digest')
+    self.mox.VerifyAll()
+
+  def testChangedFileIsRehashed(self):
+    index = hash_index.HashIndex(self._db_path)
+    self.assertEqual(index.GetFileMd5(self._file_path),
+                     hashlib.md5('image contents').hexdigest())
+
+    self._WriteFile('new image contents')
+    self.assertEqual(index.GetFileMd5(self._file_path),
+                     hashlib.md5('new image contents').hexdigest())
+
+  def testLookupFileHashes(self):
+    """Tests that looking up hashes never hashes the file."""
+    index = hash_index.HashIndex(self._db_path)
+    self.assertEqual(
+        index.LookupFileHashes(self._file_path, os.stat(self._file_path)),
+        None)
+
+    index.GetFileHashes(self._file_path)
+    self.assertEqual(
+        index.LookupFileHashes(self._file_path,
+                               os.stat(self._file_path))['sha256'],
+        hashlib.sha256('image contents').digest())
+
+  def testMissingFile(self):
+    index = hash_index.HashIndex(self._db_path)
+    self.assertRaises(OSError, index.GetFileMd5,
+                      os.path.join(self._static_dir, 'missing'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,216 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Durable, write-behind storage of host update event logs."""
+
+import collections
+import json
+import os
+import Queue
+import re
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HOST_LOG_STORE', message, *args)
+
+
+# Default interval, in seconds, at which queued entries are written and synced.
+FLUSH_INTERVAL = 1.0
+
+# Default size, in bytes, beyond which a new segment file is started.
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Default number of segment files beyond which old segments are compacted.
+MAX_SEGMENTS = 8
+
+# Maximum number of entries waiting to be written; any more are dropped.
+_MAX_QUEUED_ENTRIES = 100000
+
+_SEGMENT_FORMAT = 'hostlog.%08d.jsonl'
+_SEGMENT_RE = re.compile(r'^hostlog\.(\d{8})\.jsonl$')
+
+
+class HostLogStore(object):
+  """An append-only store of host log entries, written behind by a thread.
+
+  Entries are queued by Append() without ever blocking, and written out by a
+  background thread in batches, with a single write and fsync per flush
+  interval. Entries are stored as JSON lines in numbered segment files. Once
+  there are more than max_segments segments, the closed ones are compacted
+  into one, keeping only the newest max_entries_per_host entries of each host,
+  which is all that is ever replayed.
+
+  Members:
+    dropped: number of entries dropped because the write queue was full.
+  """
+
+  def __init__(self, log_dir, max_entries_per_host,
+               flush_interval=FLUSH_INTERVAL, segment_size=SEGMENT_SIZE,
+               max_segments=MAX_SEGMENTS):
+    self.dropped = 0
+    self._log_dir = log_dir
+    self._max_entries_per_host = max_entries_per_host
+    self._flush_interval = flush_interval
+    self._segment_size = segment_size
+    self._max_segments = max_segments
+    self._queue = Queue.Queue(_MAX_QUEUED_ENTRIES)
+
+    if not os.path.isdir(log_dir):
+      os.makedirs(log_dir)
+    # Never append to a segment written by a previous run, since its last
+    # line may be incomplete.
+    segments = self._GetSegmentIndices()
+    self._segment_index = segments[-1] + 1 if segments else 0
+    self._segment_file = None
+
+    self._writer = threading.Thread(target=self._WriteEntries)
+    self._writer.daemon = True
+    self._writer.start()
+
+  def _GetSegmentPath(self, index):
+    return os.path.join(self._log_dir, _SEGMENT_FORMAT % index)
+
+  def _GetSegmentIndices(self):
+    """Returns the indices of all segment files, in increasing order."""
+    matches = [_SEGMENT_RE.match(name) for name in os.listdir(self._log_dir)]
+    return sorted(int(match.group(1)) for match in matches if match)
+
+  def _ReadSegment(self, index):
+    """Yields the records in a segment, skipping any incomplete lines."""
+    with open(self._GetSegmentPath(index)) as segment_file:
+      for line in segment_file:
+        try:
+          yield json.loads(line)
+        except ValueError:
+          _Log('Skipping corrupt record in segment %d', index)
+
+  def _ReadSegments(self, indices):
+    """Yields the records in segments, skipping those stored twice.
+
+    A crash during compaction may leave the entries of the compacted segments
+    both in them and in the segment replacing them; records with a sequence
+    number no greater than one already read for their host are skipped.
+    """
+    last_seqs = {}
+    for index in indices:
+      for record in self._ReadSegment(index):
+        seq = record.get('seq')
+        if seq is not None:
+          if seq <= last_seqs.get(record['host'], 0):
+            continue
+          last_seqs[record['host']] = seq
+        yield record
+
+  def Replay(self):
+    """Yields (host_id, seq, timestamp, attrs) for all stored entries, oldest
+    first.
+
+    The sequence number is None for entries stored without one. Must be called
+    before any entries are appended.
+    """
+    for record in self._ReadSegments(self._GetSegmentIndices()):
+      host_id = record.pop('host')
+      seq = record.pop('seq', None)
+      timestamp = record.pop('timestamp')
+      yield host_id, seq, timestamp, record
+
+  def Append(self, host_id, seq, timestamp, attrs):
+    """Queues an entry to be written; never blocks."""
+    record = dict(attrs, host=host_id, seq=seq, timestamp=timestamp)
+    try:
+      self._queue.put_nowait(record)
+    except Queue.Full:
+      self.dropped += 1
+
+  def Flush(self):
+    """Blocks until all entries appended so far are written and synced."""
+    self._queue.join()
+
+  def Close(self):
+    """Writes out all pending entries and stops the writer thread."""
+    self._queue.put(None)
+    self._writer.join()
+
+  def _WriteEntries(self):
+    """Writer thread loop; writes batches of queued entries to disk."""
+    while True:
+      # Wait for an entry, then give others a chance to accumulate.
+      records = [self._queue.get()]
+      if records[0] is not None:
+        time.sleep(self._flush_interval)
+      while True:
+        try:
+          records.append(self._queue.get_nowait())
+        except Queue.Empty:
+          break
+
+      closing = None in records
+      try:
+        self._WriteBatch([record for record in records if record is not None])
+      except (IOError, OSError) as e:
+        _Log('Failed to write %d host log entries: %s', len(records), e)
+      finally:
+        for _ in records:
+          self._queue.task_done()
+
+      if closing:
+        if self._segment_file:
+          self._segment_file.close()
+        return
+
+  def _WriteBatch(self, records):
+    """Appends records to the current segment with a single write and sync."""
+    if not records:
+      return
+
+    if not self._segment_file:
+      self._segment_file = open(self._GetSegmentPath(self._segment_index), 'a')
+    self._segment_file.write(
+        ''.join(json.dumps(record) + '\n' for record in records))
+    self._segment_file.flush()
+    os.fsync(self._segment_file.fileno())
+
+    if self._segment_file.tell() >= self._segment_size:
+      self._segment_file.close()
+      self._segment_file = None
+      self._segment_index += 1
+      if len(self._GetSegmentIndices()) > self._max_segments:
+        self._Compact()
+
+  def _Compact(self):
+    """Merges all closed segments into one, dropping entries never replayed.
+
+    The merged segment replaces the newest closed one, so that replay order is
+    preserved; it is written to a temporary file and renamed into place. The
+    older segments are removed afterwards; if that is interrupted, their
+    entries are skipped when read again.
+    """
+    indices = [index for index in self._GetSegmentIndices()
+               if index < self._segment_index]
+    host_entries = collections.OrderedDict()
+    for record in self._ReadSegments(indices):
+      host_entries.setdefault(record['host'], collections.deque(
+          maxlen=self._max_entries_per_host)).append(record)
+    # Entries stored without a sequence number are older than all others.
+    records = sorted((record for entries in host_entries.itervalues()
+                      for record in entries),
+                     key=lambda record: (record.get('seq') or 0,
+                                         record['timestamp']))
+
+    compacted_path = self._GetSegmentPath(indices[-1])
+    temp_path = compacted_path + '.tmp'
+    with open(temp_path, 'w') as compacted_file:
+      compacted_file.write(
+          ''.join(json.dumps(record) + '\n' for record in records))
+      compacted_file.flush()
+      os.fsync(compacted_file.fileno())
+    os.rename(temp_path, compacted_path)
+    for index in indices[:-1]:
+      os.remove(self._GetSegmentPath(index))
+    _Log('Compacted %d segments into %d entries', len(indices), len(records))
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for host_log_store module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import autoupdate
+import host_log_store
+
+
+class HostLogStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self._log_dir = tempfile.mkdtemp('host_log_store_unittest')
+
+  def tearDown(self):
+    shutil.rmtree(self._log_dir)
+
+  def _CreateStore(self, **kwargs):
+    return host_log_store.HostLogStore(self._log_dir, 2, flush_interval=0,
+                                       **kwargs)
+
+  def testReplay(self):
+    """Tests that appended entries are replayed by a new store, in order."""
+    store = self._CreateStore()
+    store.Append('1.1.1.1', 1, 100, {'version': '1.0'})
+    store.Append('2.2.2.2', 2, 101, {'event_type': 3, 'event_result': 1})
+    store.Close()
+
+    store = self._CreateStore()
+    self.assertEqual(list(store.Replay()),
+                     [('1.1.1.1', 1, 100, {'version': '1.0'}),
+                      ('2.2.2.2', 2, 101,
+                       {'event_type': 3, 'event_result': 1})])
+    store.Close()
+
+  def testCorruptRecordSkipped(self):
+    store = self._CreateStore()
+    store.Append('1.1.1.1', 1, 100, {'version': '1.0'})
+    store.Close()
+    segment = os.path.join(self._log_dir, os.listdir(self._log_dir)[0])
+    with open(segment, 'a') as f:
+      f.write('{"host": "1.1.1.1", "time')
+
+    store = self._CreateStore()
+    self.assertEqual(list(store.Replay()),
+                     [('1.1.1.1', 1, 100, {'version': '1.0'})])
+    store.Close()
+
+  def testCompaction(self):
+    """Tests that old segments are merged, keeping recent entries per host."""
+    store = self._CreateStore(segment_size=1, max_segments=2)
+    seq = 0
+    for i in range(10):
+      for host_id in ('1.1.1.1', '2.2.2.2'):
+        seq += 1
+        # All within the same second, so only sequence numbers order them.
+        store.Append(host_id, seq, 100, {'version': str(i)})
+        store.Flush()
+    store.Close()
+    self.assertTrue(len(os.listdir(self._log_dir)) <= 3)
+
+    store = self._CreateStore()
+    replayed = list(store.Replay())
+    store.Close()
+    seqs = [replayed_seq for _, replayed_seq, _, _ in replayed]
+    self.assertEqual(seqs, sorted(seqs))
+    replayed = [(host_id, attrs['version'])
+                for host_id, _, _, attrs in replayed]
+    for host_id in ('1.1.1.1', '2.2.2.2'):
+      self.assertEqual([version for replayed_host_id, version in replayed
+                        if replayed_host_id == host_id][-2:], ['8', '9'])
+
+  def testInterruptedCompaction(self):
+    """Tests that entries left in a compacted segment are replayed once."""
+    store = self._CreateStore()
+    store.Append('1.1.1.1', 1, 100, {'version': '1.0'})
+    store.Append('2.2.2.2', 2, 100, {'version': '1.0'})
+    store.Close()
+    # The compacted copy of the first segment, followed by a new entry, as
+    # left by a crash before the first segment was removed.
+    segment = os.path.join(self._log_dir, os.listdir(self._log_dir)[0])
+    with open(segment) as f:
+      compacted = f.read()
+    with open(segment.replace('00000000', '00000001'), 'w') as f:
+      f.write(compacted + '{"host": "1.1.1.1", "seq": 3, "timestamp": 101}\n')
+
+    store = self._CreateStore()
+    self.assertEqual([(host_id, seq) for host_id, seq, _, _ in store.Replay()],
+                     [('1.1.1.1', 1), ('2.2.2.2', 2), ('1.1.1.1', 3)])
+    store.Close()
+
+  def testHostInfoTableReplay(self):
+    """Tests that a host info table persists and restores its logs."""
+    store = self._CreateStore()
+    table = autoupdate.HostInfoTable(max_log_entries=2, log_store=store)
+    for version in ('1.0', '2.0', '3.0'):
+      table.AddLogEntry('1.1.1.1', {'version': version})
+    store.Close()
+
+    store = self._CreateStore()
+    table = autoupdate.HostInfoTable(max_log_entries=2, log_store=store)
+    log = table.GetHostInfo('1.1.1.1').GetLog()
+    self.assertEqual([entry['version'] for entry in log], ['2.0', '3.0'])
+    # Sequence numbers survive the restart, and new entries follow them.
+    table.AddLogEntry('1.1.1.1', {'version': '4.0'})
+    self.assertEqual(
+        [entry['seq'] for entry in table.GetHostInfo('1.1.1.1').GetLog()],
+        [log[1]['seq'], log[1]['seq'] + 1])
+    store.Close()
+
+
+if __name__ == '__main__':
+  unittest.main()
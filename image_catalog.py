@@ -0,0 +1,270 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""In-memory catalog of the images built for each board.
+
+The image directories of a board are scanned once, and scanned again only
+after they change, as reported by inotify where available or noticed by
+polling their modification times otherwise. Finding the latest image of a
+board is then a dictionary lookup, rather than a run of get_latest_image.sh.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import struct
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('IMAGE_CATALOG', message, *args)
+
+
+# Seconds between checks for changes of a board's images, when inotify isn't
+# available.
+POLL_SECONDS = 10
+
+# Name of the file holding the version of an image.
+VERSION_FILE = 'version.txt'
+
+# Name of the link to a board's latest image maintained by the build scripts.
+LATEST_LINK = 'latest'
+
+# inotify(7) constants.
+_IN_CLOEXEC = 0o2000000
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_WATCH_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+               _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF)
+# Watch descriptor, mask, cookie and name length of an event.
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def ReadVersion(image_dir):
+  """Returns the COREOS_VERSION in the version file of image_dir, or None.
+
+  Raises:
+    IOError if the version file can't be read.
+  """
+  with open(os.path.join(image_dir, VERSION_FILE)) as ver_file:
+    for line in ver_file:
+      key, _, value = line.partition('=')
+      if key == 'COREOS_VERSION':
+        return value.strip().strip('"\'')
+  return None
+
+
+def _VersionKey(version):
+  """Returns a key ordering versions like Autoupdate._CanUpdate() does."""
+  return [int(i) for i in re.split('[^0-9]', version) if i]
+
+
+class _Inotify(object):
+  """A non-blocking inotify instance, through the C library.
+
+  Raises:
+    OSError or AttributeError on creation if inotify isn't available.
+  """
+
+  def __init__(self):
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    self._add_watch = libc.inotify_add_watch
+    self.fd = libc.inotify_init1(os.O_NONBLOCK | _IN_CLOEXEC)
+    if self.fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+
+  def AddWatch(self, path):
+    """Watches path for changes, returning its watch descriptor."""
+    wd = self._add_watch(self.fd, path, _WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    return wd
+
+  def ReadEvents(self):
+    """Returns the (watch descriptor, mask) of pending events, if any."""
+    events = []
+    while True:
+      try:
+        data = os.read(self.fd, 64 * 1024)
+      except OSError as e:
+        if e.errno == errno.EAGAIN:
+          return events
+        raise
+      offset = 0
+      while offset < len(data):
+        wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+        offset += _EVENT_HEADER.size + name_len
+        events.append((wd, mask))
+
+
+class _BoardImages(object):
+  """The images of a board, as of the last scan.
+
+  Members:
+    latest: (directory, version) of the latest image, or None.
+    versions: dictionary mapping image directories to versions.
+    watched: whether all the directories scanned are watched by inotify.
+    signature: modification times of the directories scanned, for polling.
+    checked: time of the last check for changes.
+  """
+
+  __slots__ = ('latest', 'versions', 'watched', 'signature', 'checked')
+
+  def __init__(self):
+    self.latest = None
+    self.versions = {}
+    self.watched = False
+    self.signature = None
+    self.checked = 0
+
+
+class ImageCatalog(object):
+  """Finds the images built for boards, in images_root/<board>/<image>.
+
+  Members:
+    scans: number of scans of board image directories so far.
+  """
+
+  def __init__(self, images_root, use_inotify=True, poll_seconds=POLL_SECONDS):
+    """Creates an empty catalog; boards are scanned when first looked up.
+
+    Args:
+      images_root: directory holding one directory of images per board.
+      use_inotify: whether to use inotify to learn of changes.
+      poll_seconds: seconds between checks for changes without inotify.
+    """
+    self.images_root = images_root
+    self._poll_seconds = poll_seconds
+    self._lock = threading.Lock()
+    self._boards = {}
+    # Boards by inotify watch descriptor.
+    self._watches = {}
+    self._inotify = None
+    self.scans = 0
+    if use_inotify:
+      try:
+        self._inotify = _Inotify()
+      except (AttributeError, OSError) as e:
+        _Log('inotify unavailable, polling for image changes: %s', e)
+
+  @staticmethod
+  def _GetSignature(board_dir):
+    """Returns the modification times of board_dir and of what's in it."""
+    try:
+      names = sorted(os.listdir(board_dir))
+    except OSError:
+      names = []
+    signature = []
+    for path in [board_dir] + [os.path.join(board_dir, name) for name in names]:
+      for file_path in (path, os.path.join(path, VERSION_FILE)):
+        try:
+          signature.append(os.stat(file_path).st_mtime)
+        except OSError:
+          signature.append(None)
+    return signature
+
+  def _Watch(self, board, path):
+    """Watches path for changes to board's images; returns whether it is."""
+    if not self._inotify:
+      return False
+    try:
+      self._watches[self._inotify.AddWatch(path)] = board
+      return True
+    except OSError as e:
+      _Log('Polling %s, which cannot be watched: %s', path, e)
+      return False
+
+  def _Scan(self, board):
+    """Returns the images of board as they are now, watching them if possible.
+
+    Directories are watched before being read, so that no change goes
+    unnoticed. The latest image is the target of the latest link if it has a
+    version, and the highest version otherwise.
+    """
+    self.scans += 1
+    board_dir = os.path.join(self.images_root, board)
+    images = _BoardImages()
+    images.watched = self._Watch(board, board_dir)
+    try:
+      names = os.listdir(board_dir)
+    except OSError:
+      names = []
+    for name in names:
+      image_dir = os.path.realpath(os.path.join(board_dir, name))
+      if name == LATEST_LINK or not os.path.isdir(image_dir):
+        continue
+      images.watched = self._Watch(board, image_dir) and images.watched
+      try:
+        version = ReadVersion(image_dir)
+      except IOError:
+        continue
+      if version:
+        images.versions[image_dir] = version
+
+    latest_dir = os.path.realpath(os.path.join(board_dir, LATEST_LINK))
+    if latest_dir in images.versions:
+      images.latest = (latest_dir, images.versions[latest_dir])
+    elif images.versions:
+      images.latest = max(images.versions.iteritems(),
+                          key=lambda item: (_VersionKey(item[1]), item[0]))
+    if not images.watched:
+      images.signature = self._GetSignature(board_dir)
+    images.checked = time.time()
+    return images
+
+  def _ProcessEvents(self):
+    """Forgets the images of boards that inotify reports changes to."""
+    for wd, mask in self._inotify.ReadEvents():
+      if mask & _IN_Q_OVERFLOW:
+        self._boards.clear()
+        continue
+      if mask & _IN_IGNORED:
+        board = self._watches.pop(wd, None)
+      else:
+        board = self._watches.get(wd)
+      self._boards.pop(board, None)
+
+  def _GetBoardImages(self, board):
+    """Returns the up-to-date images of board. Must hold the lock."""
+    if self._inotify:
+      self._ProcessEvents()
+    images = self._boards.get(board)
+    if images and not images.watched:
+      now = time.time()
+      if now - images.checked >= self._poll_seconds:
+        board_dir = os.path.join(self.images_root, board)
+        if self._GetSignature(board_dir) == images.signature:
+          images.checked = now
+        else:
+          images = None
+    if not images:
+      images = self._Scan(board)
+      self._boards[board] = images
+    return images
+
+  def GetLatestImage(self, board):
+    """Returns the directory and version of board's latest image, or None."""
+    with self._lock:
+      return self._GetBoardImages(board).latest
+
+  def GetImages(self, board):
+    """Returns a dictionary mapping board's image directories to versions."""
+    with self._lock:
+      return dict(self._GetBoardImages(board).versions)
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for image_catalog module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import image_catalog
+
+
+class ImageCatalogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.images_root = os.path.realpath(
+        tempfile.mkdtemp('image_catalog_unittest'))
+    self.board_dir = os.path.join(self.images_root, 'amd64-usr')
+    os.mkdir(self.board_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.images_root)
+
+  def _AddImage(self, name, version):
+    image_dir = os.path.join(self.board_dir, name)
+    os.mkdir(image_dir)
+    with open(os.path.join(image_dir, image_catalog.VERSION_FILE), 'w') as f:
+      f.write('COREOS_BUILD=1\nCOREOS_VERSION="%s"\n' % version)
+    return image_dir
+
+  def testLatestImageIsHighestVersion(self):
+    catalog = image_catalog.ImageCatalog(self.images_root, use_inotify=False)
+    self._AddImage('a', '9.0.0')
+    newest = self._AddImage('b', '10.0.0')
+    self.assertEqual(catalog.GetLatestImage('amd64-usr'), (newest, '10.0.0'))
+    self.assertEqual(catalog.GetLatestImage('other'), None)
+
+  def testGetImages(self):
+    catalog = image_catalog.ImageCatalog(self.images_root, use_inotify=False)
+    older = self._AddImage('a', '9.0.0')
+    newest = self._AddImage('b', '10.0.0')
+    self.assertEqual(catalog.GetImages('amd64-usr'),
+                     {older: '9.0.0', newest: '10.0.0'})
+    self.assertEqual(catalog.GetImages('other'), {})
+
+  def testLatestLinkIsFollowed(self):
+    catalog = image_catalog.ImageCatalog(self.images_root, use_inotify=False)
+    linked = self._AddImage('a', '9.0.0')
+    self._AddImage('b', '10.0.0')
+    os.symlink(linked, os.path.join(self.board_dir,
+                                    image_catalog.LATEST_LINK))
+    self.assertEqual(catalog.GetLatestImage('amd64-usr'), (linked, '9.0.0'))
+
+  def testPollingNoticesChanges(self):
+    catalog = image_catalog.ImageCatalog(self.images_root, use_inotify=False,
+                                         poll_seconds=0)
+    self._AddImage('a', '9.0.0')
+    catalog.GetLatestImage('amd64-usr')
+    catalog.GetLatestImage('amd64-usr')
+    self.assertEqual(catalog.scans, 1)
+    newest = self._AddImage('b', '10.0.0')
+    # Make sure the change shows even with coarse modification times.
+    os.utime(self.board_dir, (0, 0))
+    self.assertEqual(catalog.GetLatestImage('amd64-usr'), (newest, '10.0.0'))
+    self.assertEqual(catalog.scans, 2)
+
+  def testInotifyNoticesChanges(self):
+    catalog = image_catalog.ImageCatalog(self.images_root)
+    if not catalog._inotify:
+      self.skipTest('inotify is not available')
+    self._AddImage('a', '9.0.0')
+    catalog.GetLatestImage('amd64-usr')
+    catalog.GetLatestImage('amd64-usr')
+    self.assertEqual(catalog.scans, 1)
+    newest = self._AddImage('b', '10.0.0')
+    self.assertEqual(catalog.GetLatestImage('amd64-usr'), (newest, '10.0.0'))
+    self.assertEqual(catalog.scans, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,24 +2,211 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""Logging via CherryPy."""
+"""Logging via CherryPy.
 
+Messages are logged with a tag and a level, and dropped before being formatted
+if the level is below that configured for the tag. Once an asynchronous writer
+has been started, messages are formatted and written to the CherryPy logs by a
+background thread, so that logging never blocks a request on file I/O.
+"""
+
+import logging
+import Queue
 import re
+import threading
 
 import cherrypy
 
 
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+_LEVEL_NAMES = {'debug': DEBUG, 'info': INFO, 'warning': WARNING,
+                'error': ERROR}
+
+# Level of tags without a level of their own.
+_default_level = INFO
+
+# Levels of individual tags.
+_tag_levels = {}
+
+# The running AsyncLogWriter, if any.
+_writer = None
+
+# Maximum number of messages waiting to be written before new ones are dropped.
+MAX_QUEUED_MESSAGES = 10000
+
+
 class Loggable(object):
   """Provides a log method, with automatic log tag generation."""
   _CAMELCASE_RE = re.compile('(?<=.)([A-Z])')
 
-  def _Log(self, message, *args):
+  def _Log(self, message, *args, **kwargs):
     return LogWithTag(
         self._CAMELCASE_RE.sub(r'_\1', self.__class__.__name__).upper(),
-        message, *args)
+        message, *args, **kwargs)
+
+
+def SetLevel(level, tag=None):
+  """Sets the minimum level of messages logged for a tag, or by default."""
+  global _default_level  # pylint: disable=W0603
+  if tag is None:
+    _default_level = level
+  else:
+    _tag_levels[tag] = level
+  # Messages are filtered here; the CherryPy log must let them all through.
+  if level < cherrypy.log.error_log.level:
+    cherrypy.log.error_log.setLevel(level)
+
+
+def GetLevel(tag):
+  """Returns the minimum level of messages logged for a tag."""
+  return _tag_levels.get(tag, _default_level)
+
+
+def ConfigureLevels(spec):
+  """Sets log levels from a comma separated list of [TAG=]LEVEL entries.
+
+  For instance, 'warning,UPDATE=debug' logs debug messages tagged UPDATE, and
+  only warnings and errors otherwise.
+
+  Raises:
+    ValueError if spec is malformed or names an unknown level.
+  """
+  for entry in spec.split(','):
+    tag, _, level_name = entry.strip().rpartition('=')
+    level = _LEVEL_NAMES.get(level_name.lower())
+    if level is None:
+      raise ValueError('Unknown log level: %r' % level_name)
+    SetLevel(level, tag or None)
+
+
+def _Format(message, args):
+  # Messages without args are logged verbatim, so that they need no escaping.
+  return message % args if args else message
+
+
+def _Write(timestamp, tag, level, message, args):
+  # Written like cherrypy.log() does, but always to the global log: on request
+  # threads, cherrypy.log() picks the application's, whose level is its own.
+  cherrypy.log.error_log.log(level, ' '.join((timestamp, tag,
+                                              _Format(message, args))))
+
+
+def LogWithTag(tag, message, *args, **kwargs):
+  """Logs a message, formatted with args only if it is going to be written.
+
+  Args:
+    tag: tag of the message, usually naming the module logging it.
+    message: the message, a format string if args are given.
+    args: values formatted into message.
+    level: keyword argument, the level of the message; defaults to INFO.
+  """
+  level = kwargs.get('level', INFO)
+  if level < _tag_levels.get(tag, _default_level):
+    return
+  # Messages are stamped when logged, not when the writer gets to them.
+  timestamp = cherrypy.log.time()
+  if _writer:
+    _writer.Put(_Write, timestamp, tag, level, message, args)
+  else:
+    _Write(timestamp, tag, level, message, args)
+
+
+class _QueueHandler(logging.Handler):
+  """Hands records over to an AsyncLogWriter, to be emitted by handlers."""
+
+  def __init__(self, writer, handlers):
+    logging.Handler.__init__(self)
+    self._writer = writer
+    self.handlers = handlers
+
+  def _Emit(self, record):
+    for handler in self.handlers:
+      if record.levelno >= handler.level:
+        handler.handle(record)
+
+  def emit(self, record):
+    if self._writer.IsWriterThread():
+      self._Emit(record)
+    else:
+      self._writer.Put(self._Emit, record)
+
+
+class AsyncLogWriter(object):
+  """Writes log messages from a background thread.
+
+  Members:
+    dropped: number of messages dropped because the queue was full.
+  """
+
+  def __init__(self, max_queued=MAX_QUEUED_MESSAGES):
+    self._queue = Queue.Queue(max_queued)
+    self._thread = None
+    self._loggers = []
+    self._dropped_lock = threading.Lock()
+    self.dropped = 0
+
+  def Put(self, func, *args):
+    """Queues func(*args) to be called by the writer thread."""
+    try:
+      self._queue.put_nowait((func, args))
+    except Queue.Full:
+      with self._dropped_lock:
+        self.dropped += 1
+
+  def IsWriterThread(self):
+    return threading.current_thread() is self._thread
+
+  def _Run(self):
+    reported_dropped = 0
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      func, args = item
+      try:
+        func(*args)
+      except Exception:  # pylint: disable=W0703
+        # Like the logging module, never let a failed write stop logging.
+        pass
+      dropped = self.dropped
+      if dropped != reported_dropped and self._queue.empty():
+        _Write(cherrypy.log.time(), 'LOG', WARNING, '%d log messages dropped',
+               (dropped - reported_dropped,))
+        reported_dropped = dropped
+
+  def Start(self):
+    """Starts the writer thread and routes the CherryPy logs through it."""
+    for logger in (cherrypy.log.error_log, cherrypy.log.access_log):
+      self._loggers.append((logger, logger.handlers))
+      logger.handlers = [_QueueHandler(self, logger.handlers)]
+    self._thread = threading.Thread(target=self._Run, name='AsyncLogWriter')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Stop(self):
+    """Writes out queued messages, then stops the writer thread."""
+    self._queue.put(None)
+    self._thread.join()
+    for logger, handlers in self._loggers:
+      logger.handlers = handlers
+    self._loggers = []
+
+
+def StartAsyncWriter():
+  """Starts writing log messages from a background thread."""
+  global _writer  # pylint: disable=W0603
+  if not _writer:
+    _writer = AsyncLogWriter()
+    _writer.Start()
 
 
-def LogWithTag(tag, message, *args):
-  # CherryPy log doesn't seem to take any optional args, so we just handle
-  # args by formatting them into message.
-  return cherrypy.log(message % args, context=tag)
+def StopAsyncWriter():
+  """Writes out queued log messages and goes back to writing them directly."""
+  global _writer  # pylint: disable=W0603
+  if _writer:
+    writer, _writer = _writer, None
+    writer.Stop()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for log_util module."""
+
+import logging
+import threading
+import unittest
+
+import cherrypy
+
+import log_util
+
+
+class _RecordingHandler(logging.Handler):
+  """Records the messages and threads of the records it handles."""
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+    self.threads = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+    self.threads.append(threading.current_thread())
+
+
+class _FormatCounter(object):
+  """Counts how many times it is formatted into a message."""
+
+  def __init__(self):
+    self.count = 0
+
+  def __str__(self):
+    self.count += 1
+    return 'counter'
+
+
+class LogUtilTest(unittest.TestCase):
+
+  def setUp(self):
+    self._handler = _RecordingHandler()
+    self._saved_handlers = cherrypy.log.error_log.handlers
+    self._saved_cherrypy_level = cherrypy.log.error_log.level
+    cherrypy.log.error_log.handlers = [self._handler]
+    self._saved_levels = (log_util._default_level, dict(log_util._tag_levels))
+
+  def tearDown(self):
+    log_util.StopAsyncWriter()
+    cherrypy.log.error_log.handlers = self._saved_handlers
+    cherrypy.log.error_log.setLevel(self._saved_cherrypy_level)
+    log_util._default_level = self._saved_levels[0]
+    log_util._tag_levels.clear()
+    log_util._tag_levels.update(self._saved_levels[1])
+
+  def testLogWithTagFormatsMessage(self):
+    log_util.LogWithTag('TEST', 'value %d of %s', 1, 'x')
+    self.assertEqual(len(self._handler.messages), 1)
+    self.assertTrue(self._handler.messages[0].endswith('TEST value 1 of x'))
+
+  def testMessageWithoutArgsIsVerbatim(self):
+    log_util.LogWithTag('TEST', '<version="100%">')
+    self.assertTrue(self._handler.messages[0].endswith('<version="100%">'))
+
+  def testMessagesBelowLevelAreNotFormatted(self):
+    counter = _FormatCounter()
+    log_util.LogWithTag('TEST', 'skipped %s', counter, level=log_util.DEBUG)
+    self.assertEqual(counter.count, 0)
+    self.assertEqual(self._handler.messages, [])
+
+  def testConfigureLevels(self):
+    log_util.ConfigureLevels('warning,TEST=debug')
+    self.assertEqual(log_util.GetLevel('TEST'), log_util.DEBUG)
+    self.assertEqual(log_util.GetLevel('OTHER'), log_util.WARNING)
+    log_util.LogWithTag('TEST', 'shown', level=log_util.DEBUG)
+    log_util.LogWithTag('OTHER', 'hidden')
+    log_util.LogWithTag('OTHER', 'shown too', level=log_util.ERROR)
+    self.assertEqual(len(self._handler.messages), 2)
+    self.assertRaises(ValueError, log_util.ConfigureLevels, 'TEST=loud')
+
+  def testAsyncWriterFormatsAndWritesOffCallerThread(self):
+    log_util.StartAsyncWriter()
+    counter = _FormatCounter()
+    log_util.LogWithTag('TEST', 'async %s', counter)
+    cherrypy.log.error_log.info('direct')
+    log_util.StopAsyncWriter()
+
+    self.assertEqual(counter.count, 1)
+    self.assertEqual(len(self._handler.messages), 2)
+    self.assertTrue(self._handler.messages[0].endswith('TEST async counter'))
+    self.assertEqual(self._handler.messages[1], 'direct')
+    for thread in self._handler.threads:
+      self.assertNotEqual(thread, threading.current_thread())
+    # Handlers are restored once the writer stops.
+    self.assertEqual(cherrypy.log.error_log.handlers, [self._handler])
+
+  def testAsyncWriterDropsMessagesWhenFull(self):
+    writer = log_util.AsyncLogWriter(max_queued=1)
+    writer.Put(log_util._Write, 'now', 'TEST', log_util.INFO, 'first', ())
+    writer.Put(log_util._Write, 'now', 'TEST', log_util.INFO, 'second', ())
+    self.assertEqual(writer.dropped, 1)
+
+  def testAsyncWriterKeepsLogTime(self):
+    log_util.StartAsyncWriter()
+    saved_time = cherrypy.log.time
+    try:
+      cherrypy.log.time = lambda: '[logged]'
+      log_util.LogWithTag('TEST', 'stamped')
+      cherrypy.log.time = lambda: '[written]'
+      log_util.StopAsyncWriter()
+    finally:
+      cherrypy.log.time = saved_time
+    self.assertEqual(self._handler.messages, ['[logged] TEST stamped'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,155 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Request timing histograms, exported in the Prometheus text format."""
+
+import bisect
+import threading
+import time
+
+
+# Upper bounds, in seconds, of the default histogram buckets.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Content type of the exported metrics.
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Whether timers record anything; see Enable().
+_enabled = False
+
+_histograms = []
+_collectors = []
+
+
+def Enable():
+  """Makes timers record observations; until then, they cost next to nothing."""
+  global _enabled  # pylint: disable=W0603
+  _enabled = True
+
+
+def IsEnabled():
+  return _enabled
+
+
+class _NullTimer(object):
+  """A timer that records nothing, used while metrics are disabled."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+  """Observes the time spent in a with block into a histogram."""
+
+  __slots__ = ('_histogram', '_label_value', '_start')
+
+  def __init__(self, histogram, label_value):
+    self._histogram = histogram
+    self._label_value = label_value
+    self._start = None
+
+  def __enter__(self):
+    self._start = time.time()
+    return self
+
+  def __exit__(self, *_):
+    self._histogram.Observe(time.time() - self._start, self._label_value)
+    return False
+
+
+class Histogram(object):
+  """A histogram of durations, optionally split by the value of one label.
+
+  Histograms register themselves for export on creation, and are meant to be
+  created once, at module level.
+  """
+
+  def __init__(self, name, description, label=None, buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.description = description
+    self.label = label
+    self.buckets = tuple(buckets)
+    self._lock = threading.Lock()
+    # Per label value: a list of bucket counts, the last one for +Inf, the
+    # number of observations and their sum.
+    self._series = {}
+    _histograms.append(self)
+
+  def Observe(self, value, label_value=''):
+    """Records an observation, in seconds."""
+    with self._lock:
+      series = self._series.get(label_value)
+      if series is None:
+        series = self._series[label_value] = [[0] * (len(self.buckets) + 1),
+                                              0, 0.0]
+      series[0][bisect.bisect_left(self.buckets, value)] += 1
+      series[1] += 1
+      series[2] += value
+
+  def Time(self, label_value=''):
+    """Returns a context manager timing its block, if metrics are enabled."""
+    if not _enabled:
+      return _NULL_TIMER
+    return _Timer(self, label_value)
+
+  def _FormatLabels(self, label_value, extra=''):
+    labels = []
+    if self.label:
+      labels.append('%s="%s"' % (self.label, _EscapeLabelValue(label_value)))
+    if extra:
+      labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+  def Export(self):
+    """Returns the histogram in the Prometheus text format."""
+    lines = ['# HELP %s %s' % (self.name, self.description),
+             '# TYPE %s histogram' % self.name]
+    with self._lock:
+      series = sorted((label_value, (list(counts), count, total))
+                      for label_value, (counts, count, total)
+                      in self._series.iteritems())
+    for label_value, (counts, count, total) in series:
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+        cumulative += bucket_count
+        lines.append('%s_bucket%s %d' % (
+            self.name, self._FormatLabels(label_value, 'le="%s"' % bound),
+            cumulative))
+      lines.append('%s_sum%s %r' % (self.name, self._FormatLabels(label_value),
+                                    total))
+      lines.append('%s_count%s %d' % (self.name,
+                                      self._FormatLabels(label_value), count))
+    return '\n'.join(lines)
+
+
+def _EscapeLabelValue(value):
+  return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n',
+                                                                     r'\n')
+
+
+def RegisterCollector(collector):
+  """Registers a function returning values to export with the histograms.
+
+  Args:
+    collector: function returning a list of (name, type, description, value)
+               tuples, where type is 'counter' or 'gauge'.
+  """
+  _collectors.append(collector)
+
+
+def Export():
+  """Returns all histograms and collected values in the Prometheus format."""
+  sections = [histogram.Export() for histogram in _histograms]
+  for collector in _collectors:
+    for name, metric_type, description, value in collector():
+      sections.append('# HELP %s %s\n# TYPE %s %s\n%s %r' % (
+          name, description, name, metric_type, name, value))
+  return '\n'.join(sections) + '\n'
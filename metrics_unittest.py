@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for metrics module."""
+
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    self._saved = (metrics._enabled, list(metrics._histograms),
+                   list(metrics._collectors))
+
+  def tearDown(self):
+    metrics._enabled = self._saved[0]
+    metrics._histograms[:] = self._saved[1]
+    metrics._collectors[:] = self._saved[2]
+
+  def testObserveCountsCumulativeBuckets(self):
+    histogram = metrics.Histogram('test_seconds', 'Test.', buckets=(0.1, 1))
+    histogram.Observe(0.05)
+    histogram.Observe(0.1)
+    histogram.Observe(0.5)
+    histogram.Observe(5)
+    self.assertEqual(histogram.Export().splitlines(), [
+        '# HELP test_seconds Test.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        'test_seconds_sum 5.65',
+        'test_seconds_count 4'])
+
+  def testLabelValuesAreSeparateSeries(self):
+    histogram = metrics.Histogram('test_seconds', 'Test.', label='stage',
+                                  buckets=(1,))
+    histogram.Observe(0.5, 'parse')
+    histogram.Observe(2, 'render')
+    histogram.Observe(0.5, 'a"b')
+    lines = histogram.Export().splitlines()
+    self.assertTrue('test_seconds_bucket{stage="parse",le="1"} 1' in lines)
+    self.assertTrue('test_seconds_bucket{stage="render",le="1"} 0' in lines)
+    self.assertTrue('test_seconds_count{stage="render"} 1' in lines)
+    self.assertTrue(r'test_seconds_count{stage="a\"b"} 1' in lines)
+
+  def testTimeRecordsNothingWhenDisabled(self):
+    metrics._enabled = False
+    histogram = metrics.Histogram('test_seconds', 'Test.')
+    with histogram.Time():
+      pass
+    self.assertFalse('test_seconds_count' in histogram.Export())
+
+  def testTimeRecordsWhenEnabled(self):
+    metrics.Enable()
+    self.assertTrue(metrics.IsEnabled())
+    histogram = metrics.Histogram('test_seconds', 'Test.', label='stage')
+    with histogram.Time('parse'):
+      pass
+    self.assertTrue('test_seconds_count{stage="parse"} 1' in
+                    histogram.Export().splitlines())
+
+  def testExportIncludesCollectors(self):
+    metrics.Histogram('test_seconds', 'Test.')
+    metrics.RegisterCollector(
+        lambda: [('test_hits_total', 'counter', 'Hits.', 3)])
+    exported = metrics.Export()
+    self.assertTrue('# TYPE test_seconds histogram\n' in exported)
+    self.assertTrue('# HELP test_hits_total Hits.\n'
+                    '# TYPE test_hits_total counter\n'
+                    'test_hits_total 3\n' in exported)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,309 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Management of the directory of cached update payloads.
+
+Each entry of the cache is a subdirectory holding generated payloads and their
+metadata. Entries are generated in a temporary directory and published by
+renaming it into place, and evicted by renaming them out of the way before
+removing them, so that an entry is never seen half-written or half-removed,
+even after a crash. Entries are evicted least recently used first once the
+cache exceeds its size budget, except while they are in use.
+"""
+
+import collections
+import contextlib
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PAYLOAD_CACHE', message, *args)
+
+
+# Default maximum total size of the cache, in bytes.
+MAX_BYTES = 8 * 1024 * 1024 * 1024
+
+# Prefix of temporary directories, which are never entries.
+_TEMP_PREFIX = '.tmp-'
+
+# Prefix of the lock files of entries, which are never entries either.
+_LOCK_PREFIX = '.lock-'
+
+
+def _GetDirSize(path):
+  """Returns the total size of the files under path, in bytes."""
+  size = 0
+  for dir_path, _, file_names in os.walk(path):
+    for file_name in file_names:
+      try:
+        size += os.lstat(os.path.join(dir_path, file_name)).st_size
+      except OSError:
+        pass
+  return size
+
+
+def GetEntryName(cache_dir, path):
+  """Returns the name of the entry of cache_dir holding path, or None.
+
+  Args:
+    cache_dir: the cache directory.
+    path: normalized path of a file, which must be inside an entry, not
+          directly in cache_dir.
+  """
+  prefix = os.path.join(os.path.normpath(cache_dir), '')
+  if not path.startswith(prefix):
+    return None
+  name, sep, _ = path[len(prefix):].partition(os.sep)
+  if not sep or name.startswith((_TEMP_PREFIX, _LOCK_PREFIX)):
+    return None
+  return name
+
+
+def _MakeParentDir(final_dir):
+  parent_dir = os.path.dirname(final_dir)
+  try:
+    os.makedirs(parent_dir)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  return parent_dir
+
+
+def MakeTempDir(final_dir):
+  """Returns a new temporary directory to prepare final_dir in.
+
+  The directory is created next to final_dir, so that it can be renamed to it.
+  """
+  return tempfile.mkdtemp(prefix=_TEMP_PREFIX + os.path.basename(final_dir),
+                          dir=_MakeParentDir(final_dir))
+
+
+def _GetLockPath(final_dir):
+  parent_dir, name = os.path.split(final_dir)
+  return os.path.join(parent_dir, _LOCK_PREFIX + name)
+
+
+@contextlib.contextmanager
+def LockDir(final_dir, remove=False):
+  """Holds an exclusive lock on final_dir, across processes.
+
+  The lock is an flock() on a file next to final_dir, so it is released even
+  if its holder crashes. If the lock file is removed while waiting for it, it
+  is waited for again on the new file.
+
+  Args:
+    final_dir: directory to lock.
+    remove: whether to remove the lock file before releasing it, once
+            final_dir is gone.
+  """
+  _MakeParentDir(final_dir)
+  lock_path = _GetLockPath(final_dir)
+  while True:
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+      if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+        break
+    except OSError:
+      pass
+    os.close(fd)
+  try:
+    yield
+    if remove:
+      os.unlink(lock_path)
+  finally:
+    os.close(fd)
+
+
+def PublishDir(temp_dir, final_dir):
+  """Moves the contents of temp_dir to final_dir, atomically if it is new.
+
+  If final_dir already exists, files are moved into it one at a time, each
+  atomically, replacing files of the same name. temp_dir is left empty or
+  removed.
+  """
+  try:
+    os.rename(temp_dir, final_dir)
+    return
+  except OSError as e:
+    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+      raise
+  for file_name in os.listdir(temp_dir):
+    os.rename(os.path.join(temp_dir, file_name),
+              os.path.join(final_dir, file_name))
+
+
+class _Entry(object):
+  """Size, last access time and number of users of a cache entry."""
+
+  __slots__ = ('size', 'last_access', 'users')
+
+  def __init__(self, size, last_access):
+    self.size = size
+    self.last_access = last_access
+    self.users = 0
+
+
+class PayloadCache(object):
+  """Tracks the entries of a payload cache directory and evicts old ones."""
+
+  def __init__(self, cache_dir, max_bytes=MAX_BYTES):
+    """Scans cache_dir, removing leftovers of interrupted work.
+
+    Args:
+      cache_dir: directory holding one subdirectory per entry.
+      max_bytes: maximum total size of the entries, in bytes.
+    """
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    # Entries by name, least recently used first.
+    self._entries = collections.OrderedDict()
+    self._total_bytes = 0
+    self.evicted = 0
+
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    found = []
+    for name in os.listdir(cache_dir):
+      path = os.path.join(cache_dir, name)
+      if name.startswith(_TEMP_PREFIX):
+        _Log('Removing leftover %s', path)
+        shutil.rmtree(path, ignore_errors=True)
+      elif os.path.isdir(path):
+        found.append((os.stat(path).st_mtime, name))
+    for mtime, name in sorted(found):
+      entry = _Entry(_GetDirSize(os.path.join(cache_dir, name)), mtime)
+      self._entries[name] = entry
+      self._total_bytes += entry.size
+    self._Evict()
+
+  def _Remove(self, name):
+    """Removes an entry's directory, without ever leaving it half-removed.
+
+    The entry must have been dropped from the table beforehand. If it has
+    been acquired or published again since, its directory is kept and
+    accounted for again instead.
+    """
+    path = os.path.join(self.cache_dir, name)
+    temp_path = tempfile.mkdtemp(prefix=_TEMP_PREFIX + name,
+                                 dir=self.cache_dir)
+    with LockDir(path, remove=True):
+      with self._lock:
+        entry = self._entries.get(name)
+        if entry is None:
+          try:
+            os.rename(path, os.path.join(temp_path, name))
+          except OSError as e:
+            if e.errno != errno.ENOENT:
+              _Log('Failed to remove %s: %s', path, e)
+      if entry is not None:
+        _Log('Keeping %s, which is in use again', path)
+        size = _GetDirSize(path)
+        with self._lock:
+          if self._entries.get(name) is entry:
+            self._total_bytes += size - entry.size
+            entry.size = size
+    shutil.rmtree(temp_path, ignore_errors=True)
+
+  def _Evict(self):
+    """Evicts the least recently used entries not in use until within budget.
+    """
+    evicted = []
+    with self._lock:
+      for name, entry in self._entries.items():
+        if self._total_bytes <= self.max_bytes:
+          break
+        if entry.users:
+          continue
+        del self._entries[name]
+        self._total_bytes -= entry.size
+        evicted.append(name)
+      self.evicted += len(evicted)
+    for name in evicted:
+      _Log('Evicting %s', name)
+      self._Remove(name)
+
+  def _Touch(self, name):
+    """Marks an entry as just used, creating it if needed.
+
+    Must be called with the lock held.
+    """
+    entry = self._entries.pop(name, None)
+    if entry is None:
+      entry = _Entry(0, 0)
+    entry.last_access = time.time()
+    self._entries[name] = entry
+    return entry
+
+  def Acquire(self, name):
+    """Protects an entry, or one about to be published, from eviction."""
+    with self._lock:
+      self._Touch(name).users += 1
+
+  def Release(self, name):
+    """Ends a use started with Acquire()."""
+    with self._lock:
+      entry = self._entries.get(name)
+      if entry and entry.users:
+        entry.users -= 1
+        # Forget entries that were never published.
+        if (not entry.users and not entry.size and
+            not os.path.isdir(os.path.join(self.cache_dir, name))):
+          del self._entries[name]
+
+  def Touch(self, name):
+    """Marks an existing entry as just used."""
+    with self._lock:
+      if name in self._entries:
+        self._Touch(name)
+
+  def Publish(self, name, temp_dir):
+    """Makes the contents of temp_dir, from MakeTempDir(), part of an entry.
+
+    Then evicts other entries as needed to stay within budget.
+    """
+    PublishDir(temp_dir, os.path.join(self.cache_dir, name))
+    size = _GetDirSize(os.path.join(self.cache_dir, name))
+    with self._lock:
+      entry = self._Touch(name)
+      self._total_bytes += size - entry.size
+      entry.size = size
+    self._Evict()
+
+  def Clear(self):
+    """Removes all entries not in use."""
+    removed = []
+    with self._lock:
+      for name in os.listdir(self.cache_dir):
+        entry = self._entries.get(name)
+        if (name.startswith((_TEMP_PREFIX, _LOCK_PREFIX)) or
+            (entry and entry.users)):
+          continue
+        if entry:
+          del self._entries[name]
+          self._total_bytes -= entry.size
+        removed.append(name)
+    # Entries are locked for removal, which mustn't happen with the lock held.
+    for name in removed:
+      self._Remove(name)
+
+  def GetStats(self):
+    """Returns a dictionary describing the cache."""
+    with self._lock:
+      return {'entries': len(self._entries),
+              'bytes': self._total_bytes,
+              'max_bytes': self.max_bytes,
+              'in_use': sum(1 for entry in self._entries.itervalues()
+                            if entry.users),
+              'evicted': self.evicted}
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_cache module."""
+
+import fcntl
+import os
+import shutil
+import tempfile
+import unittest
+
+import payload_cache
+
+
+class PayloadCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp('payload_cache_unittest')
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+  def _Publish(self, cache, name, size):
+    """Publishes an entry holding a payload of size bytes."""
+    final_dir = os.path.join(self.cache_dir, name)
+    temp_dir = payload_cache.MakeTempDir(final_dir)
+    with open(os.path.join(temp_dir, 'update.gz'), 'w') as fh:
+      fh.write('x' * size)
+    cache.Publish(name, temp_dir)
+
+  def _Entries(self):
+    return sorted(os.listdir(self.cache_dir))
+
+  def testLeastRecentlyUsedIsEvicted(self):
+    cache = payload_cache.PayloadCache(self.cache_dir, max_bytes=25)
+    self._Publish(cache, 'a', 10)
+    self._Publish(cache, 'b', 10)
+    cache.Touch('a')
+    self._Publish(cache, 'c', 10)
+    self.assertEqual(self._Entries(), ['a', 'c'])
+    self.assertEqual(cache.GetStats()['bytes'], 20)
+    self.assertEqual(cache.evicted, 1)
+
+  def testEntriesInUseAreNotEvicted(self):
+    cache = payload_cache.PayloadCache(self.cache_dir, max_bytes=15)
+    self._Publish(cache, 'a', 10)
+    cache.Acquire('a')
+    cache.Acquire('b')
+    self._Publish(cache, 'b', 10)
+    # Over budget, but both entries are in use.
+    self.assertEqual(self._Entries(), ['a', 'b'])
+    cache.Release('a')
+    cache.Release('b')
+    self._Publish(cache, 'c', 10)
+    self.assertEqual(self._Entries(), ['c'])
+
+  def testEntryAcquiredWhileEvictedIsKept(self):
+    cache = payload_cache.PayloadCache(self.cache_dir, max_bytes=15)
+    self._Publish(cache, 'a', 10)
+    remove = cache._Remove
+    def _AcquireAndRemove(name):
+      # A request acquires the entry after it is dropped but before its
+      # directory is removed.
+      cache.Acquire(name)
+      remove(name)
+    cache._Remove = _AcquireAndRemove
+    self._Publish(cache, 'b', 10)
+    self.assertEqual(self._Entries(), ['a', 'b'])
+    self.assertEqual(cache.GetStats()['bytes'], 20)
+    cache._Remove = remove
+    cache.Release('a')
+    self._Publish(cache, 'c', 4)
+    # The entry acquired again counts as the most recently used one.
+    self.assertEqual(self._Entries(), ['a', 'c'])
+
+  def testUnpublishedEntryIsForgotten(self):
+    cache = payload_cache.PayloadCache(self.cache_dir)
+    cache.Acquire('a')
+    cache.Release('a')
+    self.assertEqual(cache.GetStats()['entries'], 0)
+
+  def testStartupRemovesLeftoversAndLoadsEntries(self):
+    leftover = payload_cache.MakeTempDir(os.path.join(self.cache_dir, 'a'))
+    os.mkdir(os.path.join(self.cache_dir, 'b'))
+    with open(os.path.join(self.cache_dir, 'b', 'update.gz'), 'w') as fh:
+      fh.write('x' * 10)
+    cache = payload_cache.PayloadCache(self.cache_dir)
+    self.assertFalse(os.path.exists(leftover))
+    self.assertEqual(cache.GetStats()['entries'], 1)
+    self.assertEqual(cache.GetStats()['bytes'], 10)
+    cache.Clear()
+    self.assertEqual(self._Entries(), [])
+
+  def testPublishDirIntoExistingDir(self):
+    final_dir = os.path.join(self.cache_dir, 'a')
+    os.mkdir(final_dir)
+    temp_dir = payload_cache.MakeTempDir(final_dir)
+    open(os.path.join(temp_dir, 'update.gz'), 'w').close()
+    payload_cache.PublishDir(temp_dir, final_dir)
+    self.assertEqual(os.listdir(final_dir), ['update.gz'])
+
+
+  def testGetEntryName(self):
+    def _GetEntryName(*parts):
+      return payload_cache.GetEntryName(
+          self.cache_dir, os.path.normpath(os.path.join(self.cache_dir,
+                                                        *parts)))
+    self.assertEqual(_GetEntryName('a', 'update.gz'), 'a')
+    self.assertEqual(_GetEntryName('a', 'b', 'update.gz'), 'a')
+    self.assertEqual(_GetEntryName('x', '..', 'a', 'update.gz'), 'a')
+    self.assertEqual(_GetEntryName('update.gz'), None)
+    self.assertEqual(_GetEntryName('..', 'a', 'update.gz'), None)
+    self.assertEqual(_GetEntryName('.tmp-a', 'update.gz'), None)
+    self.assertEqual(_GetEntryName('.lock-a'), None)
+
+  def testLockDir(self):
+    final_dir = os.path.join(self.cache_dir, 'a')
+    lock_path = os.path.join(self.cache_dir, '.lock-a')
+    with payload_cache.LockDir(final_dir, remove=True):
+      # Another open file, like one of another process, can't take the lock.
+      with open(lock_path) as lock_file:
+        self.assertRaises(IOError, fcntl.flock, lock_file,
+                          fcntl.LOCK_EX | fcntl.LOCK_NB)
+    self.assertFalse(os.path.exists(lock_path))
+
+
+if __name__ == '__main__':
+  unittest.main()
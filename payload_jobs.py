@@ -0,0 +1,144 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Background scheduling of update payload generation."""
+
+import collections
+import Queue
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PAYLOAD_JOBS', message, *args)
+
+
+# Number of finished jobs to keep around for status reporting.
+FINISHED_JOBS_KEPT = 100
+
+# Seconds to wait before retrying a job that failed.
+FAILED_JOB_RETRY_DELAY = 60
+
+
+class PayloadJob(object):
+  """A payload generation job and its state.
+
+  Members:
+    key:       unique job identifier, normally the path of the payload.
+    status:    one of PENDING, RUNNING, DONE or FAILED.
+    error:     description of the error a failed job ran into.
+    submitted: time the job was submitted.
+    started:   time the job started running.
+    finished:  time the job finished running.
+  """
+
+  PENDING = 'pending'
+  RUNNING = 'running'
+  DONE = 'done'
+  FAILED = 'failed'
+
+  def __init__(self, key, func, args):
+    self.key = key
+    self.func = func
+    self.args = args
+    self.status = self.PENDING
+    self.error = None
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+
+  def IsActive(self):
+    """Returns True if the job is waiting to run or running."""
+    return self.status in (self.PENDING, self.RUNNING)
+
+  def ToDict(self):
+    """Returns a JSON-serializable description of the job."""
+    return {'key': self.key,
+            'status': self.status,
+            'error': self.error,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished}
+
+
+class PayloadJobScheduler(object):
+  """Runs payload generation jobs on a bounded pool of worker threads.
+
+  Jobs are identified by a key. Submitting a job while another one with the
+  same key is active, or failed only recently, returns the existing job rather
+  than scheduling a new one.
+  """
+
+  def __init__(self, num_workers):
+    self._lock = threading.Lock()
+    # Jobs indexed by key, in submission order.
+    self._jobs = collections.OrderedDict()
+    self._queue = Queue.Queue()
+    for _ in range(num_workers):
+      worker = threading.Thread(target=self._RunJobs)
+      worker.daemon = True
+      worker.start()
+
+  def _RunJobs(self):
+    """Worker thread loop; runs queued jobs forever."""
+    while True:
+      job = self._queue.get()
+      with self._lock:
+        job.status = PayloadJob.RUNNING
+        job.started = time.time()
+
+      _Log('Running job %s', job.key)
+      try:
+        job.func(*job.args)
+      except Exception as e:
+        _Log('Job %s failed: %s', job.key, e)
+        status, error = PayloadJob.FAILED, str(e)
+      else:
+        status, error = PayloadJob.DONE, None
+
+      with self._lock:
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        self._PruneFinishedJobs()
+
+  def _PruneFinishedJobs(self):
+    """Forgets the oldest finished jobs. Must be called with the lock held."""
+    finished_keys = [key for key, job in self._jobs.iteritems()
+                     if not job.IsActive()]
+    for key in finished_keys[:-FINISHED_JOBS_KEPT]:
+      del self._jobs[key]
+
+  def Submit(self, key, func, *args):
+    """Schedules func(*args) to run in the background, unless already done.
+
+    Returns:
+      The PayloadJob for key.
+    """
+    with self._lock:
+      job = self._jobs.get(key)
+      if job and (job.IsActive() or
+                  (job.status == PayloadJob.FAILED and
+                   time.time() - job.finished < FAILED_JOB_RETRY_DELAY)):
+        return job
+
+      job = PayloadJob(key, func, args)
+      self._jobs.pop(key, None)
+      self._jobs[key] = job
+      self._queue.put(job)
+      _Log('Queued job %s', key)
+      return job
+
+  def GetJob(self, key):
+    """Returns the most recent PayloadJob for key, if any."""
+    with self._lock:
+      return self._jobs.get(key)
+
+  def GetJobs(self):
+    """Returns a list of descriptions of all known jobs, oldest first."""
+    with self._lock:
+      return [job.ToDict() for job in self._jobs.itervalues()]
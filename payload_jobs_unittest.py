@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_jobs module."""
+
+import threading
+import time
+import unittest
+
+import mox
+
+import payload_jobs
+
+
+class PayloadJobSchedulerTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._scheduler = payload_jobs.PayloadJobScheduler(2)
+    self._release = threading.Event()
+    self._finished = threading.Event()
+    self._calls = []
+
+  def _Generate(self, payload):
+    self._calls.append(payload)
+    self._release.wait()
+    try:
+      if payload == 'bad':
+        raise Exception('generation failed')
+    finally:
+      self._finished.set()
+
+  def _WaitForJob(self, key):
+    """Waits until the job for key is done running."""
+    self._finished.wait()
+    while self._scheduler.GetJob(key).IsActive():
+      time.sleep(0.01)
+
+  def testSubmitDeduplicatesActiveJobs(self):
+    job = self._scheduler.Submit('update.gz', self._Generate, 'update.gz')
+    self.assertTrue(job.IsActive())
+    self.assertTrue(
+        self._scheduler.Submit('update.gz', self._Generate, 'update.gz') is job)
+
+    self._release.set()
+    self._WaitForJob('update.gz')
+    self.assertEqual(job.status, payload_jobs.PayloadJob.DONE)
+    self.assertEqual(self._calls, ['update.gz'])
+    self.assertEqual([(j['key'], j['status'])
+                      for j in self._scheduler.GetJobs()],
+                     [('update.gz', 'done')])
+
+    # Finished jobs are run again when resubmitted.
+    self.assertFalse(
+        self._scheduler.Submit('update.gz', self._Generate, 'update.gz') is job)
+
+  def testFailedJobIsNotRetriedImmediately(self):
+    self._release.set()
+    job = self._scheduler.Submit('bad', self._Generate, 'bad')
+    self._WaitForJob('bad')
+    self.assertEqual(job.status, payload_jobs.PayloadJob.FAILED)
+    self.assertEqual(job.error, 'generation failed')
+    self.assertTrue(self._scheduler.Submit('bad', self._Generate, 'bad') is job)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,107 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Serving of payloads and other static files, with resumable downloads."""
+
+import mimetypes
+import os
+
+import cherrypy
+from cherrypy.lib import cptools
+from cherrypy.lib import httputil
+
+
+# Size of the chunks files are sent in.
+CHUNK_SIZE = 1024 * 1024
+
+
+def _ReadChunks(file_obj, length):
+  """Yields up to length bytes of file_obj in chunks, then closes it."""
+  try:
+    while length > 0:
+      chunk = file_obj.read(min(CHUNK_SIZE, length))
+      if not chunk:
+        break
+      length -= len(chunk)
+      yield chunk
+  finally:
+    file_obj.close()
+
+
+def GetStatETag(file_stat):
+  """Returns an entity tag identifying a file's content by its stat."""
+  return '%x-%x-%x' % (file_stat.st_ino, file_stat.st_size,
+                       int(file_stat.st_mtime * 1000000))
+
+
+def ServeFile(path, get_etag=None):
+  """Serves a file as the response to the current request.
+
+  Single byte ranges are honored, subject to any If-Range condition, so that
+  interrupted downloads can be resumed; requests for multiple ranges are
+  answered with the whole file. Conditional requests are answered with 304 or
+  412 as appropriate.
+
+  Args:
+    path: path of the file to serve.
+    get_etag: function of the file's path and stat result returning its
+              entity tag, or None if there is none; when missing or returning
+              None, a tag derived from the stat result is used. Either tag
+              is accepted in If-Range.
+  Returns:
+    The response body, as an iterable of strings.
+  Raises:
+    cherrypy.HTTPError(404) if path is not a readable file, or other
+    cherrypy.HTTPError or cherrypy.HTTPRedirect for failed preconditions.
+  """
+  request = cherrypy.serving.request
+  response = cherrypy.serving.response
+
+  try:
+    file_obj = open(path, 'rb')
+  except IOError:
+    raise cherrypy.NotFound()
+
+  try:
+    file_stat = os.fstat(file_obj.fileno())
+    size = file_stat.st_size
+    stat_etag = '"%s"' % GetStatETag(file_stat)
+    content_etag = get_etag and get_etag(path, file_stat)
+    etag = '"%s"' % content_etag if content_etag else stat_etag
+    last_modified = httputil.HTTPDate(file_stat.st_mtime)
+
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Type'] = (mimetypes.guess_type(path)[0] or
+                                        'application/octet-stream')
+    cptools.validate_etags()
+    cptools.validate_since()
+
+    # A range is only honored if the client's copy is still current. The
+    # stat tag identifies the file as well as its content tag does, and is
+    # what clients got while the content tag wasn't known yet.
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range not in (etag, stat_etag, last_modified):
+      range_header = None
+
+    ranges = httputil.get_ranges(range_header, size)
+    if ranges == []:
+      response.headers['Content-Range'] = 'bytes */%d' % size
+      raise cherrypy.HTTPError(416, 'Requested range not satisfiable')
+
+    start, stop = 0, size
+    if ranges and len(ranges) == 1:
+      start, stop = ranges[0]
+      response.status = 206
+      response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1,
+                                                               size)
+      file_obj.seek(start)
+    response.headers['Content-Length'] = stop - start
+  except Exception:
+    file_obj.close()
+    raise
+
+  return _ReadChunks(file_obj, stop - start)
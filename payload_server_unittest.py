@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_server module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cherrypy
+from cherrypy import _cprequest
+from cherrypy.lib import httputil
+
+import payload_server
+
+
+class PayloadServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._static_dir = tempfile.mkdtemp('payload_server_unittest')
+    self._file_path = os.path.join(self._static_dir, 'update.gz')
+    self._data = ''.join(chr(i % 256) for i in range(1000))
+    with open(self._file_path, 'w') as f:
+      f.write(self._data)
+
+  def tearDown(self):
+    shutil.rmtree(self._static_dir)
+
+  def _Serve(self, headers=None, get_etag=None):
+    """Serves the test file for a request with given headers.
+
+    Returns:
+      A tuple of the response and the body, as a string.
+    """
+    request = _cprequest.Request(httputil.Host('127.0.0.1', 80),
+                                 httputil.Host('127.0.0.1', 1111))
+    request.protocol = (1, 1)
+    request.headers = httputil.HeaderMap(headers or {})
+    response = _cprequest.Response()
+    cherrypy.serving.load(request, response)
+    return response, ''.join(payload_server.ServeFile(self._file_path,
+                                                      get_etag))
+
+  def testServeWholeFile(self):
+    response, body = self._Serve(get_etag=lambda path, file_stat: 'abc')
+    self.assertEqual(body, self._data)
+    self.assertEqual(response.headers['Content-Length'], 1000)
+    self.assertEqual(response.headers['ETag'], '"abc"')
+
+  def testServeRange(self):
+    response, body = self._Serve({'Range': 'bytes=100-199'})
+    self.assertEqual(response.status, 206)
+    self.assertEqual(body, self._data[100:200])
+    self.assertEqual(response.headers['Content-Range'], 'bytes 100-199/1000')
+
+    # The range is only honored while the file matches the If-Range tag.
+    etag = response.headers['ETag']
+    response, body = self._Serve({'Range': 'bytes=900-', 'If-Range': etag})
+    self.assertEqual(body, self._data[900:])
+    response, body = self._Serve({'Range': 'bytes=900-',
+                                  'If-Range': '"stale"'})
+    self.assertEqual(body, self._data)
+
+  def testServeRangeWithStatETag(self):
+    """Tests that a tag from before the content tag was known still works."""
+    response, _ = self._Serve()
+    stat_etag = response.headers['ETag']
+    response, body = self._Serve({'Range': 'bytes=900-',
+                                  'If-Range': stat_etag},
+                                 get_etag=lambda path, file_stat: 'abc')
+    self.assertEqual(response.headers['ETag'], '"abc"')
+    self.assertEqual(response.status, 206)
+    self.assertEqual(body, self._data[900:])
+
+  def testServeUnsatisfiableRange(self):
+    try:
+      self._Serve({'Range': 'bytes=2000-'})
+      self.fail('Expected HTTPError')
+    except cherrypy.HTTPError as e:
+      self.assertEqual(e.status, 416)
+
+  def testServeNotModified(self):
+    try:
+      self._Serve({'If-None-Match': '"abc"'},
+                  get_etag=lambda path, file_stat: 'abc')
+      self.fail('Expected HTTPRedirect')
+    except cherrypy.HTTPRedirect as e:
+      self.assertEqual(e.status, 304)
+
+  def testServeMissingFile(self):
+    os.remove(self._file_path)
+    self.assertRaises(cherrypy.NotFound, self._Serve)
+
+
+if __name__ == '__main__':
+  unittest.main()
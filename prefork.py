@@ -0,0 +1,186 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Running the devserver as several pre-forked worker processes.
+
+Each worker runs its own CherryPy engine and binds its own listening socket
+with SO_REUSEPORT, so that the kernel spreads incoming connections over the
+workers. State that must be consistent across workers is kept in a separate
+state process, and accessed through proxies over a local socket.
+"""
+
+import errno
+import os
+import signal
+import socket
+import time
+import traceback
+from multiprocessing import managers
+
+import cherrypy
+from cherrypy import _cpwsgi_server
+from cherrypy.process import servers
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PREFORK', message, *args)
+
+
+# Python 2 doesn't define SO_REUSEPORT; this is its value on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Minimum number of seconds between restarts of exited workers.
+RESTART_DELAY = 1
+
+
+class ReusePortServer(_cpwsgi_server.CPWSGIServer):
+  """A CherryPy HTTP server whose port may be shared with other processes."""
+
+  def bind(self, family, type, proto=0):
+    """Creates and binds the listening socket, allowing port reuse.
+
+    Mirrors the base class, less SSL support, which the devserver doesn't use.
+    """
+    # pylint: disable=W0622
+    self.socket = socket.socket(family, type, proto)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    if self.nodelay:
+      self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if (family == socket.AF_INET6 and
+        self.bind_addr[0] in ('::', '::0', '::0.0.0.0')):
+      self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    self.socket.bind(self.bind_addr)
+
+
+class SharedStateManager(managers.BaseManager):
+  """Serves objects shared by all workers from a separate process.
+
+  Objects are registered with RegisterSharedObject() and created in the state
+  process on first use; calling the method of the same name on a started
+  manager returns a proxy to the single shared instance.
+  """
+
+
+def RegisterSharedObject(name, factory):
+  """Registers an object to be shared through SharedStateManager.
+
+  Args:
+    name: name of the manager method returning a proxy to the object.
+    factory: function creating the object; called in the state process.
+  """
+  instances = []
+
+  def _GetInstance():
+    if not instances:
+      instances.append(factory())
+    return instances[0]
+
+  SharedStateManager.register(name, callable=_GetInstance)
+
+
+def _IgnoreStopSignals():
+  """Makes the calling process ignore SIGTERM and SIGINT."""
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def StartSharedStateManager():
+  """Starts the state process and returns its SharedStateManager."""
+  manager = SharedStateManager()
+  # Signals are handled by the supervisor, which shuts the manager down once
+  # the workers are gone; a signal to the whole process group mustn't kill
+  # the state process before then.
+  manager.start(_IgnoreStopSignals)
+  return manager
+
+
+def Serve(root, config):
+  """Serves the given CherryPy root on a port shared with other workers.
+
+  Like cherrypy.quickstart(), but without the check that the port is free and
+  without autoreload, which would restart the whole devserver in each worker.
+
+  Args:
+    root: root object of the application.
+    config: CherryPy configuration dictionary.
+  """
+  cherrypy.config.update(config)
+  cherrypy.tree.mount(root, '', config)
+  cherrypy.engine.autoreload.unsubscribe()
+
+  # Without a bind_addr, the adapter doesn't wait for the port to be free.
+  cherrypy.server.unsubscribe()
+  servers.ServerAdapter(cherrypy.engine,
+                        ReusePortServer(cherrypy.server)).subscribe()
+
+  cherrypy.engine.signals.subscribe()
+  cherrypy.engine.start()
+  cherrypy.engine.block()
+
+
+def RunWorkers(num_workers, run_worker):
+  """Runs run_worker in num_workers forked processes until interrupted.
+
+  Workers that exit are restarted. On SIGTERM or SIGINT, all workers are
+  terminated and waited for.
+
+  Args:
+    num_workers: number of worker processes.
+    run_worker: function run in each worker process.
+  """
+  workers = set()
+  stopping = []
+
+  def _StartWorker():
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.default_int_handler)
+      status = 1
+      try:
+        run_worker()
+        status = 0
+      except Exception:
+        _Log('Worker failed: %s', traceback.format_exc())
+      finally:
+        os._exit(status)
+    _Log('Started worker %d', pid)
+    workers.add(pid)
+
+  def _Stop(signum, _frame):
+    _Log('Stopping workers on signal %d', signum)
+    stopping.append(signum)
+    for pid in workers:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+  signal.signal(signal.SIGTERM, _Stop)
+  signal.signal(signal.SIGINT, _Stop)
+
+  for _ in range(num_workers):
+    _StartWorker()
+
+  last_restart = 0
+  while workers:
+    try:
+      pid, status = os.wait()
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+    if pid not in workers:
+      continue
+    workers.discard(pid)
+    if stopping:
+      continue
+    _Log('Worker %d exited with status %d, restarting', pid, status)
+    time.sleep(max(0, last_restart + RESTART_DELAY - time.time()))
+    last_restart = time.time()
+    _StartWorker()
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for prefork module."""
+
+import os
+import unittest
+
+import autoupdate
+import prefork
+
+
+class PreforkTest(unittest.TestCase):
+
+  def testSharedObject(self):
+    """Tests that forked processes see the same shared object."""
+    prefork.RegisterSharedObject('HostInfoTable', autoupdate.HostInfoTable)
+    manager = prefork.StartSharedStateManager()
+    try:
+      pid = os.fork()
+      if pid == 0:
+        manager.HostInfoTable().UpdateHostAttrs(
+            '1.1.1.1', {'forced_update_label': 'label'})
+        os._exit(0)
+      os.waitpid(pid, 0)
+
+      host_infos = manager.HostInfoTable()
+      self.assertEqual(
+          host_infos.UpdateHostAttrs('1.1.1.1', {},
+                                     pop_attr='forced_update_label'),
+          'label')
+      self.assertEqual(host_infos.GetHostInfo('1.1.1.1').attrs, {})
+    finally:
+      manager.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,257 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Caching of file information fetched from remote devservers.
+
+Information is fetched over kept-alive connections, kept for a while, and then
+revalidated in the background with the entity tag it was served with, while
+the stale copy keeps being used. Only when a copy has been stale for too long
+is a request held up by fetching it again.
+"""
+
+import collections
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+import common_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('REMOTE_FILEINFO', message, *args)
+
+
+# Seconds for which fetched information is used without revalidation.
+FRESH_SECONDS = 60
+
+# Seconds past freshness for which information is still used while being
+# revalidated in the background.
+MAX_STALE_SECONDS = 3600
+
+# Maximum number of URLs whose information is kept.
+MAX_ENTRIES = 256
+
+# Maximum number of idle connections kept per remote host.
+MAX_IDLE_CONNECTIONS = 4
+
+# Seconds to wait for remote devservers.
+TIMEOUT = 30
+
+
+class RemoteFileInfoError(IOError):
+  """Raised when information can't be fetched from a remote devserver."""
+
+
+class HTTPConnectionPool(object):
+  """Keeps connections to remote hosts alive across requests."""
+
+  def __init__(self, max_idle=MAX_IDLE_CONNECTIONS, timeout=TIMEOUT):
+    self._max_idle = max_idle
+    self._timeout = timeout
+    self._lock = threading.Lock()
+    # Idle connections by (scheme, host and port).
+    self._idle = collections.defaultdict(list)
+
+  def _GetConnection(self, key):
+    """Returns an idle connection to key, if any, and a new one otherwise.
+
+    Returns:
+      A tuple of the connection and whether it was used before.
+    """
+    with self._lock:
+      if self._idle[key]:
+        return self._idle[key].pop(), True
+    scheme, netloc = key
+    if scheme == 'https':
+      return httplib.HTTPSConnection(netloc, timeout=self._timeout), False
+    return httplib.HTTPConnection(netloc, timeout=self._timeout), False
+
+  def _ReleaseConnection(self, key, conn):
+    with self._lock:
+      if len(self._idle[key]) < self._max_idle:
+        self._idle[key].append(conn)
+        return
+    conn.close()
+
+  def Request(self, url, headers=None):
+    """Sends a GET request, on an idle connection if there is one.
+
+    A request failing on a reused connection, which the remote host may have
+    closed in the meantime, is retried once on a new connection.
+
+    Returns:
+      A tuple of the response status, headers (an httplib.HTTPMessage) and
+      body.
+    Raises:
+      RemoteFileInfoError if the request fails.
+    """
+    url = urlparse.urlsplit(url)
+    key = (url.scheme, url.netloc)
+    path = url.path + ('?' + url.query if url.query else '')
+    while True:
+      conn, reused = self._GetConnection(key)
+      try:
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+      except (httplib.HTTPException, socket.error) as e:
+        conn.close()
+        if reused:
+          continue
+        raise RemoteFileInfoError('Request to %s failed: %r' % (url.netloc, e))
+
+      if response.will_close:
+        conn.close()
+      else:
+        self._ReleaseConnection(key, conn)
+      return response.status, response.msg, body
+
+
+class _Entry(object):
+  """Information about a remote file, and when it was last validated."""
+
+  __slots__ = ('value', 'etag', 'validated', 'revalidating')
+
+  def __init__(self, value, etag, validated):
+    self.value = value
+    self.etag = etag
+    self.validated = validated
+    self.revalidating = False
+
+
+class RemoteFileInfoCache(object):
+  """Fetches and caches information about remote files, by URL.
+
+  Members:
+    hits: lookups answered from a fresh copy.
+    stale_hits: lookups answered from a stale copy being revalidated.
+    misses: lookups that waited for the information to be fetched.
+    revalidations: conditional requests sent.
+    not_modified: conditional requests answered with 304 Not Modified.
+  """
+
+  def __init__(self, parse, fresh_seconds=FRESH_SECONDS,
+               max_stale_seconds=MAX_STALE_SECONDS, max_entries=MAX_ENTRIES,
+               pool=None):
+    """Creates an empty cache.
+
+    Args:
+      parse: function turning a response body into the value to cache; may
+             raise ValueError for malformed bodies.
+      fresh_seconds: seconds for which values are used without revalidation.
+      max_stale_seconds: seconds past freshness for which values are used
+                         while being revalidated in the background.
+      max_entries: maximum number of URLs whose values are kept.
+      pool: HTTPConnectionPool to fetch values with.
+    """
+    self._parse = parse
+    self._fresh_seconds = fresh_seconds
+    self._max_stale_seconds = max_stale_seconds
+    self._max_entries = max_entries
+    self._pool = pool or HTTPConnectionPool()
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    # Serializes fetches of each URL, so that concurrent misses fetch once.
+    self._fetch_locks = common_util.LockDict()
+    self.hits = 0
+    self.stale_hits = 0
+    self.misses = 0
+    self.revalidations = 0
+    self.not_modified = 0
+
+  def _Fetch(self, url, entry):
+    """Fetches the value of url, conditionally if entry is given.
+
+    Returns:
+      The up-to-date entry for url, which is also stored.
+    Raises:
+      RemoteFileInfoError if the value can't be fetched or parsed.
+    """
+    _Log('Fetching %s', url)
+    headers = {}
+    if entry and entry.etag:
+      headers['If-None-Match'] = entry.etag
+      self.revalidations += 1
+    status, response_headers, body = self._pool.Request(url, headers)
+    now = time.time()
+
+    if status == httplib.NOT_MODIFIED and entry:
+      self.not_modified += 1
+      new_entry = _Entry(entry.value, entry.etag, now)
+    elif status == httplib.OK:
+      try:
+        value = self._parse(body)
+      except ValueError as e:
+        raise RemoteFileInfoError('Malformed response from %s: %s' % (url, e))
+      new_entry = _Entry(value, response_headers.getheader('ETag'), now)
+    else:
+      raise RemoteFileInfoError('Request for %s failed with status %d' %
+                                (url, status))
+
+    with self._lock:
+      self._entries.pop(url, None)
+      self._entries[url] = new_entry
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+    return new_entry
+
+  def _Revalidate(self, url, entry):
+    """Background thread body; revalidates a stale entry."""
+    try:
+      with self._fetch_locks.lock(url):
+        self._Fetch(url, entry)
+    except RemoteFileInfoError as e:
+      _Log('Failed to revalidate %s, still using stale copy: %s', url, e)
+    finally:
+      entry.revalidating = False
+
+  def Get(self, url):
+    """Returns the value for url, fetching it only if it isn't cached.
+
+    Raises:
+      RemoteFileInfoError if the value had to be fetched and that failed.
+    """
+    with self._lock:
+      entry = self._entries.get(url)
+    now = time.time()
+    if entry:
+      age = now - entry.validated
+      if age < self._fresh_seconds:
+        self.hits += 1
+        return entry.value
+      if age < self._fresh_seconds + self._max_stale_seconds:
+        self.stale_hits += 1
+        with self._lock:
+          start = not entry.revalidating
+          entry.revalidating = True
+        if start:
+          thread = threading.Thread(target=self._Revalidate,
+                                    args=(url, entry))
+          thread.daemon = True
+          thread.start()
+        return entry.value
+
+    self.misses += 1
+    with self._fetch_locks.lock(url):
+      # Another thread may have fetched it while this one waited.
+      with self._lock:
+        current = self._entries.get(url)
+      if current and current is not entry:
+        return current.value
+      return self._Fetch(url, entry).value
+
+  def GetStats(self):
+    """Returns a dictionary of cache statistics."""
+    with self._lock:
+      entries = len(self._entries)
+    return {'entries': entries,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'not_modified': self.not_modified}
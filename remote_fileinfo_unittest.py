@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for remote_fileinfo module."""
+
+import httplib
+import mimetools
+import socket
+import StringIO
+import threading
+import time
+import unittest
+
+import mox
+
+import remote_fileinfo
+
+
+_URL = 'http://remotehost:8080/api/fileinfo/update.gz'
+
+
+def _Headers(etag):
+  return mimetools.Message(StringIO.StringIO('ETag: %s\r\n\r\n' % etag))
+
+
+class RemoteFileInfoCacheTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.pool = self.mox.CreateMock(remote_fileinfo.HTTPConnectionPool)
+    self.now = 1000.0
+    self.stubs.Set(time, 'time', lambda: self.now)
+    self.cache = remote_fileinfo.RemoteFileInfoCache(
+        int, fresh_seconds=10, max_stale_seconds=100, pool=self.pool)
+
+  @staticmethod
+  def _WaitForRevalidation():
+    for thread in threading.enumerate():
+      if thread is not threading.current_thread():
+        thread.join()
+
+  def testFreshValueIsReused(self):
+    self.pool.Request(_URL, {}).AndReturn((200, _Headers('"a"'), '1'))
+    self.mox.ReplayAll()
+    self.assertEqual(self.cache.Get(_URL), 1)
+    self.now += 5
+    self.assertEqual(self.cache.Get(_URL), 1)
+    self.assertEqual((self.cache.misses, self.cache.hits), (1, 1))
+    self.mox.VerifyAll()
+
+  def testStaleValueIsUsedWhileRevalidated(self):
+    self.pool.Request(_URL, {}).AndReturn((200, _Headers('"a"'), '1'))
+    self.pool.Request(_URL, {'If-None-Match': '"a"'}).AndReturn(
+        (304, _Headers('"a"'), ''))
+    self.mox.ReplayAll()
+    self.assertEqual(self.cache.Get(_URL), 1)
+    self.now += 20
+    self.assertEqual(self.cache.Get(_URL), 1)
+    self._WaitForRevalidation()
+    self.assertEqual(self.cache.stale_hits, 1)
+    # The revalidated copy is fresh again.
+    self.assertEqual(self.cache.Get(_URL), 1)
+    self.assertEqual(self.cache.hits, 1)
+    self.mox.VerifyAll()
+
+  def testExpiredValueIsFetchedAgain(self):
+    self.pool.Request(_URL, {}).AndReturn((200, _Headers('"a"'), '1'))
+    self.pool.Request(_URL, {'If-None-Match': '"a"'}).AndReturn(
+        (200, _Headers('"b"'), '2'))
+    self.mox.ReplayAll()
+    self.assertEqual(self.cache.Get(_URL), 1)
+    self.now += 200
+    self.assertEqual(self.cache.Get(_URL), 2)
+    self.assertEqual(self.cache.misses, 2)
+    self.mox.VerifyAll()
+
+  def testFailures(self):
+    self.pool.Request(_URL, {}).AndReturn((404, _Headers('"a"'), ''))
+    self.pool.Request(_URL, {}).AndReturn((200, _Headers('"a"'), 'junk'))
+    self.mox.ReplayAll()
+    self.assertRaises(remote_fileinfo.RemoteFileInfoError, self.cache.Get,
+                      _URL)
+    self.assertRaises(remote_fileinfo.RemoteFileInfoError, self.cache.Get,
+                      _URL)
+    self.mox.VerifyAll()
+
+
+class HTTPConnectionPoolTest(mox.MoxTestBase):
+
+  def _CreateConnection(self, status=None, will_close=False):
+    """Returns a mock connection answering a request with status, or failing.
+    """
+    conn = self.mox.CreateMock(httplib.HTTPConnection)
+    conn.request('GET', '/api/fileinfo/update.gz', headers={})
+    if status is None:
+      conn.getresponse().AndRaise(socket.error('reset'))
+      conn.close()
+    else:
+      response = self.mox.CreateMock(httplib.HTTPResponse)
+      response.status = status
+      response.msg = _Headers('"a"')
+      response.will_close = will_close
+      conn.getresponse().AndReturn(response)
+      response.read().AndReturn('body')
+    return conn
+
+  def testConnectionsAreReusedAndRetried(self):
+    pool = remote_fileinfo.HTTPConnectionPool()
+    self.mox.StubOutWithMock(pool, '_GetConnection')
+    key = ('http', 'remotehost:8080')
+    first = self._CreateConnection(200)
+    stale = self._CreateConnection()
+    fresh = self._CreateConnection(200, will_close=True)
+    fresh.close()
+    pool._GetConnection(key).AndReturn((first, False))
+    pool._GetConnection(key).AndReturn((stale, True))
+    pool._GetConnection(key).AndReturn((fresh, False))
+    self.mox.ReplayAll()
+
+    self.assertEqual(pool.Request(_URL)[0], 200)
+    self.assertEqual(pool._idle[key], [first])
+    self.assertEqual(pool.Request(_URL)[2], 'body')
+    self.mox.VerifyAll()
+
+  def testFailureOnNewConnectionIsRaised(self):
+    pool = remote_fileinfo.HTTPConnectionPool()
+    self.mox.StubOutWithMock(pool, '_GetConnection')
+    failing = self._CreateConnection()
+    pool._GetConnection(('http', 'remotehost:8080')).AndReturn(
+        (failing, False))
+    self.mox.ReplayAll()
+    self.assertRaises(remote_fileinfo.RemoteFileInfoError, pool.Request, _URL)
+    self.mox.VerifyAll()
+
+
+if __name__ == '__main__':
+  unittest.main()
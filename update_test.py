@@ -4,106 +4,320 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-from xml.dom import minidom
+"""Load generator and latency benchmark for devserver update pings.
+
+Sends a mix of protocol 2.0 and 3.0 update checks and event pings from a set
+of simulated clients, and reports throughput and latency percentiles. Unless
+--url is given, a devserver is started in serve-only mode on a temporary
+archive directory holding generated payloads, so that runs are repeatable.
+
+Simulated clients are told apart by the devserver by their address, so against
+a local devserver each one connects from its own 127.x.y.z address. With a
+request rate, latencies are measured from when each request was due, so that a
+stalled server isn't hidden by the load generator slowing down with it.
+
+Usage:
+  update_test.py [--concurrency=10] [--rate=0] [--requests=1000]
+                 [--clients=100] [--event_ratio=0.3] [--protocol2_ratio=0.2]
+                 [--url=http://host:port]
+"""
+
+import collections
+import httplib
+import itertools
+import optparse
+import os
+import random
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
 import threading
-import urllib2
+import time
+import urlparse
+
 
+_APP_ID = '{87efface-864d-49a5-9bb3-4b050a7c227a}'
+_LEGACY_APP_ID = '{e96281a6-d1af-4bde-9a0a-97b76e56dc57}'
 
-UPDATE_BLOB="""\
+_REQUEST_2_0 = """\
 <?xml version="1.0" encoding="UTF-8"?>
-<o:gupdate
-  xmlns:o="http://www.google.com/update2/request"
-  version="MementoSoftwareUpdate-0.1.0.0"
-  protocol="2.0"
-  machineid="{1B0A13AC-7004-638C-3CA6-EC082E8F5DE9}"
-  ismachine="0"
-  userid="{bogus}">
-<o:os version="Memento"
-   platform="memento"
-   sp="ForcedUpdate_i686">
-</o:os>
-<o:app appid="{87efface-864d-49a5-9bb3-4b050a7c227a}"
-   version="ForcedUpdate"
-   lang="en-us"
-   brand="GGLG"
-   track="developer-build"
-   board="x86-generic">
-<o:ping active="0"></o:ping>
-<o:updatecheck></o:updatecheck>
+<o:gupdate xmlns:o="http://www.google.com/update2/request" protocol="2.0"
+  version="MementoSoftwareUpdate-0.1.0.0" ismachine="0"
+  machineid="{%(machine_id)s}" userid="{bogus}">
+<o:os version="Memento" platform="memento" sp="ForcedUpdate_i686"></o:os>
+<o:app appid="%(app_id)s" version="%(version)s" lang="en-us" brand="GGLG"
+  track="developer-build" board="x86-generic">
+%(body)s
 </o:app>
 </o:gupdate>
 """
 
-UPDATE_URL = 'http://localhost:8080/update/'
-
-def do_ping():
-  update_ping = urllib2.Request(UPDATE_URL, update_blob)
-  update_ping.add_header('Content-Type', 'text/xml')
-  print urllib2.urlopen(update_ping).read()
-  #TODO assert noupdate
-
-def do_version_ping():
-  url = UPDATE_URL + 'LATEST'
-  update_ping = urllib2.Request(url, UPDATE_BLOB)
-  update_ping.add_header('Content-Type', 'text/xml')
-  response = urllib2.urlopen(update_ping).read()
-  assert _verify_response(response), 'couldn\'t fetch update file'
-  print 'Successfully pinged updateserver.'
-
-def do_badversion_ping():
-  url = UPDATE_URL + 'BADVERSION'
-  update_ping = urllib2.Request(url, UPDATE_BLOB)
-  update_ping.add_header('Content-Type', 'text/xml')
-  response = urllib2.urlopen(update_ping).read()
-  assert ('noupdate' in response)
-  print 'requesting bogus version returns noupdate.'
-
-def _verify_download(url, content_length):
-  # Eventually, verify something about the update. For now,
-  # sanity-check its size.
-  f = urllib2.urlopen(url)
-  data = f.read(1024 * 1024)
-  length = len(data)
-  while data:
-    data = f.read(1024 * 1024)
-    length += len(data)
-  assert content_length == length
-  print 'Got a valid download.'
-  return True
-
-def _verify_response(data):
-  update_dom = minidom.parseString(data)
-  print data
-  root = update_dom.firstChild
-  update_info = root.getElementsByTagName('updatecheck')[0]
-  update_url = update_info.getAttribute('codebase')
-  hash = update_info.getAttribute('hash')
-  head_request = urllib2.Request(update_url)
-  head_request.get_method = lambda: 'HEAD'
+_REQUEST_3_0 = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<request protocol="3.0" version="CoreOSUpdateEngine-0.1.0.0"
+  updaterversion="CoreOSUpdateEngine-0.1.0.0" installsource="ondemandupdate"
+  ismachine="1">
+<os version="Indy" platform="Chrome OS" sp="ForcedUpdate_x86_64"></os>
+<app appid="%(app_id)s" version="%(version)s" track="developer-build"
+  lang="en-US" board="x86-generic" hardware_class="" delta_okay="false"
+  machineid="{%(machine_id)s}">
+%(body)s
+</app>
+</request>
+"""
+
+_UPDATE_CHECK = {'2.0': '<o:ping active="0"></o:ping>'
+                        '<o:updatecheck></o:updatecheck>',
+                 '3.0': '<ping active="1"></ping><updatecheck></updatecheck>'}
+_EVENT = {'2.0': '<o:event eventtype="3" eventresult="1" '
+                 'previousversion="%(version)s"></o:event>',
+          '3.0': '<event eventtype="3" eventresult="1" '
+                 'previousversion="%(version)s"></event>'}
+
+# Size of the generated payloads a local devserver serves.
+_PAYLOAD_SIZE = 1024 * 1024
+
+# Seconds to wait for a local devserver to start.
+_STARTUP_TIMEOUT = 30
+
+
+class Client(object):
+  """A simulated update client.
+
+  Members:
+    address: local address to connect from, or None for the default.
+    machine_id: the client's machine id.
+    version: the version the client reports running.
+  """
+
+  def __init__(self, index, use_source_address):
+    self.address = None
+    if use_source_address:
+      self.address = '127.%d.%d.%d' % (1 + index / 65536 % 254,
+                                       index / 256 % 256, index % 256)
+    self.machine_id = '%08X-0000-0000-0000-%012X' % (index, index)
+    self.version = '0.%d.0' % (index % 10)
+
+  def GetRequest(self, protocol, kind):
+    """Returns the body of an update check or event ping from this client."""
+    values = {'machine_id': self.machine_id, 'version': self.version,
+              'app_id': _APP_ID if protocol == '3.0' else _LEGACY_APP_ID}
+    values['body'] = (_UPDATE_CHECK if kind == 'update' else _EVENT)[protocol]
+    values['body'] %= values
+    return (_REQUEST_3_0 if protocol == '3.0' else _REQUEST_2_0) % values
+
+
+class LoadGenerator(object):
+  """Sends update pings from several threads and records their latencies."""
+
+  def __init__(self, url, clients, options):
+    url = urlparse.urlsplit(url)
+    self._host = url.hostname
+    self._port = url.port or 80
+    self._path = url.path.rstrip('/') + '/update'
+    self._clients = clients
+    self._options = options
+    self._next_request = itertools.count()
+    self._lock = threading.Lock()
+    # Latencies in seconds, and error counts, by request kind.
+    self.latencies = collections.defaultdict(list)
+    self.errors = collections.defaultdict(int)
+    self.updates_offered = 0
+
+  def _PickKind(self):
+    """Returns a (protocol, kind) pair following the configured mix."""
+    options = self._options
+    protocol = '2.0' if random.random() < options.protocol2_ratio else '3.0'
+    kind = 'event' if random.random() < options.event_ratio else 'update'
+    return protocol, kind
+
+  def _SendRequest(self, client, body):
+    """Sends one update ping on a new connection; returns the response."""
+    conn = httplib.HTTPConnection(
+        self._host, self._port, timeout=60,
+        source_address=(client.address, 0) if client.address else None)
+    try:
+      conn.request('POST', self._path, body,
+                   {'Content-Type': 'text/xml', 'Connection': 'close'})
+      response = conn.getresponse()
+      return response.status, response.read()
+    finally:
+      conn.close()
+
+  def _Run(self, start_time):
+    """Worker thread loop; sends requests until all have been sent."""
+    options = self._options
+    while True:
+      with self._lock:
+        index = next(self._next_request)
+      if index >= options.requests:
+        return
+
+      due = time.time()
+      if options.rate:
+        due = start_time + float(index) / options.rate
+        time.sleep(max(0, due - time.time()))
+
+      client = self._clients[index % len(self._clients)]
+      protocol, kind = self._PickKind()
+      request_kind = '%s %s' % (kind, protocol)
+      try:
+        status, data = self._SendRequest(client,
+                                         client.GetRequest(protocol, kind))
+        failed = status != 200
+      except (socket.error, httplib.HTTPException):
+        failed, data = True, ''
+      latency = time.time() - due
+
+      with self._lock:
+        if failed:
+          self.errors[request_kind] += 1
+        else:
+          self.latencies[request_kind].append(latency)
+          if kind == 'update' and 'noupdate' not in data:
+            self.updates_offered += 1
+
+  def Run(self):
+    """Sends all requests; returns the number of seconds it took."""
+    start_time = time.time()
+    threads = [threading.Thread(target=self._Run, args=(start_time,))
+               for _ in range(self._options.concurrency)]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return time.time() - start_time
+
+
+def _Percentile(sorted_values, percent):
+  """Returns the nearest-rank percentile of a sorted list."""
+  if not sorted_values:
+    return 0
+  rank = max(0, int(round(percent / 100.0 * len(sorted_values))) - 1)
+  return sorted_values[rank]
+
+
+def PrintReport(generator, elapsed):
+  """Prints throughput and latency percentiles, overall and by kind."""
+  all_latencies = sum(generator.latencies.values(), [])
+  total = len(all_latencies) + sum(generator.errors.values())
+  print ('%d requests in %.2fs: %.1f requests/s, %d errors, '
+         '%d updates offered' % (total, elapsed, total / elapsed,
+                                 sum(generator.errors.values()),
+                                 generator.updates_offered))
+  print '%-12s %8s %8s %8s %8s %8s %7s' % ('kind', 'count', 'p50 ms', 'p95 ms',
+                                           'p99 ms', 'max ms', 'errors')
+  kinds = sorted(set(generator.latencies) | set(generator.errors))
+  for kind in kinds + ['all']:
+    latencies = sorted(all_latencies if kind == 'all'
+                       else generator.latencies[kind])
+    errors = (sum(generator.errors.values()) if kind == 'all'
+              else generator.errors[kind])
+    print '%-12s %8d %8.1f %8.1f %8.1f %8.1f %7d' % (
+        kind, len(latencies), _Percentile(latencies, 50) * 1000,
+        _Percentile(latencies, 95) * 1000, _Percentile(latencies, 99) * 1000,
+        (latencies[-1] if latencies else 0) * 1000, errors)
+
+
+def _GetFreePort():
+  """Returns a TCP port that is currently free on localhost."""
+  sock = socket.socket()
+  try:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+  finally:
+    sock.close()
+
+
+def StartLocalDevserver(archive_dir, port, extra_args):
+  """Starts a devserver serving generated payloads from archive_dir.
+
+  Returns:
+    The devserver process, once it accepts connections.
+  """
+  for file_name in ('update.gz', 'kernel_update.gz'):
+    with open(os.path.join(archive_dir, file_name), 'wb') as f:
+      f.write(os.urandom(_PAYLOAD_SIZE))
+
+  devserver = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'devserver.py')
+  with open(os.path.join(archive_dir, 'devserver.log'), 'w') as log_file:
+    process = subprocess.Popen(
+        [sys.executable, devserver, '--archive_dir', archive_dir,
+         '--data_dir', archive_dir, '--port', str(port), '--production',
+         '--logfile', log_file.name] + extra_args,
+        stdout=log_file, stderr=subprocess.STDOUT)
+
+  deadline = time.time() + _STARTUP_TIMEOUT
+  while time.time() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError('devserver exited with status %d' % process.returncode)
+    try:
+      socket.create_connection(('127.0.0.1', port), timeout=1).close()
+      return process
+    except socket.error:
+      time.sleep(0.2)
+  process.kill()
+  raise RuntimeError('devserver did not start within %ds' % _STARTUP_TIMEOUT)
+
+
+def main():
+  parser = optparse.OptionParser(usage=__doc__.split('Usage:')[1].rstrip())
+  parser.add_option('--clients', type='int', default=100,
+                    help='number of simulated clients (default: %default)')
+  parser.add_option('--concurrency', type='int', default=10,
+                    help='number of requests in flight (default: %default)')
+  parser.add_option('--devserver_args', default='',
+                    help='extra arguments for a local devserver, e.g. '
+                    '"--workers 4"')
+  parser.add_option('--event_ratio', type='float', default=0.3,
+                    help='fraction of requests that are event pings rather '
+                    'than update checks (default: %default)')
+  parser.add_option('--protocol2_ratio', type='float', default=0.2,
+                    help='fraction of requests using protocol 2.0 rather '
+                    'than 3.0 (default: %default)')
+  parser.add_option('--rate', type='float', default=0,
+                    help='requests per second to send, or 0 to send as fast '
+                    'as possible (default: %default)')
+  parser.add_option('--requests', type='int', default=1000,
+                    help='total number of requests (default: %default)')
+  parser.add_option('--seed', type='int', default=0,
+                    help='random seed of the request mix (default: %default)')
+  parser.add_option('--url',
+                    help='base URL of a running devserver to test, instead of '
+                    'starting one, e.g. http://localhost:8080')
+  options, _ = parser.parse_args()
+  random.seed(options.seed)
+
+  archive_dir = None
+  devserver = None
+  url = options.url
   try:
-    fd = urllib2.urlopen(head_request)
-  except urllib2.HTTPError, e:
-    # HTTP error
-    print 'FAILED: unable to retrieve %s\n\t%s' % (update_url, e)
-    length = 0
-  else:
-    # HTTP succeeded
-    length = int(fd.headers.getheaders('Content-Length')[0])
+    if not url:
+      archive_dir = tempfile.mkdtemp(prefix='update_test')
+      port = _GetFreePort()
+      devserver = StartLocalDevserver(archive_dir, port,
+                                      options.devserver_args.split())
+      url = 'http://127.0.0.1:%d' % port
+
+    # Other addresses in 127/8 reach a local devserver on Linux.
+    use_source_address = (sys.platform.startswith('linux') and
+                          urlparse.urlsplit(url).hostname in
+                          ('localhost', '127.0.0.1'))
+    clients = [Client(i, use_source_address) for i in range(options.clients)]
+
+    generator = LoadGenerator(url, clients, options)
+    PrintReport(generator, generator.Run())
   finally:
-    fd.close()
-    return (length > 0)
+    if devserver:
+      devserver.terminate()
+      devserver.wait()
+    if archive_dir:
+      shutil.rmtree(archive_dir)
 
-def test(num_clients):
-  # Fake some concurrent requests for each autoupdate operation.
-  for clients in range(num_clients):
-    for op in (do_version_ping, do_badversion_ping):
-      t = threading.Thread(target=op)
-      t.start()
 
 if __name__ == '__main__':
-  if len(sys.argv) > 1:
-    num_clients = int(sys.argv[1])
-  else:
-    num_clients = 1
-  test(num_clients)
+  main()